@@ -1,797 +1,2868 @@
-# %%
-import base64, requests, schedule, time, json, pytz, logging, os, sys
-from requests.exceptions import ConnectionError
-from datetime import datetime, timedelta
-# for influxdb 1.x
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
-# for influxdb 2.x
-from influxdb_client import InfluxDBClient as InfluxDBClient2
-# from influxdb_client.client.exceptions import InfluxDBError # possible duplicate
-from influxdb_client.client.write_api import SYNCHRONOUS
-# for influxdb 3.x
-from influxdb_client_3 import InfluxDBClient3, InfluxDBError
-# For XML processing
-import xml.etree.ElementTree as ET
-
-# %% [markdown]
-# ## Variables
-
-# %%
-FITBIT_LOG_FILE_PATH = os.environ.get("FITBIT_LOG_FILE_PATH") or "your/expected/log/file/location/path"
-TOKEN_FILE_PATH = os.environ.get("TOKEN_FILE_PATH") or "your/expected/token/file/location/path"
-OVERWRITE_LOG_FILE = True
-FITBIT_LANGUAGE = 'en_US'
-INFLUXDB_VERSION = os.environ.get("INFLUXDB_VERSION") or "1" # Version of influxdb in use, supported values are 1 or 2
-assert INFLUXDB_VERSION in ['1','2','3'], "Only InfluxDB version 1 or 2 or 3 is allowed - please put either 1 or 2 or 3"
-# Update these variables for influxdb 1.x versions
-INFLUXDB_HOST = os.environ.get("INFLUXDB_HOST") or 'localhost' # for influxdb 1.x
-INFLUXDB_PORT = os.environ.get("INFLUXDB_PORT") or 8086 # for influxdb 1.x 
-INFLUXDB_USERNAME = os.environ.get("INFLUXDB_USERNAME") or 'your_influxdb_username' # for influxdb 1.x
-INFLUXDB_PASSWORD = os.environ.get("INFLUXDB_PASSWORD") or 'your_influxdb_password' # for influxdb 1.x
-INFLUXDB_DATABASE = os.environ.get("INFLUXDB_DATABASE") or 'your_influxdb_database_name' # for influxdb 1.x
-# Update these variables for influxdb 2.x versions
-INFLUXDB_BUCKET = os.environ.get("INFLUXDB_BUCKET") or "your_bucket_name_here" # for influxdb 2.x
-INFLUXDB_ORG = os.environ.get("INFLUXDB_ORG") or "your_org_here" # for influxdb 2.x
-INFLUXDB_TOKEN = os.environ.get("INFLUXDB_TOKEN") or "your_token_here" # for influxdb 2.x
-INFLUXDB_URL = os.environ.get("INFLUXDB_URL") or "http://your_url_here:8086" # for influxdb 2.x
-INFLUXDB_V3_ACCESS_TOKEN = os.getenv("INFLUXDB_V3_ACCESS_TOKEN",'') # InfluxDB V3 Access token, required only for InfluxDB 3.x
-# MAKE SURE you set the application type to PERSONAL. Otherwise, you won't have access to intraday data series, resulting in 40X errors.
-client_id = os.environ.get("CLIENT_ID") or "your_application_client_ID" # Change this to your client ID
-client_secret = os.environ.get("CLIENT_SECRET") or "your_application_client_secret" # Change this to your client Secret
-DEVICENAME = os.environ.get("DEVICENAME") or "Your_Device_Name" # e.g. "Charge5"
-ACCESS_TOKEN = "" # Empty Global variable initialization, will be replaced with a functional access code later using the refresh code
-MANUAL_START_DATE = os.getenv("MANUAL_START_DATE", None) # optional, in YYYY-MM-DD format, if you want to bulk update only from specific date
-MANUAL_END_DATE = os.getenv("MANUAL_END_DATE", datetime.today().strftime('%Y-%m-%d')) # optional, in YYYY-MM-DD format, if you want to bulk update until a specific date
-AUTO_DATE_RANGE = False if os.environ.get("AUTO_DATE_RANGE") in ['False','false','FALSE','f','F','no','No','NO','0'] else (not bool(MANUAL_START_DATE)) # Automatically selects date range from todays date and update_date_range variable
-auto_update_date_range = 1 # Days to go back from today for AUTO_DATE_RANGE *** DO NOT go above 2 - otherwise may break rate limit ***
-LOCAL_TIMEZONE = os.environ.get("LOCAL_TIMEZONE") or "Automatic" # set to "Automatic" for Automatic setup from User profile (if not mentioned here specifically).
-SCHEDULE_AUTO_UPDATE = True if AUTO_DATE_RANGE else False # Scheduling updates of data when script runs
-SERVER_ERROR_MAX_RETRY = 3
-EXPIRED_TOKEN_MAX_RETRY = 5
-SKIP_REQUEST_ON_SERVER_ERROR = True
-
-# %% [markdown]
-# ## Logging setup
-
-# %%
-if OVERWRITE_LOG_FILE:
-    with open(FITBIT_LOG_FILE_PATH, "w"): pass
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(FITBIT_LOG_FILE_PATH, mode='a'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
-
-# %% [markdown]
-# ## Setting up base API Caller function
-
-# %%
-# Generic Request caller for all 
-def request_data_from_fitbit(url, headers={}, params={}, data={}, request_type="get"):
-    global ACCESS_TOKEN
-    retry_attempts = 0
-    logging.debug("Requesting data from fitbit via Url : " + url)
-    while True: # Unlimited Retry attempts
-        if request_type == "get" and headers == {}:
-            headers = {
-                "Authorization": f"Bearer {ACCESS_TOKEN}",
-                "Accept": "application/json",
-                'Accept-Language': FITBIT_LANGUAGE
-            }
-        try:        
-            if request_type == "get":
-                response = requests.get(url, headers=headers, params=params, data=data)
-            elif request_type == "post":
-                response = requests.post(url, headers=headers, params=params, data=data)
-            else:
-                raise Exception("Invalid request type " + str(request_type))
-        
-            if response.status_code == 200: # Success
-                if url.endswith(".tcx"): # TCX XML file for GPS data
-                    return response
-                else:
-                    return response.json()
-            elif response.status_code == 429: # API Limit reached
-                retry_after = int(response.headers["Fitbit-Rate-Limit-Reset"]) + 300 # Fitbit changed their headers.
-                logging.warning("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(retry_after) + " seconds")
-                print("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(retry_after) + " seconds")
-                time.sleep(retry_after)
-            elif response.status_code == 401: # Access token expired ( most likely )
-                logging.info("Current Access Token : " + ACCESS_TOKEN)
-                logging.warning("Error code : " + str(response.status_code) + ", Details : " + response.text)
-                print("Error code : " + str(response.status_code) + ", Details : " + response.text)
-                ACCESS_TOKEN = Get_New_Access_Token(client_id, client_secret)
-                logging.info("New Access Token : " + ACCESS_TOKEN)
-                headers["Authorization"] = f"Bearer {ACCESS_TOKEN}" # Update the renewed ACCESS_TOKEN to the headers dict
-                time.sleep(30)
-                if retry_attempts > EXPIRED_TOKEN_MAX_RETRY:
-                    logging.error("Unable to solve the 401 Error. Please debug - " + response.text)
-                    raise Exception("Unable to solve the 401 Error. Please debug - " + response.text)
-            elif response.status_code in [500, 502, 503, 504]: # Fitbit server is down or not responding ( most likely ):
-                logging.warning("Server Error encountered ( Code 5xx ): Retrying after 120 seconds....")
-                time.sleep(120)
-                if retry_attempts > SERVER_ERROR_MAX_RETRY:
-                    logging.error("Unable to solve the server Error. Retry limit exceed. Please debug - " + response.text)
-                    if SKIP_REQUEST_ON_SERVER_ERROR:
-                        logging.warning("Retry limit reached for server error : Skipping request -> " + url)
-                        return None
-            else:
-                logging.error("Fitbit API request failed. Status code: " + str(response.status_code) + " " + str(response.text) )
-                print(f"Fitbit API request failed. Status code: {response.status_code}", response.text)
-                response.raise_for_status()
-                return None
-
-        except ConnectionError as e:
-            logging.error("Retrying in 5 minutes - Failed to connect to internet : " + str(e))
-            print("Retrying in 5 minutes - Failed to connect to internet : " + str(e))
-        retry_attempts += 1
-        time.sleep(30)
-
-# %% [markdown]
-# ## Token Refresh Management
-
-# %%
-def refresh_fitbit_tokens(client_id, client_secret, refresh_token):
-    logging.info("Attempting to refresh tokens...")
-    url = "https://api.fitbit.com/oauth2/token"
-    headers = {
-        "Authorization": "Basic " + base64.b64encode((client_id + ":" + client_secret).encode()).decode(),
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token
-    }
-    json_data = request_data_from_fitbit(url, headers=headers, data=data, request_type="post")
-    access_token = json_data["access_token"]
-    new_refresh_token = json_data["refresh_token"]
-    tokens = {
-        "access_token": access_token,
-        "refresh_token": new_refresh_token
-    }
-    with open(TOKEN_FILE_PATH, "w") as file:
-        json.dump(tokens, file)
-    logging.info("Fitbit token refresh successful!")
-    return access_token, new_refresh_token
-
-def load_tokens_from_file():
-    with open(TOKEN_FILE_PATH, "r") as file:
-        tokens = json.load(file)
-        return tokens.get("access_token"), tokens.get("refresh_token")
-
-def Get_New_Access_Token(client_id, client_secret):
-    try:
-        access_token, refresh_token = load_tokens_from_file()
-    except FileNotFoundError:
-        refresh_token = input("No token file found. Please enter a valid refresh token : ")
-    access_token, refresh_token = refresh_fitbit_tokens(client_id, client_secret, refresh_token)
-    return access_token
-
-ACCESS_TOKEN = Get_New_Access_Token(client_id, client_secret)
-
-# %% [markdown]
-# ## Influxdb Database Initialization
-
-# %%
-if INFLUXDB_VERSION == "2":
-    try:
-        influxdbclient = InfluxDBClient2(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
-        influxdb_write_api = influxdbclient.write_api(write_options=SYNCHRONOUS)
-    except InfluxDBError as err:
-        logging.error("Unable to connect with influxdb 2.x database! Aborted")
-        raise InfluxDBError("InfluxDB connection failed:" + str(err))
-elif INFLUXDB_VERSION == "1":
-    try:
-        influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD)
-        influxdbclient.switch_database(INFLUXDB_DATABASE)
-    except InfluxDBClientError as err:
-        logging.error("Unable to connect with influxdb 1.x database! Aborted")
-        raise InfluxDBClientError("InfluxDB connection failed:" + str(err))
-elif INFLUXDB_VERSION == "3":
-    try:
-        influxdbclient = InfluxDBClient3(
-                host=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
-                token=INFLUXDB_V3_ACCESS_TOKEN,
-                database=INFLUXDB_DATABASE
-                )
-        demo_point = {
-        'measurement': 'DemoPoint',
-        'time': '1970-01-01T00:00:00+00:00',
-        'tags': {'DemoTag': 'DemoTagValue'},
-        'fields': {'DemoField': 0}
-        }
-        # The following code block tests the connection by writing/overwriting a demo point. raises error and aborts if connection fails. 
-        influxdbclient.write(record=[demo_point])
-    except InfluxDBError as err:
-        logging.error("Unable to connect with influxdb 3.x database! Aborted")
-        raise InfluxDBClientError("InfluxDB connection failed:" + str(err))
-else:
-    logging.error("No matching version found. Supported values are 1 and 2 and 3")
-    raise InfluxDBClientError("No matching version found. Supported values are 1 and 2 and 3")
-
-def write_points_to_influxdb(points):
-    if INFLUXDB_VERSION == "2":
-        try:
-            influxdb_write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=points)
-            logging.info("Successfully updated influxdb database with new points")
-        except InfluxDBError as err:
-            logging.error("Unable to connect with influxdb 2.x database! " + str(err))
-            print("Influxdb connection failed! ", str(err))
-    elif INFLUXDB_VERSION == "1":
-        try:
-            influxdbclient.write_points(points)
-            logging.info("Successfully updated influxdb database with new points")
-        except InfluxDBClientError as err:
-            logging.error("Unable to connect with influxdb 1.x database! " + str(err))
-            print("Influxdb connection failed! ", str(err))
-    elif INFLUXDB_VERSION == "3":
-        try:
-            influxdbclient.write(record=points)
-            logging.info("Successfully updated influxdb database with new points")
-        except InfluxDBError as err:
-            logging.error("Unable to connect with influxdb 3.x database! " + str(err))
-            print("Influxdb connection failed! ", str(err))
-    else:
-        logging.error("No matching version found. Supported values are 1 and 2 and 3")
-        raise InfluxDBClientError("No matching version found. Supported values are 1 and 2 and 3")
-
-# %% [markdown]
-# ## Set Timezone from profile data
-
-# %%
-if LOCAL_TIMEZONE == "Automatic":
-    LOCAL_TIMEZONE = pytz.timezone(request_data_from_fitbit("https://api.fitbit.com/1/user/-/profile.json")["user"]["timezone"])
-else:
-    LOCAL_TIMEZONE = pytz.timezone(LOCAL_TIMEZONE)
-
-# %% [markdown]
-# ## Selecting Dates for update
-
-# %%
-if AUTO_DATE_RANGE:
-    end_date = datetime.now(LOCAL_TIMEZONE)
-    start_date = end_date - timedelta(days=auto_update_date_range)
-    end_date_str = end_date.strftime("%Y-%m-%d")
-    start_date_str = start_date.strftime("%Y-%m-%d")
-else:
-    start_date_str = MANUAL_START_DATE or input("Enter start date in YYYY-MM-DD format : ")
-    end_date_str = MANUAL_END_DATE or input("Enter end date in YYYY-MM-DD format : ")
-    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-
-# %% [markdown]
-# ## Setting up functions for Requesting data from server
-
-# %%
-collected_records = []
-
-def update_working_dates():
-    global end_date, start_date, end_date_str, start_date_str
-    end_date = datetime.now(LOCAL_TIMEZONE)
-    start_date = end_date - timedelta(days=auto_update_date_range)
-    end_date_str = end_date.strftime("%Y-%m-%d")
-    start_date_str = start_date.strftime("%Y-%m-%d")
-
-# Get last synced battery level of the device
-def get_battery_level():
-    device = request_data_from_fitbit("https://api.fitbit.com/1/user/-/devices.json")[0]
-    if device != None:
-        collected_records.append({
-            "measurement": "DeviceBatteryLevel",
-            "time": LOCAL_TIMEZONE.localize(datetime.fromisoformat(device['lastSyncTime'])).astimezone(pytz.utc).isoformat(),
-            "fields": {
-                "value": float(device['batteryLevel'])
-            }
-        })
-        logging.info("Recorded battery level for " + DEVICENAME)
-    else:
-        logging.error("Recording battery level failed : " + DEVICENAME)
-
-# For intraday detailed data, max possible range in one day. 
-def get_intraday_data_limit_1d(date_str, measurement_list):
-    for measurement in measurement_list:
-        data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/' + measurement[0] + '/date/' + date_str + '/1d/' + measurement[2] + '.json')["activities-" + measurement[0] + "-intraday"]['dataset']
-        if data != None:
-            for value in data:
-                log_time = datetime.fromisoformat(date_str + "T" + value['time'])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  measurement[1],
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            "value": int(value['value'])
-                        }
-                    })
-            logging.info("Recorded " +  measurement[1] + " intraday for date " + date_str)
-        else:
-            logging.error("Recording failed : " +  measurement[1] + " intraday for date " + date_str)
-
-# Max range is 30 days, records BR, SPO2 Intraday, skin temp and HRV - 4 queries
-def get_daily_data_limit_30d(start_date_str, end_date_str):
-
-    hrv_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/hrv/date/' + start_date_str + '/' + end_date_str + '.json').get('hrv')
-    if hrv_data_list != None:
-        for data in hrv_data_list:
-            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                    "measurement":  "HRV",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME
-                    },
-                    "fields": {
-                        "dailyRmssd": data["value"]["dailyRmssd"],
-                        "deepRmssd": data["value"]["deepRmssd"]
-                    }
-                })
-        logging.info("Recorded HRV for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed HRV for date " + start_date_str + " to " + end_date_str)
-
-    br_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/br/date/' + start_date_str + '/' + end_date_str + '.json').get("br")
-    if br_data_list != None:
-        for data in br_data_list:
-            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                    "measurement":  "BreathingRate",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME
-                    },
-                    "fields": {
-                        "value": data["value"]["breathingRate"]
-                    }
-                })
-        logging.info("Recorded BR for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.warning("Records not found : BR for date " + start_date_str + " to " + end_date_str)
-
-    skin_temp_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/temp/skin/date/' + start_date_str + '/' + end_date_str + '.json').get("tempSkin")
-    if skin_temp_data_list != None:
-        for temp_record in skin_temp_data_list:
-            log_time = datetime.fromisoformat(temp_record["dateTime"] + "T" + "00:00:00")
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                    "measurement":  "Skin Temperature Variation",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME
-                    },
-                    "fields": {
-                        "RelativeValue": temp_record["value"]["nightlyRelative"]
-                    }
-                })
-        logging.info("Recorded Skin Temperature Variation for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : Skin Temperature Variation for date " + start_date_str + " to " + end_date_str)
-
-    spo2_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/spo2/date/' + start_date_str + '/' + end_date_str + '/all.json')
-    if spo2_data_list != None:
-        for days in spo2_data_list:
-            data = days["minutes"]
-            for record in data: 
-                log_time = datetime.fromisoformat(record["minute"])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  "SPO2_Intraday",
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            "value": float(record["value"]),
-                        }
-                    })
-        logging.info("Recorded SPO2 intraday for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : SPO2 intraday for date " + start_date_str + " to " + end_date_str)
-
-    weight_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/body/log/weight/date/' + start_date_str + '/' + end_date_str + '.json').get("weight")
-    if weight_data_list != None:
-        for entry in weight_data_list:
-            log_time = datetime.fromisoformat(entry["date"] + "T" + entry["time"])
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                "measurement":  "weight",
-                "time": utc_time,
-                "tags": {
-                    "Device": DEVICENAME
-                },
-                "fields": {
-                    "value": float(entry["weight"]),
-                }
-            })
-            collected_records.append({
-                "measurement":  "bmi",
-                "time": utc_time,
-                "tags": {
-                    "Device": DEVICENAME
-                },
-                "fields": {
-                    "value": float(entry["bmi"]),
-                }
-            })
-        logging.info("Recorded weight and BMI for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : weight and BMI for date " + start_date_str + " to " + end_date_str)
-
-# Only for sleep data - limit 100 days - 1 query
-def get_daily_data_limit_100d(start_date_str, end_date_str):
-
-    sleep_data = request_data_from_fitbit('https://api.fitbit.com/1.2/user/-/sleep/date/' + start_date_str + '/' + end_date_str + '.json').get("sleep")
-    if sleep_data != None:
-        for record in sleep_data:
-            log_time = datetime.fromisoformat(record["startTime"])
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            try:
-                minutesLight= record['levels']['summary']['light']['minutes']
-                minutesREM = record['levels']['summary']['rem']['minutes']
-                minutesDeep = record['levels']['summary']['deep']['minutes']
-            except:
-                minutesLight= record['levels']['summary']['asleep']['minutes']
-                minutesREM = record['levels']['summary']['restless']['minutes']
-                minutesDeep = 0
-
-            collected_records.append({
-                    "measurement":  "Sleep Summary",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME,
-                        "isMainSleep": record["isMainSleep"],
-                    },
-                    "fields": {
-                        'efficiency': record["efficiency"],
-                        'minutesAfterWakeup': record['minutesAfterWakeup'],
-                        'minutesAsleep': record['minutesAsleep'],
-                        'minutesToFallAsleep': record['minutesToFallAsleep'],
-                        'minutesInBed': record['timeInBed'],
-                        'minutesAwake': record['minutesAwake'],
-                        'minutesLight': minutesLight,
-                        'minutesREM': minutesREM,
-                        'minutesDeep': minutesDeep
-                    }
-                })
-            
-            sleep_level_mapping = {'wake': 3, 'rem': 2, 'light': 1, 'deep': 0, 'asleep': 1, 'restless': 2, 'awake': 3, 'unknown': 4}
-            for sleep_stage in record['levels']['data']:
-                log_time = datetime.fromisoformat(sleep_stage["dateTime"])
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement":  "Sleep Levels",
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME,
-                            "isMainSleep": record["isMainSleep"],
-                        },
-                        "fields": {
-                            'level': sleep_level_mapping[sleep_stage["level"]],
-                            'duration_seconds': sleep_stage["seconds"]
-                        }
-                    })
-            wake_time = datetime.fromisoformat(record["endTime"])
-            utc_wake_time = LOCAL_TIMEZONE.localize(wake_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                        "measurement":  "Sleep Levels",
-                        "time": utc_wake_time,
-                        "tags": {
-                            "Device": DEVICENAME,
-                            "isMainSleep": record["isMainSleep"],
-                        },
-                        "fields": {
-                            'level': sleep_level_mapping['wake'],
-                            'duration_seconds': None
-                        }
-                    })
-        logging.info("Recorded Sleep data for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : Sleep data for date " + start_date_str + " to " + end_date_str)
-
-# Max date range 1 year, records HR zones, Activity minutes and Resting HR - 4 + 3 + 1 + 1 = 9 queries
-def get_daily_data_limit_365d(start_date_str, end_date_str):
-    activity_minutes_list = ["minutesSedentary", "minutesLightlyActive", "minutesFairlyActive", "minutesVeryActive"]
-    for activity_type in activity_minutes_list:
-        activity_minutes_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json').get("activities-tracker-"+activity_type)
-        if activity_minutes_data_list != None:
-            for data in activity_minutes_data_list:
-                log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                collected_records.append({
-                        "measurement": "Activity Minutes",
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            activity_type : int(data["value"])
-                        }
-                    })
-            logging.info("Recorded " + activity_type + "for date " + start_date_str + " to " + end_date_str)
-        else:
-            logging.error("Recording failed : " + activity_type + " for date " + start_date_str + " to " + end_date_str)
-        
-
-    activity_others_list = ["distance", "calories", "steps"]
-    for activity_type in activity_others_list:
-        activity_others_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json').get("activities-tracker-"+activity_type)
-        if activity_others_data_list != None:
-            for data in activity_others_data_list:
-                log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-                utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-                activity_name = "Total Steps" if activity_type == "steps" else activity_type
-                collected_records.append({
-                        "measurement": activity_name,
-                        "time": utc_time,
-                        "tags": {
-                            "Device": DEVICENAME
-                        },
-                        "fields": {
-                            "value" : float(data["value"])
-                        }
-                    })
-            logging.info("Recorded " + activity_name + " for date " + start_date_str + " to " + end_date_str)
-        else:
-            logging.error("Recording failed : " + activity_name + " for date " + start_date_str + " to " + end_date_str)
-        
-
-    HR_zones_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/heart/date/' + start_date_str + '/' + end_date_str + '.json').get("activities-heart")
-    if HR_zones_data_list != None:
-        for data in HR_zones_data_list:
-            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                    "measurement": "HR zones",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME
-                    },
-                    # Using get() method with a default value 0 to prevent keyerror ( see issue #31)
-                    "fields": {
-                        "Normal" : data["value"]["heartRateZones"][0].get("minutes", 0),
-                        "Fat Burn" :  data["value"]["heartRateZones"][1].get("minutes", 0),
-                        "Cardio" :  data["value"]["heartRateZones"][2].get("minutes", 0),
-                        "Peak" :  data["value"]["heartRateZones"][3].get("minutes", 0)
-                    }
-                })
-            if "restingHeartRate" in data["value"]:
-                collected_records.append({
-                            "measurement":  "RestingHR",
-                            "time": utc_time,
-                            "tags": {
-                                "Device": DEVICENAME
-                            },
-                            "fields": {
-                                "value": data["value"]["restingHeartRate"]
-                            }
-                        })
-        logging.info("Recorded RHR and HR zones for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : RHR and HR zones for date " + start_date_str + " to " + end_date_str)
-
-# records SPO2 single days for the whole given period - 1 query
-def get_daily_data_limit_none(start_date_str, end_date_str):
-    data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/spo2/date/' + start_date_str + '/' + end_date_str + '.json')
-    if data_list != None:
-        for data in data_list:
-            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
-            utc_time = LOCAL_TIMEZONE.localize(log_time).astimezone(pytz.utc).isoformat()
-            collected_records.append({
-                    "measurement":  "SPO2",
-                    "time": utc_time,
-                    "tags": {
-                        "Device": DEVICENAME
-                    },
-                    "fields": {
-                        "avg": data["value"]["avg"],
-                        "max": data["value"]["max"],
-                        "min": data["value"]["min"]
-                    }
-                })
-        logging.info("Recorded Avg SPO2 for date " + start_date_str + " to " + end_date_str)
-    else:
-        logging.error("Recording failed : Avg SPO2 for date " + start_date_str + " to " + end_date_str)
-
-# fetches TCX GPS data
-def get_tcx_data(tcx_url, ActivityID):
-    tcx_headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Accept": "application/x-www-form-urlencoded"
-    }
-    tcx_params = {
-            'includePartialTCX': 'false'
-        }
-    response = request_data_from_fitbit(tcx_url, headers=tcx_headers, params=tcx_params)
-    if response.status_code != 200:
-        logging.error(f"Error fetching TCX file: {response.status_code}, {response.text}")
-    else:
-        root = ET.fromstring(response.text)
-        namespace = {"ns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
-        trackpoints = root.findall(".//ns:Trackpoint", namespace)
-        prev_time = None
-        prev_distance = None
-        
-        for i, trkpt in enumerate(trackpoints):
-            time_elem = trkpt.find("ns:Time", namespace)
-            lat = trkpt.find(".//ns:LatitudeDegrees", namespace)
-            lon = trkpt.find(".//ns:LongitudeDegrees", namespace)
-            altitude = trkpt.find("ns:AltitudeMeters", namespace)
-            distance = trkpt.find("ns:DistanceMeters", namespace)
-            heart_rate = trkpt.find(".//ns:HeartRateBpm/ns:Value", namespace)
-
-            if time_elem is not None and lat is not None:
-                current_time = datetime.fromisoformat(time_elem.text.strip("Z"))
-                fields = {
-                    "lat": float(lat.text),
-                    "lon": float(lon.text)
-                }
-                if altitude is not None:
-                    fields["altitude"] = float(altitude.text)
-                if distance is not None:
-                    fields["distance"] = float(distance.text)
-                    current_distance = float(distance.text)
-                else:
-                    current_distance = None
-                if heart_rate is not None:
-                    fields["heart_rate"] = int(heart_rate.text)
-                if i > 0 and prev_time is not None and prev_distance is not None and current_distance is not None:
-                    time_diff = (current_time - prev_time).total_seconds()
-                    distance_diff = current_distance - prev_distance
-                    if time_diff > 0:
-                        speed_mps = distance_diff / time_diff
-                        speed_kph = speed_mps * 3.6
-                        fields["speed_kph"] = speed_kph
-                prev_time = current_time
-                prev_distance = current_distance
-                
-                collected_records.append({
-                        "measurement": "GPS",
-                        "tags": {
-                            "ActivityID": ActivityID
-                        },
-                        "time": datetime.fromisoformat(time_elem.text.strip("Z")).astimezone(pytz.utc).isoformat(),
-                        "fields": fields
-                    })
-
-# Fetches latest activities from record ( upto last 50 )
-def fetch_latest_activities(end_date_str):
-    next_end_date_str = (datetime.strptime(end_date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-    recent_activities_data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/list.json', params={'beforeDate': next_end_date_str, 'sort':'desc', 'limit':50, 'offset':0})
-    TCX_record_count, TCX_record_limit = 0,10
-    if recent_activities_data != None:
-        for activity in recent_activities_data['activities']:
-            fields = {}
-            if 'activeDuration' in activity:
-                fields['ActiveDuration'] = int(activity['activeDuration'])
-            if 'averageHeartRate' in activity:
-                fields['AverageHeartRate'] = int(activity['averageHeartRate'])
-            if 'calories' in activity:
-                fields['calories'] = int(activity['calories'])
-            if 'duration' in activity:
-                fields['duration'] = int(activity['duration'])
-            if 'distance' in activity:
-                fields['distance'] = float(activity['distance'])
-            if 'steps' in activity:
-                fields['steps'] = int(activity['steps'])
-            starttime = datetime.fromisoformat(activity['startTime'].strip("Z"))
-            utc_time = starttime.astimezone(pytz.utc).isoformat()
-            try:
-                extracted_activity_name = activity['activityName']
-            except KeyError as MissingKeyError:
-                extracted_activity_name = "Unknown-Activity"
-            ActivityID = utc_time + "-" + extracted_activity_name
-            collected_records.append({
-                "measurement": "Activity Records",
-                "time": utc_time,
-                "tags": {
-                    "ActivityName": extracted_activity_name
-                },
-                "fields": fields
-            })
-            if activity.get("hasGps", False):
-                tcx_link = activity.get("tcxLink", False)
-                if tcx_link and TCX_record_count <= TCX_record_limit:
-                    TCX_record_count += 1
-                    try:
-                        get_tcx_data(tcx_link, ActivityID)
-                        logging.info("Recorded TCX GPS data for " + tcx_link)
-                    except Exception as tcx_exception:
-                        logging.error("Failed to get GPS Data for " + tcx_link + " : " + str(tcx_exception))
-        logging.info("Fetched 50 recent activities before date " + end_date_str)
-    else:
-        logging.error("Fetching 50 recent activities failed : before date " + end_date_str)
-
-
-# %% [markdown]
-# ## Call the functions one time as a startup update OR do switch to bulk update mode
-
-# %%
-if AUTO_DATE_RANGE:
-    date_list = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_date - start_date).days + 1)]
-    if len(date_list) > 3:
-        logging.warn("Auto schedule update is not meant for more than 3 days at a time, please consider lowering the auto_update_date_range variable to aviod rate limit hit!")
-    for date_str in date_list:
-        get_intraday_data_limit_1d(date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')]) # 2 queries x number of dates ( default 2)
-    get_daily_data_limit_30d(start_date_str, end_date_str) # 3 queries
-    get_daily_data_limit_100d(start_date_str, end_date_str) # 1 query
-    get_daily_data_limit_365d(start_date_str, end_date_str) # 8 queries
-    get_daily_data_limit_none(start_date_str, end_date_str) # 1 query
-    get_battery_level() # 1 query
-    fetch_latest_activities(end_date_str) # 1 query
-    write_points_to_influxdb(collected_records)
-    collected_records = []
-else:
-    # Do Bulk update----------------------------------------------------------------------------------------------------------------------------
-
-    schedule.every(1).hours.do(lambda : Get_New_Access_Token(client_id,client_secret)) # Auto-refresh tokens every 1 hour
-    
-    date_list = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_date - start_date).days + 1)]
-
-    def yield_dates_with_gap(date_list, gap):
-        start_index = -1*gap
-        while start_index < len(date_list)-1:
-            start_index  = start_index + gap
-            end_index = start_index+gap
-            if end_index > len(date_list) - 1:
-                end_index = len(date_list) - 1
-            if start_index > len(date_list) - 1:
-                break
-            yield (date_list[start_index],date_list[end_index])
-
-    def do_bulk_update(funcname, start_date, end_date):
-        global collected_records
-        funcname(start_date, end_date)
-        schedule.run_pending()
-        write_points_to_influxdb(collected_records)
-        collected_records = []
-
-    fetch_latest_activities(date_list[-1])
-    write_points_to_influxdb(collected_records)
-    do_bulk_update(get_daily_data_limit_none, date_list[0], date_list[-1])
-    for date_range in yield_dates_with_gap(date_list, 360):
-        do_bulk_update(get_daily_data_limit_365d, date_range[0], date_range[1])
-    for date_range in yield_dates_with_gap(date_list, 98):
-        do_bulk_update(get_daily_data_limit_100d, date_range[0], date_range[1])
-    for date_range in yield_dates_with_gap(date_list, 28):
-        do_bulk_update(get_daily_data_limit_30d, date_range[0], date_range[1])
-    for single_day in date_list:
-        do_bulk_update(get_intraday_data_limit_1d, single_day, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')])
-
-    logging.info("Success : Bulk update complete for " + start_date_str + " to " + end_date_str)
-    print("Bulk update complete!")
-
-# %% [markdown]
-# ## Schedule functions at specific intervals (Ongoing continuous update)
-
-# %%
-# Ongoing continuous update of data
-if SCHEDULE_AUTO_UPDATE:
-    
-    schedule.every(1).hours.do(lambda : Get_New_Access_Token(client_id,client_secret)) # Auto-refresh tokens every 1 hour
-    schedule.every(3).minutes.do( lambda : get_intraday_data_limit_1d(end_date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')] )) # Auto-refresh detailed HR and steps
-    schedule.every(1).hours.do( lambda : get_intraday_data_limit_1d((datetime.strptime(end_date_str, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d"), [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')] )) # Refilling any missing data on previous day end of night due to fitbit sync delay ( see issue #10 )
-    schedule.every(20).minutes.do(get_battery_level) # Auto-refresh battery level
-    schedule.every(3).hours.do(lambda : get_daily_data_limit_30d(start_date_str, end_date_str))
-    schedule.every(4).hours.do(lambda : get_daily_data_limit_100d(start_date_str, end_date_str))
-    schedule.every(6).hours.do( lambda : get_daily_data_limit_365d(start_date_str, end_date_str))
-    schedule.every(6).hours.do(lambda : get_daily_data_limit_none(start_date_str, end_date_str))
-    schedule.every(1).hours.do( lambda : fetch_latest_activities(end_date_str))
-
-    while True:
-        schedule.run_pending()
-        if len(collected_records) != 0:
-            write_points_to_influxdb(collected_records)
-            collected_records = []
-        time.sleep(30)
-        update_working_dates()
-        
-
-
+# %%
+import base64, requests, time, json, pytz, logging, os, sys, threading, sqlite3, queue, functools, random, hashlib, re, gzip, tempfile, itertools, bisect, collections, heapq, hmac, contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+from requests.adapters import HTTPAdapter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timedelta
+# The InfluxDB client of the selected version is imported by connect_influxdb() ( the 3.x client loads pyarrow, which is slow and large )
+# For XML processing
+import xml.etree.ElementTree as ET
+import urllib.parse
+import email.utils
+
+# %% [markdown]
+# ## Variables
+
+# %%
+FITBIT_LOG_FILE_PATH = os.environ.get("FITBIT_LOG_FILE_PATH") or "your/expected/log/file/location/path"
+TOKEN_FILE_PATH = os.environ.get("TOKEN_FILE_PATH") or "your/expected/token/file/location/path"
+OVERWRITE_LOG_FILE = True
+FITBIT_LANGUAGE = 'en_US'
+INFLUXDB_VERSION = os.environ.get("INFLUXDB_VERSION") or "1" # Version of influxdb in use, supported values are 1 or 2
+assert INFLUXDB_VERSION in ['1','2','3'], "Only InfluxDB version 1 or 2 or 3 is allowed - please put either 1 or 2 or 3"
+# Update these variables for influxdb 1.x versions
+INFLUXDB_HOST = os.environ.get("INFLUXDB_HOST") or 'localhost' # for influxdb 1.x
+INFLUXDB_PORT = os.environ.get("INFLUXDB_PORT") or 8086 # for influxdb 1.x 
+INFLUXDB_USERNAME = os.environ.get("INFLUXDB_USERNAME") or 'your_influxdb_username' # for influxdb 1.x
+INFLUXDB_PASSWORD = os.environ.get("INFLUXDB_PASSWORD") or 'your_influxdb_password' # for influxdb 1.x
+INFLUXDB_DATABASE = os.environ.get("INFLUXDB_DATABASE") or 'your_influxdb_database_name' # for influxdb 1.x
+# Update these variables for influxdb 2.x versions
+INFLUXDB_BUCKET = os.environ.get("INFLUXDB_BUCKET") or "your_bucket_name_here" # for influxdb 2.x
+INFLUXDB_ORG = os.environ.get("INFLUXDB_ORG") or "your_org_here" # for influxdb 2.x
+INFLUXDB_TOKEN = os.environ.get("INFLUXDB_TOKEN") or "your_token_here" # for influxdb 2.x
+INFLUXDB_URL = os.environ.get("INFLUXDB_URL") or "http://your_url_here:8086" # for influxdb 2.x
+INFLUXDB_V3_ACCESS_TOKEN = os.getenv("INFLUXDB_V3_ACCESS_TOKEN",'') # InfluxDB V3 Access token, required only for InfluxDB 3.x
+# MAKE SURE you set the application type to PERSONAL. Otherwise, you won't have access to intraday data series, resulting in 40X errors.
+client_id = os.environ.get("CLIENT_ID") or "your_application_client_ID" # Change this to your client ID
+client_secret = os.environ.get("CLIENT_SECRET") or "your_application_client_secret" # Change this to your client Secret
+DEVICENAME = os.environ.get("DEVICENAME") or "Your_Device_Name" # e.g. "Charge5"
+MANUAL_START_DATE = os.getenv("MANUAL_START_DATE", None) # optional, in YYYY-MM-DD format, if you want to bulk update only from specific date
+MANUAL_END_DATE = os.getenv("MANUAL_END_DATE", datetime.today().strftime('%Y-%m-%d')) # optional, in YYYY-MM-DD format, if you want to bulk update until a specific date
+AUTO_DATE_RANGE = False if os.environ.get("AUTO_DATE_RANGE") in ['False','false','FALSE','f','F','no','No','NO','0'] else (not bool(MANUAL_START_DATE)) # Automatically selects date range from todays date and update_date_range variable
+auto_update_date_range = 1 # Days to go back from today for AUTO_DATE_RANGE *** Going above 2 makes the updates wait for the hourly rate limit reset ***
+LOCAL_TIMEZONE = os.environ.get("LOCAL_TIMEZONE") or "Automatic" # set to "Automatic" for Automatic setup from User profile (if not mentioned here specifically).
+SCHEDULE_AUTO_UPDATE = False if os.environ.get("SCHEDULE_AUTO_UPDATE") in ['False','false','FALSE','f','F','no','No','NO','0'] else AUTO_DATE_RANGE # Scheduling updates of data when script runs, set to False to exit after the startup update
+SERVER_ERROR_MAX_RETRY = 3
+EXPIRED_TOKEN_MAX_RETRY = 5
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN") or 300) # Seconds before the access token expires when it is refreshed, the token is only refreshed when it is about to expire or rejected
+SKIP_REQUEST_ON_SERVER_ERROR = True
+CONNECTION_ERROR_MAX_RETRY = int(os.environ.get("CONNECTION_ERROR_MAX_RETRY") or 8) # A request is skipped after this many connection errors in a row
+FITBIT_REQUEST_TIMEOUT = float(os.environ.get("FITBIT_REQUEST_TIMEOUT") or 60) # Seconds a Fitbit request waits for the connection or for the next data from the server before it is retried like a connection error
+FITBIT_RETRY_BASE_DELAY = float(os.environ.get("FITBIT_RETRY_BASE_DELAY") or 5) # Base delay in seconds for the retries of failed Fitbit requests ( doubles with every attempt, with jitter )
+FITBIT_RETRY_MAX_DELAY = float(os.environ.get("FITBIT_RETRY_MAX_DELAY") or 300) # Cap of the exponential retry delay ( before the jitter ), a longer Retry-After header of the server is still honored
+CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get("CIRCUIT_BREAKER_THRESHOLD") or 5) # Failed attempts in a row ( server or connection errors ) after which requests to an endpoint are skipped, 0 to disable
+CIRCUIT_BREAKER_COOLDOWN = int(os.environ.get("CIRCUIT_BREAKER_COOLDOWN") or 600) # Seconds an endpoint is skipped before a single trial request is let through
+BULK_RETRY_ROUNDS = int(os.environ.get("BULK_RETRY_ROUNDS") or 2) # Bulk update units with skipped requests are run again up to this many times once the rest of the plan is done
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS") or 4) # Number of distinct hosts to keep connection pools for
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE") or 10) # Max number of keep-alive connections reused per host
+RATE_LIMIT_CALLS_PER_HOUR = int(os.environ.get("RATE_LIMIT_CALLS_PER_HOUR") or 150) # Fitbit allows 150 API calls per hour per user
+RATE_LIMIT_RESERVED_CALLS = int(os.environ.get("RATE_LIMIT_RESERVED_CALLS") or 0) # Calls left unused every hour ( e.g. if other apps use the same Fitbit account )
+RATE_LIMIT_RESET_BUFFER = int(os.environ.get("RATE_LIMIT_RESET_BUFFER") or 15) # Extra seconds to wait after the reported rate limit reset time
+STATE_DB_FILE_PATH = os.environ.get("STATE_DB_FILE_PATH") or os.path.join(os.path.dirname(TOKEN_FILE_PATH), "fitbit_state.db") # SQLite file for local state ( bulk update progress journal etc. ), stored next to the token file by default
+FETCH_MAX_WORKERS = int(os.environ.get("FETCH_MAX_WORKERS") or 4) # Max number of Fitbit API requests running in parallel, set to 1 to fetch sequentially
+INFLUXDB_WRITE_BATCH_SIZE = int(os.environ.get("INFLUXDB_WRITE_BATCH_SIZE") or 5000) # Max number of points sent to the database in one write request
+INFLUXDB_FLUSH_INTERVAL = int(os.environ.get("INFLUXDB_FLUSH_INTERVAL") or 10) # Max seconds a fetched point waits in the buffer before being written
+INFLUXDB_MAX_BUFFERED_POINTS = int(os.environ.get("INFLUXDB_MAX_BUFFERED_POINTS") or 20000) # Fetching pauses when this many points are waiting to be written
+INFLUXDB_ASYNC_WRITE = True if os.environ.get("INFLUXDB_ASYNC_WRITE") in ['True','true','TRUE','t','T','yes','Yes','YES','1'] else False # Write the batches from a dedicated background thread, so fetching never waits for a database round-trip
+INFLUXDB_WRITE_MAX_RETRY = int(os.environ.get("INFLUXDB_WRITE_MAX_RETRY") or 4) # Retries with exponential backoff and jitter before a failed batch is spooled to disk
+INFLUXDB_WRITE_RETRY_DELAY = float(os.environ.get("INFLUXDB_WRITE_RETRY_DELAY") or 2) # Base delay in seconds for the write retries ( doubles with every attempt, capped at 60 seconds )
+INFLUXDB_SPOOL_DIR = os.environ.get("INFLUXDB_SPOOL_DIR") or os.path.join(os.path.dirname(TOKEN_FILE_PATH), "influxdb_spool") # Batches the database could not accept are stored here as line protocol and replayed once it recovers
+INFLUXDB_SPOOL_REPLAY_INTERVAL = int(os.environ.get("INFLUXDB_SPOOL_REPLAY_INTERVAL") or 60) # Minimum seconds between two attempts to replay the spooled batches
+BULK_RESUME = False if os.environ.get("BULK_RESUME") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # Skip the bulk update units completed in a previous ( interrupted ) run
+INTRADAY_INCREMENTAL = False if os.environ.get("INTRADAY_INCREMENTAL") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # The live 3 minute update requests only the intraday data after the last stored point instead of the whole day
+INTRADAY_OVERLAP_MINUTES = int(os.environ.get("INTRADAY_OVERLAP_MINUTES") or 5) # Minutes before the last stored point that are requested again by the incremental update
+INTRADAY_ROLLUPS = False if os.environ.get("INTRADAY_ROLLUPS") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # Also write per minute and per hour min / max / mean / count ( or sum ) rollups of the intraday data to the *_1m and *_1h measurements
+RESPONSE_CACHE = False if os.environ.get("RESPONSE_CACHE") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # Skip requests, parsing and writes for data that has not changed since it was last fetched
+RESPONSE_CACHE_RECENT_TTL = int(os.environ.get("RESPONSE_CACHE_RECENT_TTL") or 60) # Seconds a response for recent days is reused before it is requested again ( and compared with the stored hash )
+RESPONSE_CACHE_PAST_TTL = int(os.environ.get("RESPONSE_CACHE_PAST_TTL") or 30*24*3600) # Seconds a response for past days is reused, these are practically immutable
+RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS = int(os.environ.get("RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS") or 3) # Days after which Fitbit data is considered final ( late syncs and corrections happen before )
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES") or 20000) # Least recently used entries are evicted above this size
+TCX_ARCHIVE_DIR = os.environ.get("TCX_ARCHIVE_DIR") or os.path.join(os.path.dirname(TOKEN_FILE_PATH), "tcx_archive") # Downloaded GPS activity files are archived here, activities already ingested are not downloaded again
+TCX_DOWNLOAD_LIMIT = int(os.environ.get("TCX_DOWNLOAD_LIMIT") or 10) # Maximum number of new GPS activity files downloaded by one ( hourly ) update of the latest activities, bulk updates download all of them
+BULK_DRY_RUN = True if os.environ.get("BULK_DRY_RUN") in ['True','true','TRUE','t','T','yes','Yes','YES','1'] else False # Print the bulk update plan with its API call cost and estimated completion time, then exit without fetching
+BULK_SKIP_EMPTY_DAYS = False if os.environ.get("BULK_SKIP_EMPTY_DAYS") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # Probe the daily step counts first and skip the intraday requests for days without any tracker data
+BULK_PROGRESS_INTERVAL = int(os.environ.get("BULK_PROGRESS_INTERVAL") or 60) # Seconds between two bulk update progress reports ( done units per phase and estimated completion time ) in the log
+FITBIT_ACCOUNTS_FILE = os.environ.get("FITBIT_ACCOUNTS_FILE") # optional JSON file listing several Fitbit accounts to collect in this one process ( see load_fitbit_accounts )
+ACCOUNT_MAX_WORKERS = int(os.environ.get("ACCOUNT_MAX_WORKERS") or 4) # Max number of accounts updated at the same time, each account runs its scheduled jobs one at a time ( the live intraday update aside )
+SCHEDULER_MAX_JITTER = float(os.environ.get("SCHEDULER_MAX_JITTER") or 10) # Scheduled jobs start up to this many seconds ( at most a tenth of their interval ) after their due time, chosen at random, so several accounts do not all call the API at the same moment
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 0) # Serve Prometheus metrics on this port at /metrics, 0 to disable
+METRICS_WRITE_INTERVAL = int(os.environ.get("METRICS_WRITE_INTERVAL") or 0) # Seconds between writes of the metrics to the FitbitFetchMetrics measurement, 0 to disable
+SUBSCRIBER_PORT = int(os.environ.get("SUBSCRIBER_PORT") or 0) # Receive Fitbit subscription notifications on this port and fetch only the changed data, 0 to disable ( polling only )
+SUBSCRIBER_VERIFICATION_CODE = os.environ.get("SUBSCRIBER_VERIFICATION_CODE") or "" # Verification code of the subscriber endpoint, from the Fitbit application settings
+SUBSCRIBER_ID = os.environ.get("SUBSCRIBER_ID") # optional, subscriber ID from the Fitbit application settings when the application has several subscriber endpoints
+SUBSCRIBER_POLL_INTERVAL_FACTOR = int(os.environ.get("SUBSCRIBER_POLL_INTERVAL_FACTOR") or 6) # With notifications, the polling of the data they cover only runs this many times less often, as a fallback for missed notifications
+FITBIT_API_BASE_URL = os.environ.get("FITBIT_API_BASE_URL") # optional, requests to https://api.fitbit.com are sent to this URL instead ( e.g. the stand-in server of extra/benchmark.py )
+INFLUXDB_WRITE_DEDUP = False if os.environ.get("INFLUXDB_WRITE_DEDUP") in ['False','false','FALSE','f','F','no','No','NO','0'] else True # Only write points that are new or changed since they were last written, the daily summaries are fetched again many times a day
+INFLUXDB_WRITE_DEDUP_MAX_ENTRIES = int(os.environ.get("INFLUXDB_WRITE_DEDUP_MAX_ENTRIES") or 100000) # Max number of written points remembered, least recently written ones are forgotten first
+INFLUXDB_WRITE_DEDUP_DB_FILE_PATH = os.environ.get("INFLUXDB_WRITE_DEDUP_DB_FILE_PATH") or os.path.join(os.path.dirname(TOKEN_FILE_PATH), "fitbit_write_index.db") # SQLite file of the written point fingerprints, shared by all accounts
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR") # optional, every fetched point is also stored in Parquet files under this directory, partitioned by measurement and date
+ARCHIVE_FLUSH_INTERVAL = int(os.environ.get("ARCHIVE_FLUSH_INTERVAL") or 600) # Max seconds fetched points are buffered before they are written to the archive
+ARCHIVE_MAX_BUFFERED_POINTS = int(os.environ.get("ARCHIVE_MAX_BUFFERED_POINTS") or 100000) # The archive buffer is written when it holds this many points
+ARCHIVE_COMPACT_FILES = int(os.environ.get("ARCHIVE_COMPACT_FILES") or 24) # The files of an archive partition ( measurement and date ) are merged into one when there are more
+ARCHIVE_COMPRESSION = os.environ.get("ARCHIVE_COMPRESSION") or "zstd" # Parquet compression codec of the archive files ( zstd, snappy, gzip or none )
+ARCHIVE_REINGEST = True if os.environ.get("ARCHIVE_REINGEST") in ['True','true','TRUE','t','T','yes','Yes','YES','1'] else False # Write the archived points of MANUAL_START_DATE to MANUAL_END_DATE to InfluxDB and exit, without any Fitbit API call
+
+# %% [markdown]
+# ## Compact data points and line protocol encoding
+
+# %%
+# Lightweight alternative to the nested point dicts, used for the high volume intraday measurements. Timestamps are integer
+# UTC epoch seconds and tags are a shared tuple of ( key, value ) pairs, so a point costs one small object and one fields dict
+class FitbitPoint:
+    __slots__ = ("measurement", "tags", "fields", "timestamp")
+
+    def __init__(self, measurement, tags, fields, timestamp):
+        self.measurement = measurement
+        self.tags = tags
+        self.fields = fields
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_dict(cls, point):
+        return cls(point["measurement"], tuple(sorted((point.get("tags") or {}).items())), point["fields"], int(datetime.fromisoformat(point["time"]).timestamp()))
+
+    def to_dict(self):
+        return {"measurement": self.measurement, "time": datetime.fromtimestamp(self.timestamp, pytz.utc).isoformat(), "tags": dict(self.tags), "fields": self.fields}
+
+# Accepts FitbitPoint objects as well as the regular point dicts
+def as_fitbit_point(point):
+    return point if isinstance(point, FitbitPoint) else FitbitPoint.from_dict(point)
+
+def escape_line_protocol_key(key):
+    return str(key).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace("\n", "\\n")
+
+# Measurement and tag part of a line, cached as the same few series repeat for every point
+@functools.lru_cache(maxsize=4096)
+def encode_line_protocol_series(measurement, tags):
+    line = escape_line_protocol_key(measurement)
+    for key, value in tags:
+        if key != "" and value is not None and value != "":
+            line += "," + escape_line_protocol_key(key) + "=" + escape_line_protocol_key(value)
+    return line
+
+# Same field value formatting as the influxdb 1.x client
+def encode_line_protocol_field_value(value):
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, int):
+        return str(value) + "i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+def encode_line_protocol_fields(fields):
+    return ",".join(escape_line_protocol_key(key) + "=" + encode_line_protocol_field_value(value) for key, value in sorted(fields.items()) if value is not None)
+
+# Encodes a point to an InfluxDB line protocol line with precision "s", returns None for points without any field value
+def encode_line_protocol(point):
+    point = as_fitbit_point(point)
+    fields = encode_line_protocol_fields(point.fields)
+    if not fields:
+        return None
+    return encode_line_protocol_series(point.measurement, point.tags) + " " + fields + " " + str(point.timestamp)
+
+# %% [markdown]
+# ## Batched timezone conversion
+
+# %%
+# UTC epoch of local midnight ( as if it were UTC ) and the UTC offsets of the day. Offsets are listed per minute only for days with a DST
+# transition, as transitions always happen on a minute boundary. Uses localize() so the result matches the per sample conversion exactly
+@functools.lru_cache(maxsize=64)
+def get_local_day_offsets(date_str, timezone):
+    day_start = datetime.fromisoformat(date_str)
+    day_start_epoch = int(day_start.replace(tzinfo=pytz.utc).timestamp())
+    first_offset = int(timezone.localize(day_start).utcoffset().total_seconds())
+    last_offset = int(timezone.localize(day_start + timedelta(hours=23, minutes=59)).utcoffset().total_seconds())
+    if first_offset == last_offset:
+        return day_start_epoch, first_offset, None
+    minute_offsets = [int(timezone.localize(day_start + timedelta(minutes=minute)).utcoffset().total_seconds()) for minute in range(1440)]
+    return day_start_epoch, None, minute_offsets
+
+# Converts the "HH:MM:SS" local times of one day to UTC epoch seconds in one pass
+def local_times_to_epoch(date_str, time_strings, timezone):
+    day_start_epoch, offset, minute_offsets = get_local_day_offsets(date_str, timezone)
+    if minute_offsets is None:
+        base = day_start_epoch - offset
+        return [base + int(time_str[0:2]) * 3600 + int(time_str[3:5]) * 60 + int(time_str[6:8]) for time_str in time_strings]
+    epochs = []
+    for time_str in time_strings:
+        seconds = int(time_str[0:2]) * 3600 + int(time_str[3:5]) * 60 + int(time_str[6:8])
+        epochs.append(day_start_epoch + seconds - minute_offsets[seconds // 60])
+    return epochs
+
+# Converts "YYYY-MM-DDTHH:MM:SS" local date times ( possibly spanning several days ) to UTC epoch seconds
+def local_datetimes_to_epoch(datetime_strings, timezone):
+    epochs = []
+    for datetime_str in datetime_strings:
+        day_start_epoch, offset, minute_offsets = get_local_day_offsets(datetime_str[0:10], timezone)
+        seconds = int(datetime_str[11:13]) * 3600 + int(datetime_str[14:16]) * 60 + int(datetime_str[17:19])
+        epochs.append(day_start_epoch + seconds - (offset if minute_offsets is None else minute_offsets[seconds // 60]))
+    return epochs
+
+# %% [markdown]
+# ## Streaming TCX parser
+
+# %%
+TCX_NAMESPACE = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+
+# Parses a TCX file ( path or file object, e.g. a streamed response body ) incrementally and yields one GPS point per Trackpoint with a position.
+# Every Trackpoint is removed from the tree once parsed, so memory stays constant for multi-hour activities
+def parse_tcx_trackpoints(source, ActivityID):
+    tags = (("ActivityID", ActivityID),)
+    prev_time = None
+    prev_distance = None
+    track = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if elem.tag == TCX_NAMESPACE + "Track":
+                track = elem
+            continue
+        if elem.tag != TCX_NAMESPACE + "Trackpoint":
+            continue
+        values = {}
+        for child in elem:
+            if child.tag == TCX_NAMESPACE + "Position":
+                for position in child:
+                    values[position.tag] = position.text
+            elif child.tag == TCX_NAMESPACE + "HeartRateBpm":
+                values[child.tag] = child.findtext(TCX_NAMESPACE + "Value")
+            else:
+                values[child.tag] = child.text
+        if track is not None:
+            track.remove(elem)
+        time_text = values.get(TCX_NAMESPACE + "Time")
+        lat = values.get(TCX_NAMESPACE + "LatitudeDegrees")
+        if time_text is None or lat is None:
+            continue
+        current_time = datetime.fromisoformat(time_text.strip("Z")).timestamp()
+        fields = {
+            "lat": float(lat),
+            "lon": float(values[TCX_NAMESPACE + "LongitudeDegrees"])
+        }
+        if values.get(TCX_NAMESPACE + "AltitudeMeters") is not None:
+            fields["altitude"] = float(values[TCX_NAMESPACE + "AltitudeMeters"])
+        current_distance = None
+        if values.get(TCX_NAMESPACE + "DistanceMeters") is not None:
+            current_distance = fields["distance"] = float(values[TCX_NAMESPACE + "DistanceMeters"])
+        if values.get(TCX_NAMESPACE + "HeartRateBpm") is not None:
+            fields["heart_rate"] = int(values[TCX_NAMESPACE + "HeartRateBpm"])
+        if prev_time is not None and prev_distance is not None and current_distance is not None:
+            time_diff = current_time - prev_time
+            if time_diff > 0:
+                fields["speed_kph"] = (current_distance - prev_distance) / time_diff * 3.6
+        prev_time = current_time
+        prev_distance = current_distance
+        yield FitbitPoint("GPS", tags, fields, int(current_time))
+
+# %% [markdown]
+# ## Logging setup
+
+# %%
+def setup_logging():
+    if OVERWRITE_LOG_FILE:
+        with open(FITBIT_LOG_FILE_PATH, "w"): pass
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(FITBIT_LOG_FILE_PATH, mode='a'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+# %% [markdown]
+# ## Metrics
+
+# %%
+# Counters, gauges and histograms of the hot paths ( Fitbit requests, fetchers, InfluxDB writes, scheduler ), keyed by metric name and a tuple of
+# ( label, value ) pairs. Exposed in the Prometheus text format on METRICS_PORT and / or written to the FitbitFetchMetrics measurement every
+# METRICS_WRITE_INTERVAL seconds. Nothing is collected when both are disabled
+METRICS_ENABLED = METRICS_PORT > 0 or METRICS_WRITE_INTERVAL > 0
+METRIC_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+METRIC_POINTS_BUCKETS = (1, 10, 100, 500, 1000, 2500, 5000, 10000, 25000)
+metric_descriptions = {
+    "fitbit_request_duration_seconds": ("histogram", "Duration of Fitbit API HTTP requests ( each attempt ), by endpoint", METRIC_SECONDS_BUCKETS),
+    "fitbit_responses_total": ("counter", "Fitbit API responses by endpoint and status code ( connection_error if no response )", None),
+    "fitbit_rate_limit_wait_seconds": ("histogram", "Time requests waited for the hourly rate limit budget, by account", METRIC_SECONDS_BUCKETS),
+    "fitbit_rate_limit_remaining": ("gauge", "Fitbit-Rate-Limit-Remaining header of the last response, by account", None),
+    "fitbit_request_retries_total": ("counter", "Retried Fitbit API requests, by endpoint and reason ( server_error, connection_error, unauthorized )", None),
+    "fitbit_circuit_breaker_opened_total": ("counter", "Times the circuit breaker of an endpoint opened, by endpoint", None),
+    "fitbit_circuit_breaker_rejected_total": ("counter", "Fitbit API requests skipped because the circuit breaker of their endpoint was open, by endpoint", None),
+    "fitbit_response_cache_total": ("counter", "Response cache lookups by result ( hit, unchanged, changed )", None),
+    "fitbit_fetcher_points_total": ("counter", "Points produced by each fetch function", None),
+    "fitbit_fetcher_parse_seconds": ("histogram", "Time a fetch function spent outside of its Fitbit requests ( parsing the responses and building the points )", METRIC_SECONDS_BUCKETS),
+    "influxdb_encode_seconds": ("histogram", "Time to encode a batch to line protocol", METRIC_SECONDS_BUCKETS),
+    "influxdb_write_duration_seconds": ("histogram", "Duration of successful InfluxDB write requests", METRIC_SECONDS_BUCKETS),
+    "influxdb_write_batch_points": ("histogram", "Number of points in the batches written to InfluxDB", METRIC_POINTS_BUCKETS),
+    "influxdb_write_errors_total": ("counter", "Failed InfluxDB write attempts, by retryable", None),
+    "influxdb_spooled_points_total": ("counter", "Points spooled to disk after all write retries failed", None),
+    "influxdb_write_suppressed_points_total": ("counter", "Points not written because the same values were already written, by measurement", None),
+    "archive_written_points_total": ("counter", "Points written to the Parquet archive files", None),
+    "point_writer_backpressure_seconds": ("histogram", "Time fetchers waited for the point writer buffer to drain", METRIC_SECONDS_BUCKETS),
+    "scheduler_lag_seconds": ("histogram", "Delay between the due time of a scheduled job and the moment it was dispatched, by job", METRIC_SECONDS_BUCKETS),
+    "scheduler_skipped_runs_total": ("counter", "Scheduled job runs skipped, by job and reason ( missed while the scheduler was busy, or overlap with the previous run still queued or running )", None),
+    "scheduler_job_duration_seconds": ("histogram", "Duration of the scheduled jobs, by job", METRIC_SECONDS_BUCKETS),
+    "fitbit_notifications_total": ("counter", "Fitbit subscription notifications received, by collection and result ( queued, duplicate, invalid, unknown_subscription )", None),
+    "account_job_queue_seconds": ("histogram", "Time scheduled jobs waited in the job queue of their account", METRIC_SECONDS_BUCKETS),
+    "bulk_remaining_units": ("gauge", "Bulk update units left to run, by account and phase ( fetch function )", None),
+    "bulk_retry_units_total": ("counter", "Bulk update units with skipped requests, by account and result ( queued for a retry round, completed by a retry, given up )", None),
+    "bulk_estimated_remaining_seconds": ("gauge", "Estimated seconds until the bulk update of an account is complete", None),
+}
+
+class MetricsRegistry:
+    def __init__(self, descriptions, enabled=True):
+        self.descriptions = descriptions
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {} # ( name, labels ) -> [ per bucket counts ( last one is +Inf ), sum, count ]
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def set(self, name, labels, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        if not self.enabled:
+            return
+        buckets = self.descriptions[name][2]
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters), dict(self.gauges), {key: (list(histogram[0]), histogram[1], histogram[2]) for key, histogram in self.histograms.items()}
+
+    def render_prometheus(self):
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+        for name, (metric_type, help_text, buckets) in self.descriptions.items():
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            if metric_type == "histogram":
+                for (series_name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative_count = 0
+                    for bound, bucket_count in zip(buckets + ("+Inf",), bucket_counts):
+                        cumulative_count += bucket_count
+                        lines.append(name + "_bucket" + format_metric_labels(labels + (("le", str(bound)),)) + " " + str(cumulative_count))
+                    lines.append(name + "_sum" + format_metric_labels(labels) + " " + repr(total))
+                    lines.append(name + "_count" + format_metric_labels(labels) + " " + str(count))
+            else:
+                for (series_name, labels), value in sorted((counters if metric_type == "counter" else gauges).items()):
+                    if series_name == name:
+                        lines.append(name + format_metric_labels(labels) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    # One point per series, histograms are written as their count and sum
+    def to_points(self, timestamp):
+        counters, gauges, histograms = self.snapshot()
+        points = [FitbitPoint("FitbitFetchMetrics", tuple(sorted(labels + (("metric", name),))), {"value": float(value)}, timestamp) for (name, labels), value in itertools.chain(counters.items(), gauges.items())]
+        points += [FitbitPoint("FitbitFetchMetrics", tuple(sorted(labels + (("metric", name),))), {"count": count, "sum": float(total)}, timestamp) for (name, labels), (bucket_counts, total, count) in histograms.items()]
+        return points
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for key, value in labels) + "}"
+
+metrics = MetricsRegistry(metric_descriptions, enabled=METRICS_ENABLED)
+
+# Dates, times and activity log ids are replaced, so each Fitbit API endpoint is one series
+metric_endpoint_patterns = [(re.compile(r"^\w+://[^/]+"), ""), (re.compile(r"\d{4}-\d{2}-\d{2}"), "{date}"), (re.compile(r"\d{2}:\d{2}"), "{time}"), (re.compile(r"/\d+\.tcx$"), "/{log_id}.tcx")]
+
+def metric_endpoint_name(url):
+    for pattern, replacement in metric_endpoint_patterns:
+        url = pattern.sub(replacement, url)
+    return url
+
+# Seconds the current thread spent in request_data_from_fitbit, so the fetchers can tell their own time apart from the requests
+metrics_thread_state = threading.local()
+
+def add_thread_request_seconds(seconds):
+    metrics_thread_state.request_seconds = get_thread_request_seconds() + seconds
+
+def get_thread_request_seconds():
+    return getattr(metrics_thread_state, "request_seconds", 0.0)
+
+# Counts the points of a fetch function and the time it spends parsing ( only while it runs, not while the consumer handles its points )
+def instrument_fetcher(funcname):
+    if not METRICS_ENABLED:
+        return funcname
+    fetcher_labels = (("fetcher", funcname.__name__),)
+
+    @functools.wraps(funcname)
+    def instrumented_fetcher(*args, **kwargs):
+        point_count, busy_seconds, request_seconds_before = 0, 0.0, get_thread_request_seconds()
+        points = funcname(*args, **kwargs)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    point = next(points)
+                except StopIteration:
+                    return
+                finally:
+                    busy_seconds += time.perf_counter() - started
+                point_count += 1
+                yield point
+        finally:
+            points.close()
+            metrics.inc("fitbit_fetcher_points_total", fetcher_labels, point_count)
+            metrics.observe("fitbit_fetcher_parse_seconds", fetcher_labels, max(busy_seconds - (get_thread_request_seconds() - request_seconds_before), 0.0))
+    return instrumented_fetcher
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics endpoint : " + format % args)
+
+def write_metrics_to_influxdb():
+    if not write_points_to_influxdb(metrics.to_points(int(time.time()))):
+        logging.warning("Writing the FitbitFetchMetrics measurement failed")
+
+def start_metrics_export():
+    if METRICS_PORT > 0:
+        metrics_server = ThreadingHTTPServer(("", METRICS_PORT), MetricsRequestHandler)
+        metrics_server.daemon_threads = True
+        threading.Thread(target=metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+        logging.info("Serving Prometheus metrics on port " + str(METRICS_PORT) + " at /metrics")
+    if METRICS_WRITE_INTERVAL > 0:
+        job_scheduler.every(METRICS_WRITE_INTERVAL, write_metrics_to_influxdb, priority=JOB_PRIORITY_HIGH)
+
+# %% [markdown]
+# ## Local state storage
+
+# %%
+# Small SQLite wrapper shared by all features that need to persist state across restarts. Connection is opened on first use and shared between threads
+class StateStore:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+        return self.connection
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    def executemany(self, sql, parameter_list):
+        with self.lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            try:
+                connection.executemany(sql, parameter_list)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+# %% [markdown]
+# ## Shared HTTP session (connection pooling and keep-alive)
+
+# %%
+# All Fitbit API calls go through this session, so TCP+TLS connections to api.fitbit.com are reused across requests instead of being opened for every call
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE))
+http_session.mount("http://", HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE))
+http_session.headers.update({
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive"
+})
+
+# Redirects the Fitbit API requests to FITBIT_API_BASE_URL, the URLs used by the fetch functions ( and cached or journaled ) stay the same
+class FitbitBaseUrlAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        request.url = FITBIT_API_BASE_URL.rstrip("/") + request.url[len("https://api.fitbit.com"):]
+        return super().send(request, **kwargs)
+
+if FITBIT_API_BASE_URL:
+    http_session.mount("https://api.fitbit.com", FitbitBaseUrlAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE))
+
+# Returns number of new vs reused connections made by the shared session ( based on urllib3 pool counters )
+def get_http_connection_stats():
+    new_connections, total_requests = 0, 0
+    for adapter in http_session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                new_connections += pool.num_connections
+                total_requests += pool.num_requests
+    return {"requests": total_requests, "new_connections": new_connections, "reused_connections": total_requests - new_connections}
+
+def log_http_connection_stats():
+    stats = get_http_connection_stats()
+    logging.info("HTTP session stats : " + str(stats["requests"]) + " requests, " + str(stats["new_connections"]) + " new connections, " + str(stats["reused_connections"]) + " reused connections")
+
+# %% [markdown]
+# ## Rate limit budget management
+
+# %%
+# Token bucket for the hourly Fitbit API budget. The bucket is synced with the Fitbit-Rate-Limit-Remaining and Fitbit-Rate-Limit-Reset headers of
+# every response, so requests are paused right before the budget runs out ( until the hourly reset ) instead of hitting a 429 error first
+class RateLimitBudget:
+    def __init__(self, calls_per_hour, reserved_calls=0, reset_buffer=0):
+        self.capacity = calls_per_hour
+        self.reserved_calls = reserved_calls
+        self.reset_buffer = reset_buffer
+        self.refill_rate = calls_per_hour / 3600.0 # only used until the first response headers are seen
+        self.tokens = float(calls_per_hour)
+        self.in_flight = 0
+        self.reset_at = None # time.monotonic() value at which the server side budget resets
+        self.last_update = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.reset_at is not None:
+            if now >= self.reset_at:
+                self.tokens = float(self.capacity - self.in_flight)
+                self.reset_at = None
+        else:
+            self.tokens = min(float(self.capacity - self.in_flight), self.tokens + (now - self.last_update) * self.refill_rate)
+        self.last_update = now
+
+    # Blocks until a call can be made without exceeding the hourly budget
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens - self.reserved_calls >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.reset_at is not None:
+                    wait_time = self.reset_at - now
+                else:
+                    wait_time = (self.reserved_calls + 1 - self.tokens) / self.refill_rate
+                logging.info("Fitbit API hourly budget used up, pausing requests for " + str(int(wait_time) + 1) + " seconds until the rate limit resets")
+                self.condition.wait(max(wait_time, 0.1))
+
+    # Releases an acquired call that did not reach the server ( e.g. connection error )
+    def release(self):
+        with self.condition:
+            self.in_flight = max(self.in_flight - 1, 0)
+            self.tokens = min(float(self.capacity), self.tokens + 1)
+            self.condition.notify_all()
+
+    # Syncs the bucket with the rate limit headers of a completed request
+    def update_from_headers(self, headers):
+        with self.condition:
+            self.in_flight = max(self.in_flight - 1, 0)
+            try:
+                remaining = int(headers["Fitbit-Rate-Limit-Remaining"])
+                reset_seconds = int(headers["Fitbit-Rate-Limit-Reset"])
+            except (KeyError, TypeError, ValueError):
+                return
+            now = time.monotonic()
+            self.tokens = float(remaining - self.in_flight)
+            self.reset_at = now + reset_seconds + self.reset_buffer
+            self.last_update = now
+            self.condition.notify_all()
+
+    # Marks the budget as empty until the reset time ( used when a 429 error is received anyway )
+    def exhaust(self, reset_seconds):
+        with self.condition:
+            self.tokens = 0.0
+            self.reset_at = time.monotonic() + reset_seconds + self.reset_buffer
+            self.condition.notify_all()
+
+    # Seconds until the given number of calls can be made at the earliest ( the hourly budget being the only limit )
+    def estimate_seconds_for(self, calls):
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            available = self.tokens - self.reserved_calls
+            if calls <= available:
+                return 0
+            seconds_to_reset = self.reset_at - now if self.reset_at is not None else 3600 - time.time() % 3600 + self.reset_buffer # Fitbit resets at the top of the hour
+            return int(seconds_to_reset + (-(-(calls - available) // (self.capacity - self.reserved_calls)) - 1) * 3600)
+
+    def status(self):
+        with self.condition:
+            self._refill(time.monotonic())
+            return {"remaining": int(self.tokens), "in_flight": self.in_flight, "reset_in_seconds": int(self.reset_at - time.monotonic()) if self.reset_at is not None else None}
+
+# %% [markdown]
+# ## Response cache
+
+# %%
+# Remembers a content hash per request URL in the local state database. Within the TTL a request is not sent at all, after it the response is
+# compared to the stored hash. In both cases the caller gets UNCHANGED_RESPONSE and skips parsing and writing data that is already stored.
+# New hashes are staged in the fetch job and only committed once its points are flushed to the database, so a failed write is fetched again next time
+UNCHANGED_RESPONSE = object()
+response_cache_immutable_after_days = {"/body/log/weight/": 30, "/sleep/": 7} # Endpoints where past days are often edited later ( manual logs ), default is RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS
+
+# Response cache hashes and ingested TCX activities staged by one fetch job ( a scheduled job, the startup update or a bulk update unit, see
+# run_fetch_job ). Only the job commits them, once its own points are flushed, so a job that fails never leaves entries behind for another one
+class FetchJob:
+    def __init__(self):
+        self.response_hashes = {} # cache key -> ( content hash, fetched at )
+        self.tcx_activities = {} # activity id -> ( log id, content hash )
+
+def current_fetch_job():
+    return getattr(account_context, "fetch_job", None)
+
+# Runs a function with the given fetch job as the fetch job of this thread ( the fetch workers of a job stage into it too )
+def run_in_fetch_job(fetch_job, funcname, *args):
+    previous_fetch_job = current_fetch_job()
+    account_context.fetch_job = fetch_job
+    try:
+        return funcname(*args)
+    finally:
+        account_context.fetch_job = previous_fetch_job
+
+class ResponseCache:
+    def __init__(self, store, max_entries):
+        self.store = store
+        self.max_entries = max_entries
+        self.store.execute("CREATE TABLE IF NOT EXISTS response_cache (cache_key TEXT PRIMARY KEY, content_hash TEXT, fetched_at REAL, last_used REAL)")
+
+    # Returns (content_hash, fetched_at) or None
+    def lookup(self, cache_key):
+        fetch_job = current_fetch_job()
+        if fetch_job is not None and cache_key in fetch_job.response_hashes:
+            return fetch_job.response_hashes[cache_key]
+        rows = self.store.execute("SELECT content_hash, fetched_at FROM response_cache WHERE cache_key = ?", (cache_key,))
+        if not rows:
+            return None
+        self.store.execute("UPDATE response_cache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+        return rows[0]
+
+    # Responses fetched outside of a fetch job are not cached
+    def stage(self, cache_key, content_hash):
+        fetch_job = current_fetch_job()
+        if fetch_job is not None:
+            fetch_job.response_hashes[cache_key] = (content_hash, time.time())
+
+    def commit(self, staged):
+        if staged:
+            self.store.executemany("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)", [(cache_key, content_hash, fetched_at, fetched_at) for cache_key, (content_hash, fetched_at) in staged.items()])
+            self.store.execute("DELETE FROM response_cache WHERE cache_key NOT IN (SELECT cache_key FROM response_cache ORDER BY last_used DESC LIMIT ?)", (self.max_entries,)) # LRU eviction
+
+    # Drops the entries of the request URLs containing text, so they are requested and processed again
+    def forget(self, text):
+        self.store.execute("DELETE FROM response_cache WHERE instr(cache_key, ?) > 0", (text,))
+
+    def clear(self):
+        self.store.execute("DELETE FROM response_cache")
+
+# TTL in seconds for a request URL, None if it is not cached ( no date in the URL ). Windows ending in the last days of the local date may still change
+def get_response_cache_ttl(url):
+    dates = re.findall(r"\d{4}-\d{2}-\d{2}", url)
+    if not dates:
+        return None
+    immutable_after_days = next((days for endpoint, days in response_cache_immutable_after_days.items() if endpoint in url), RESPONSE_CACHE_IMMUTABLE_AFTER_DAYS)
+    days_old = (datetime.now(current_account().local_timezone).date() - datetime.strptime(dates[-1], "%Y-%m-%d").date()).days
+    return RESPONSE_CACHE_PAST_TTL if days_old >= immutable_after_days else RESPONSE_CACHE_RECENT_TTL
+
+# %% [markdown]
+# ## TCX archive
+
+# %%
+# Downloaded TCX files are kept gzipped under TCX_ARCHIVE_DIR, named by the SHA-256 hash of their content, and the tcx_activities table records
+# which ActivityIDs are already ingested so finished activities are never downloaded again. Like the response cache, ingested activities are
+# staged in the fetch job and committed only after its points are flushed to the database
+class TcxArchive:
+    def __init__(self, store, directory):
+        self.store = store
+        self.directory = directory
+        self.store.execute("CREATE TABLE IF NOT EXISTS tcx_activities (activity_id TEXT PRIMARY KEY, log_id TEXT, content_hash TEXT, ingested_at TEXT)")
+
+    def is_ingested(self, activity_id):
+        fetch_job = current_fetch_job()
+        if fetch_job is not None and activity_id in fetch_job.tcx_activities:
+            return True
+        return bool(self.store.execute("SELECT 1 FROM tcx_activities WHERE activity_id = ?", (activity_id,)))
+
+    # Streams the response body into the archive, returns the path of the archived file and its content hash
+    def archive_response(self, response):
+        os.makedirs(self.directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(file_descriptor, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb") as file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    digest.update(chunk)
+                    file.write(chunk)
+            content_hash = digest.hexdigest()
+            file_path = os.path.join(self.directory, content_hash[:2], content_hash + ".tcx.gz")
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return file_path, content_hash
+
+    # Activities ingested outside of a fetch job are downloaded again next time
+    def stage(self, activity_id, log_id, content_hash):
+        fetch_job = current_fetch_job()
+        if fetch_job is not None:
+            fetch_job.tcx_activities[activity_id] = (log_id, content_hash)
+
+    def commit(self, staged):
+        if staged:
+            ingested_at = datetime.now(pytz.utc).isoformat()
+            self.store.executemany("INSERT OR REPLACE INTO tcx_activities VALUES (?, ?, ?, ?)", [(activity_id, log_id, content_hash, ingested_at) for activity_id, (log_id, content_hash) in staged.items()])
+
+# %% [markdown]
+# ## Fitbit accounts
+
+# %%
+# Everything that belongs to one Fitbit account : credentials and tokens, rate limit budget, timezone, working dates and local state.
+# The HTTP session, the fetch worker pool and the InfluxDB writer are shared by all accounts. The fetch functions work on the
+# account of the current thread ( see run_as_account ), so one process can collect the data of many accounts
+class FitbitAccount:
+    def __init__(self, name, client_id, client_secret, token_file_path, device_name, local_timezone, state_db_file_path, account_tag=None):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_file_path = token_file_path
+        self.device_name = device_name
+        self.local_timezone = local_timezone # timezone name or "Automatic" until resolve_local_timezone() runs
+        self.tags = (("Account", account_tag),) if account_tag else () # added to every point, so accounts sharing a database can be told apart
+        self.token_manager = TokenManager(self)
+        self.rate_limit_budget = RateLimitBudget(RATE_LIMIT_CALLS_PER_HOUR, RATE_LIMIT_RESERVED_CALLS, RATE_LIMIT_RESET_BUFFER) # Fitbit rate limits are per user
+        self.fetch_executor = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS, thread_name_prefix="fitbit-fetch-" + name) # see run_fetch_tasks
+        self.state_store = StateStore(state_db_file_path)
+        self.response_cache = ResponseCache(self.state_store, RESPONSE_CACHE_MAX_ENTRIES)
+        self.tcx_archive = TcxArchive(self.state_store, TCX_ARCHIVE_DIR) # the archive files are content addressed, so the directory can be shared
+        self.job_lanes = {"live": JobLane(self, live_job_executor), "background": JobLane(self, account_executor)} # scheduled jobs, one at a time per lane
+        self.pending_notifications = set() # ( collection, fetch index, date ) of the notification fetches waiting on a job lane
+        self.start_date, self.end_date, self.start_date_str, self.end_date_str = None, None, None, None
+
+    # Requests given up on ( returned None ) are counted per thread, as a bulk update unit runs all its requests in one thread ( see do_bulk_update )
+    def count_skipped_request(self):
+        account_context.skipped_request_count = get_skipped_request_count() + 1
+
+account_context = threading.local()
+
+def get_skipped_request_count():
+    return getattr(account_context, "skipped_request_count", 0)
+
+def current_account():
+    account = getattr(account_context, "account", None)
+    if account is None:
+        raise RuntimeError("No Fitbit account selected for this thread, use run_as_account()")
+    return account
+
+# Runs a function with the given account as the current account of this thread
+def run_as_account(account, funcname, *args):
+    previous_account = getattr(account_context, "account", None)
+    account_context.account = account
+    try:
+        return funcname(*args)
+    finally:
+        account_context.account = previous_account
+
+# Without FITBIT_ACCOUNTS_FILE, the single account is configured by the variables above. The accounts file is a JSON list of objects with "name" and
+# "token_file_path", and optionally "client_id", "client_secret", "device_name", "local_timezone" and "state_db_file_path" ( defaults : the
+# CLIENT_ID, CLIENT_SECRET, DEVICENAME and LOCAL_TIMEZONE variables, and fitbit_state_<name>.db next to the token file )
+def load_fitbit_accounts():
+    if not FITBIT_ACCOUNTS_FILE:
+        return [FitbitAccount("default", client_id, client_secret, TOKEN_FILE_PATH, DEVICENAME, LOCAL_TIMEZONE, STATE_DB_FILE_PATH)]
+    with open(FITBIT_ACCOUNTS_FILE, "r") as file:
+        account_configs = json.load(file)
+    accounts = []
+    for config in account_configs:
+        state_db_file_path = config.get("state_db_file_path") or os.path.join(os.path.dirname(config["token_file_path"]), "fitbit_state_" + config["name"] + ".db")
+        accounts.append(FitbitAccount(config["name"], config.get("client_id", client_id), config.get("client_secret", client_secret), config["token_file_path"], config.get("device_name", DEVICENAME), config.get("local_timezone", LOCAL_TIMEZONE), state_db_file_path, account_tag=config["name"]))
+    assert len(accounts) > 0 and len(set(account.name for account in accounts)) == len(accounts), "Account names in " + FITBIT_ACCOUNTS_FILE + " must be unique"
+    logging.info("Loaded " + str(len(accounts)) + " Fitbit accounts from " + FITBIT_ACCOUNTS_FILE)
+    return accounts
+
+# Prefixes the log messages with the name of the current account when several accounts are collected. Set on the handlers, so
+# the messages of other loggers ( e.g. urllib3 ) are prefixed too, the record is prefixed once for all handlers
+class AccountLogFilter(logging.Filter):
+    def filter(self, record):
+        account = getattr(account_context, "account", None)
+        if account is not None and not getattr(record, "account_prefixed", False):
+            record.msg = "[" + account.name + "] " + str(record.msg)
+            record.account_prefixed = True
+        return True
+
+fitbit_accounts = [] # filled by main()
+
+# %% [markdown]
+# ## Retry backoff and circuit breaker
+
+# %%
+# Exponential backoff with jitter, so the workers and accounts do not retry in lockstep. A Retry-After of the server is the minimum delay
+def get_retry_delay(attempt, retry_after=None):
+    delay = min(FITBIT_RETRY_BASE_DELAY * 2 ** attempt, FITBIT_RETRY_MAX_DELAY) * random.uniform(0.5, 1.5)
+    return max(delay, retry_after or 0)
+
+# Seconds of the Retry-After header of a response ( a number of seconds or an HTTP date ), None without a valid header
+def get_retry_after_seconds(response):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        return max((email.utils.parsedate_to_datetime(retry_after) - datetime.now(pytz.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# Counts the failed attempts in a row ( server or connection errors ) of every endpoint. After CIRCUIT_BREAKER_THRESHOLD of them the circuit of the
+# endpoint opens : its requests are skipped at once for CIRCUIT_BREAKER_COOLDOWN seconds, so a failing endpoint does not hold up the other work.
+# Then one trial request is let through per cooldown, the first answer of the server closes the circuit again
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = {} # endpoint -> failed attempts in a row
+        self.open_until = {} # endpoint -> time.monotonic() value until which its requests are skipped
+        self.lock = threading.Lock()
+
+    def allow(self, endpoint):
+        with self.lock:
+            open_until = self.open_until.get(endpoint)
+            if open_until is None:
+                return True
+            now = time.monotonic()
+            if now < open_until:
+                return False
+            self.open_until[endpoint] = now + self.cooldown # the next trial request waits for another cooldown
+            logging.info("Circuit breaker : sending a trial request to " + endpoint)
+            return True
+
+    def record_success(self, endpoint):
+        if endpoint not in self.failures: # no lock needed for the common case
+            return
+        with self.lock:
+            self.failures.pop(endpoint, None)
+            if self.open_until.pop(endpoint, None) is not None:
+                logging.info("Circuit breaker closed : " + endpoint + " is answering again")
+
+    # Returns True if the circuit of the endpoint is open, the failed request is then not retried
+    def record_failure(self, endpoint):
+        if self.failure_threshold <= 0:
+            return False
+        with self.lock:
+            failures = self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+            is_open = endpoint in self.open_until
+            if failures < self.failure_threshold and not is_open:
+                return False
+            self.open_until[endpoint] = time.monotonic() + self.cooldown
+        if not is_open:
+            logging.warning("Circuit breaker open : skipping the requests to " + endpoint + " for " + str(self.cooldown) + " seconds after " + str(failures) + " failed attempts in a row")
+            metrics.inc("fitbit_circuit_breaker_opened_total", (("endpoint", endpoint),))
+        return True
+
+    # Seconds until every open circuit lets a trial request through
+    def seconds_until_trial(self):
+        with self.lock:
+            now = time.monotonic()
+            return max([open_until - now for open_until in self.open_until.values()] + [0])
+
+endpoint_circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN) # shared by the accounts, a failing Fitbit endpoint fails for all of them
+
+# %% [markdown]
+# ## Setting up base API Caller function
+
+# %%
+# Generic Request caller for all 
+# With use_cache=True, returns UNCHANGED_RESPONSE if the data has not changed since it was last fetched ( see Response cache )
+def request_data_from_fitbit(url, headers={}, params={}, data={}, request_type="get", rate_limited=True, use_cache=False, stream=False):
+    account = current_account()
+    retry_attempts = 0
+    cache_ttl = get_response_cache_ttl(url) if use_cache and RESPONSE_CACHE else None
+    if cache_ttl is not None:
+        cache_key = url + ("?" + json.dumps(params, sort_keys=True) if params else "")
+        cached = account.response_cache.lookup(cache_key)
+        if cached and time.time() - cached[1] < cache_ttl:
+            logging.debug("Response cache hit, skipping request : " + url)
+            metrics.inc("fitbit_response_cache_total", (("result", "hit"),))
+            return UNCHANGED_RESPONSE
+    logging.debug("Requesting data from fitbit via Url : " + url)
+    endpoint_name = metric_endpoint_name(url) # metrics series and circuit breaker key
+    circuit_breaker = endpoint_circuit_breaker if rate_limited else None # requests outside of the API budget ( token refresh ) are never skipped
+    if circuit_breaker is not None and not circuit_breaker.allow(endpoint_name):
+        logging.debug("Circuit breaker open, skipping request : " + url)
+        metrics.inc("fitbit_circuit_breaker_rejected_total", (("endpoint", endpoint_name),))
+        account.count_skipped_request()
+        return None
+    request_started = time.perf_counter()
+    if request_type == "get" and headers == {}:
+        headers = {
+            "Authorization": "Bearer ",
+            "Accept": "application/json",
+            'Accept-Language': FITBIT_LANGUAGE
+        }
+    uses_access_token = headers.get("Authorization", "").startswith("Bearer ")
+    try:
+        while True: # Retried with exponential backoff until the retry limit of the error is reached or the circuit breaker of the endpoint opens
+            if request_type not in ["get", "post"]:
+                raise Exception("Invalid request type " + str(request_type))
+            if rate_limited:
+                wait_started = time.perf_counter()
+                account.rate_limit_budget.acquire()
+                metrics.observe("fitbit_rate_limit_wait_seconds", (("account", account.name),), time.perf_counter() - wait_started)
+            if uses_access_token: # set after the rate limit wait, the token is refreshed if it expires soon
+                headers["Authorization"] = "Bearer " + account.token_manager.get_access_token()
+            retry_after = None
+            response = None
+            try:        
+                try:
+                    http_started = time.perf_counter()
+                    if request_type == "get":
+                        response = http_session.get(url, headers=headers, params=params, data=data, stream=stream, timeout=FITBIT_REQUEST_TIMEOUT)
+                    else:
+                        response = http_session.post(url, headers=headers, params=params, data=data, timeout=FITBIT_REQUEST_TIMEOUT)
+                except (ConnectionError, Timeout, ChunkedEncodingError):
+                    metrics.inc("fitbit_responses_total", (("endpoint", endpoint_name), ("status", "connection_error")))
+                    raise
+                finally:
+                    if rate_limited and response is None: # no response headers to sync the budget with, whatever the error
+                        account.rate_limit_budget.release()
+                metrics.observe("fitbit_request_duration_seconds", (("endpoint", endpoint_name),), time.perf_counter() - http_started)
+                metrics.inc("fitbit_responses_total", (("endpoint", endpoint_name), ("status", str(response.status_code))))
+                if rate_limited:
+                    account.rate_limit_budget.update_from_headers(response.headers)
+                    if "Fitbit-Rate-Limit-Remaining" in response.headers:
+                        metrics.set("fitbit_rate_limit_remaining", (("account", account.name),), int(response.headers["Fitbit-Rate-Limit-Remaining"]))
+                if circuit_breaker is not None and response.status_code not in [500, 502, 503, 504]:
+                    circuit_breaker.record_success(endpoint_name) # the server answered
+        
+                if response.status_code in [200, 201]: # Success ( 201 : subscription created )
+                    if cache_ttl is not None:
+                        content_hash = hashlib.sha256(response.content).hexdigest()
+                        account.response_cache.stage(cache_key, content_hash)
+                        if cached and cached[0] == content_hash:
+                            logging.debug("Response unchanged since the last fetch, skipping : " + url)
+                            metrics.inc("fitbit_response_cache_total", (("result", "unchanged"),))
+                            return UNCHANGED_RESPONSE
+                        metrics.inc("fitbit_response_cache_total", (("result", "changed"),))
+                    if url.endswith(".tcx"): # TCX XML file for GPS data
+                        return response
+                    else:
+                        decode_started = time.perf_counter()
+                        response_data = response.json()
+                        request_started += time.perf_counter() - decode_started # decoding counts as parse time of the fetcher
+                        return response_data
+                elif response.status_code == 429: # API Limit reached ( the budget should prevent this, unless other apps share the same limit )
+                    retry_after = get_retry_after_seconds(response)
+                    if retry_after is None:
+                        retry_after = int(response.headers.get("Fitbit-Rate-Limit-Reset", 3600 - int(time.time()) % 3600)) # Fitbit changed their headers.
+                    logging.warning("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(int(retry_after) + RATE_LIMIT_RESET_BUFFER) + " seconds")
+                    print("Fitbit API limit reached. Error code : " + str(response.status_code) + ", Retrying in " + str(int(retry_after) + RATE_LIMIT_RESET_BUFFER) + " seconds")
+                    account.rate_limit_budget.exhaust(retry_after)
+                    continue # next account.rate_limit_budget.acquire() waits until the reset
+                elif response.status_code == 401 and uses_access_token: # Access token revoked or expired early, the expiry is tracked by the token manager
+                    logging.warning("Error code : " + str(response.status_code) + ", Details : " + response.text)
+                    print("Error code : " + str(response.status_code) + ", Details : " + response.text)
+                    if retry_attempts > EXPIRED_TOKEN_MAX_RETRY:
+                        logging.error("Unable to solve the 401 Error. Please debug - " + response.text)
+                        raise Exception("Unable to solve the 401 Error. Please debug - " + response.text)
+                    account.token_manager.refresh(rejected_token=headers["Authorization"][len("Bearer "):]) # unless another thread or process already did
+                    retry_reason = "unauthorized"
+                elif response.status_code in [500, 502, 503, 504]: # Fitbit server is down or not responding ( most likely ):
+                    circuit_open = circuit_breaker is not None and circuit_breaker.record_failure(endpoint_name)
+                    if circuit_open or (retry_attempts >= SERVER_ERROR_MAX_RETRY and SKIP_REQUEST_ON_SERVER_ERROR):
+                        if not circuit_open:
+                            logging.error("Unable to solve the server Error. Retry limit exceed. Please debug - " + response.text)
+                        logging.warning(("Circuit breaker open" if circuit_open else "Retry limit reached") + " for server error : Skipping request -> " + url)
+                        account.count_skipped_request()
+                        return None
+                    logging.warning("Server Error encountered ( Code " + str(response.status_code) + " )")
+                    retry_after = get_retry_after_seconds(response)
+                    retry_reason = "server_error"
+                else:
+                    logging.error("Fitbit API request failed. Status code: " + str(response.status_code) + " " + str(response.text) )
+                    print(f"Fitbit API request failed. Status code: {response.status_code}", response.text)
+                    response.raise_for_status()
+                    account.count_skipped_request()
+                    return None
+
+            except (ConnectionError, Timeout, ChunkedEncodingError) as e: # timed out or connection lost while reading the response
+                logging.error("Failed to connect to internet : " + str(e))
+                print("Failed to connect to internet : " + str(e))
+                if (circuit_breaker is not None and circuit_breaker.record_failure(endpoint_name)) or retry_attempts >= CONNECTION_ERROR_MAX_RETRY:
+                    if not rate_limited: # token refresh : the caller gets the error, and the token file lock is released
+                        raise
+                    logging.warning("Unable to connect : Skipping request -> " + url)
+                    account.count_skipped_request()
+                    return None
+                retry_reason = "connection_error"
+            retry_delay = 0 if retry_reason == "unauthorized" and retry_attempts == 0 else get_retry_delay(retry_attempts, retry_after) # the renewed token is tried at once
+            logging.warning("Retrying in " + str(round(retry_delay, 1)) + " seconds ( attempt " + str(retry_attempts + 2) + " ) : " + url)
+            metrics.inc("fitbit_request_retries_total", (("endpoint", endpoint_name), ("reason", retry_reason)))
+            retry_attempts += 1
+            time.sleep(retry_delay)
+    finally:
+        add_thread_request_seconds(time.perf_counter() - request_started)
+
+# %% [markdown]
+# ## Token Refresh Management
+
+# %%
+# Returns the new tokens with the expiry time of the access token ( epoch seconds )
+def refresh_fitbit_tokens(account, refresh_token):
+    logging.info("Attempting to refresh tokens...")
+    url = "https://api.fitbit.com/oauth2/token"
+    headers = {
+        "Authorization": "Basic " + base64.b64encode((account.client_id + ":" + account.client_secret).encode()).decode(),
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+    requested_at = time.time()
+    json_data = request_data_from_fitbit(url, headers=headers, data=data, request_type="post", rate_limited=False) # token endpoint does not count towards the API rate limit
+    tokens = {
+        "access_token": json_data["access_token"],
+        "refresh_token": json_data["refresh_token"],
+        "expires_at": requested_at + int(json_data.get("expires_in", 28800))
+    }
+    logging.info("Fitbit token refresh successful!")
+    return tokens
+
+# A token file written by an older version has no expiry time, its access token is then refreshed once
+def load_tokens_from_file(token_file_path):
+    with open(token_file_path, "r") as file:
+        return json.load(file)
+
+# Writes a temporary file next to the token file and renames it, so a crash or another process never sees a partially written file
+def save_tokens_to_file(token_file_path, tokens):
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(token_file_path)), prefix=".fitbit_token_", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w") as file:
+            json.dump(tokens, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, token_file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# Exclusive lock on "<token file>.lock", held by one process at a time while it refreshes the tokens. fcntl is not available on Windows, where
+# only the threads of one process are serialized
+@contextlib.contextmanager
+def token_file_lock(token_file_path):
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(token_file_path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Keeps the access token of an account with its expiry time and refreshes it TOKEN_REFRESH_MARGIN seconds before it expires, so no request is
+# sent with an expired token. Refresh tokens are single use : refreshes are serialized by a lock for the threads and by the token file lock for
+# the processes sharing the token file, and the file is read again under the locks, so a token refreshed meanwhile by another thread or process
+# ( or still valid after a restart ) is used instead of refreshing again
+class TokenManager:
+    def __init__(self, account):
+        self.account = account
+        self.access_token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def get_access_token(self):
+        if self.access_token and time.time() < self.expires_at - TOKEN_REFRESH_MARGIN:
+            return self.access_token
+        return self.refresh()
+
+    # rejected_token : access token of a 401 response, replaced even if it has not expired yet
+    def refresh(self, rejected_token=None):
+        token_file_path = self.account.token_file_path
+        with self.lock, token_file_lock(token_file_path):
+            try:
+                tokens = load_tokens_from_file(token_file_path)
+            except FileNotFoundError:
+                tokens = {"refresh_token": input("No token file found at " + token_file_path + ". Please enter a valid refresh token : ")}
+            if tokens.get("access_token") and tokens["access_token"] != rejected_token and time.time() < tokens.get("expires_at", 0) - TOKEN_REFRESH_MARGIN:
+                logging.debug("Using the access token of the token file, valid until " + datetime.fromtimestamp(tokens["expires_at"]).isoformat())
+            else:
+                tokens = refresh_fitbit_tokens(self.account, tokens["refresh_token"])
+                save_tokens_to_file(token_file_path, tokens)
+            self.access_token, self.expires_at = tokens["access_token"], tokens["expires_at"]
+            return self.access_token
+
+# %% [markdown]
+# ## Influxdb Database Initialization
+
+# %%
+influxdbclient = None # set by connect_influxdb()
+influxdb_write_api = None # for influxdb 2.x
+
+# Only the client of INFLUXDB_VERSION is imported
+def connect_influxdb():
+    global influxdbclient, influxdb_write_api
+    if INFLUXDB_VERSION == "2":
+        from influxdb_client import InfluxDBClient as InfluxDBClient2
+        from influxdb_client.client.write_api import SYNCHRONOUS
+        from influxdb_client.client.exceptions import InfluxDBError
+        try:
+            influxdbclient = InfluxDBClient2(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
+            influxdb_write_api = influxdbclient.write_api(write_options=SYNCHRONOUS)
+        except InfluxDBError as err:
+            logging.error("Unable to connect with influxdb 2.x database! Aborted")
+            raise InfluxDBError("InfluxDB connection failed:" + str(err))
+    elif INFLUXDB_VERSION == "1":
+        from influxdb import InfluxDBClient
+        from influxdb.exceptions import InfluxDBClientError
+        try:
+            influxdbclient = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT, username=INFLUXDB_USERNAME, password=INFLUXDB_PASSWORD)
+            influxdbclient.switch_database(INFLUXDB_DATABASE)
+        except InfluxDBClientError as err:
+            logging.error("Unable to connect with influxdb 1.x database! Aborted")
+            raise InfluxDBClientError("InfluxDB connection failed:" + str(err))
+    elif INFLUXDB_VERSION == "3":
+        from influxdb_client_3 import InfluxDBClient3, InfluxDBError
+        try:
+            influxdbclient = InfluxDBClient3(
+                    host=f"http://{INFLUXDB_HOST}:{INFLUXDB_PORT}",
+                    token=INFLUXDB_V3_ACCESS_TOKEN,
+                    database=INFLUXDB_DATABASE
+                    )
+            demo_point = {
+            'measurement': 'DemoPoint',
+            'time': '1970-01-01T00:00:00+00:00',
+            'tags': {'DemoTag': 'DemoTagValue'},
+            'fields': {'DemoField': 0}
+            }
+            # The following code block tests the connection by writing/overwriting a demo point. raises error and aborts if connection fails. 
+            influxdbclient.write(record=[demo_point])
+        except InfluxDBError as err:
+            logging.error("Unable to connect with influxdb 3.x database! Aborted")
+            raise InfluxDBError(message="InfluxDB connection failed:" + str(err))
+    else:
+        logging.error("No matching version found. Supported values are 1 and 2 and 3")
+        raise ValueError("No matching version found. Supported values are 1 and 2 and 3")
+
+influxdb_write_lock = threading.Lock() # Fetch workers write from multiple threads, the database clients are used by one thread at a time
+influxdb_spool_lock = threading.Lock()
+last_spool_replay = 0
+spooled_batch_count = 0
+
+# Returns True if the points were written successfully, or stored in the spool directory to be replayed later
+def write_points_to_influxdb(points, use_dedup=True):
+    fingerprints = {}
+    if INFLUXDB_WRITE_DEDUP and use_dedup:
+        points, fingerprints = write_dedup_index.filter(map(as_fitbit_point, points))
+    encode_started = time.perf_counter()
+    lines = [line for line in map(encode_line_protocol, points) if line is not None]
+    metrics.observe("influxdb_encode_seconds", (), time.perf_counter() - encode_started)
+    if len(lines) == 0:
+        if INFLUXDB_WRITE_DEDUP and use_dedup:
+            write_dedup_index.record(fingerprints)
+        return True
+    metrics.observe("influxdb_write_batch_points", (), len(lines))
+    with influxdb_write_lock:
+        for attempt in range(INFLUXDB_WRITE_MAX_RETRY + 1):
+            try:
+                write_started = time.perf_counter()
+                write_lines_to_influxdb(lines)
+                metrics.observe("influxdb_write_duration_seconds", (), time.perf_counter() - write_started)
+                logging.info("Successfully updated influxdb database with new points")
+                break
+            except Exception as err:
+                metrics.inc("influxdb_write_errors_total", (("retryable", str(is_retryable_write_error(err)).lower()),))
+                if not is_retryable_write_error(err):
+                    logging.error("InfluxDB rejected the batch of " + str(len(lines)) + " points, it will not be retried! " + str(err))
+                    print("Influxdb write failed! ", str(err))
+                    return False
+                if attempt == INFLUXDB_WRITE_MAX_RETRY:
+                    logging.error("Unable to connect with influxdb " + INFLUXDB_VERSION + ".x database! " + str(err))
+                    print("Influxdb connection failed! ", str(err))
+                    return spool_lines(lines)
+                delay = min(INFLUXDB_WRITE_RETRY_DELAY * 2 ** attempt, 60) * random.uniform(0.5, 1.5) # jitter keeps the workers from retrying in lockstep
+                logging.warning("InfluxDB write failed, retrying in " + str(round(delay, 1)) + " seconds ( attempt " + str(attempt + 1) + " of " + str(INFLUXDB_WRITE_MAX_RETRY) + " ) " + str(err))
+                time.sleep(delay)
+        replay_spooled_lines()
+    if INFLUXDB_WRITE_DEDUP and use_dedup:
+        write_dedup_index.record(fingerprints)
+    return True
+
+# Points are sent as line protocol with precision "s" for all database versions, errors are raised to the caller
+def write_lines_to_influxdb(lines):
+    if INFLUXDB_VERSION == "2":
+        influxdb_write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=lines, write_precision="s")
+    elif INFLUXDB_VERSION == "1":
+        influxdbclient.write_points(lines, time_precision="s", protocol="line")
+    elif INFLUXDB_VERSION == "3":
+        influxdbclient.write(record=lines, write_precision="s")
+    else:
+        logging.error("No matching version found. Supported values are 1 and 2 and 3")
+        raise ValueError("No matching version found. Supported values are 1 and 2 and 3")
+
+# Client errors ( bad data, authentication ) fail the same way on every attempt. Everything else ( timeouts, refused connections, 5xx ) is transient
+def is_retryable_write_error(err):
+    if isinstance(err, ValueError): # unsupported version above
+        return False
+    status = getattr(err, "status", None) or getattr(getattr(err, "response", None), "status", None) or getattr(err, "code", None) # code : InfluxDBClientError of the 1.x client
+    return not isinstance(status, int) or not 400 <= status < 500 or status in (408, 429)
+
+# Each batch is one line protocol file, written to a temporary name first so a crash never leaves a partial batch behind
+def spool_lines(lines):
+    global spooled_batch_count
+    try:
+        os.makedirs(INFLUXDB_SPOOL_DIR, exist_ok=True)
+        with influxdb_spool_lock:
+            spooled_batch_count += 1
+            file_name = os.path.join(INFLUXDB_SPOOL_DIR, "batch-" + str(time.time_ns()) + "-" + str(spooled_batch_count) + ".lp")
+        with open(file_name + ".tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_name + ".tmp", file_name)
+    except OSError as err:
+        logging.error("Unable to spool " + str(len(lines)) + " points to " + INFLUXDB_SPOOL_DIR + ", they are lost! " + str(err))
+        return False
+    metrics.inc("influxdb_spooled_points_total", (), len(lines))
+    logging.warning("Spooled " + str(len(lines)) + " points to " + file_name + ", they will be written once the database is reachable")
+    return True
+
+# Replays the spooled batches oldest first, stops at the first failure. Called with influxdb_write_lock held, after a successful write
+def replay_spooled_lines(force=False):
+    global last_spool_replay
+    if not force and time.monotonic() - last_spool_replay < INFLUXDB_SPOOL_REPLAY_INTERVAL:
+        return
+    last_spool_replay = time.monotonic()
+    if not os.path.isdir(INFLUXDB_SPOOL_DIR):
+        return
+    for file_name in sorted(name for name in os.listdir(INFLUXDB_SPOOL_DIR) if name.endswith(".lp")):
+        file_path = os.path.join(INFLUXDB_SPOOL_DIR, file_name)
+        with open(file_path) as file:
+            lines = file.read().splitlines()
+        try:
+            write_lines_to_influxdb(lines)
+        except Exception as err:
+            if is_retryable_write_error(err):
+                logging.warning("Replaying spooled batch " + file_name + " failed, will retry later " + str(err))
+                return
+            logging.error("InfluxDB rejected spooled batch " + file_name + ", it is discarded! " + str(err))
+        os.remove(file_path)
+        logging.info("Replayed " + str(len(lines)) + " spooled points from " + file_name)
+
+# %% [markdown]
+# ## Write deduplication
+
+# %%
+# The overlapping update windows fetch the same daily summaries ( HRV, breathing rate, SpO2, resting HR, HR zones, sleep ... ) many times a day,
+# and writing them again only adds load and compaction work to the database. The index keeps a fingerprint of every written point, ( measurement,
+# tags, field names, timestamp ) -> hash of the field values, so only new or changed points are sent. Fingerprints are recorded once the batch
+# is written ( not when it failed or was spooled ), and kept in a SQLite file so a restart does not rewrite everything. The high volume
+# intraday series and their rollups are not indexed, the incremental update already requests only their new data ( and the current hour )
+write_dedup_excluded_measurements = {"HeartRate_Intraday", "Steps_Intraday", "GPS", "FitbitFetchMetrics", "HeartRate_Intraday_1m", "HeartRate_Intraday_1h", "Steps_Intraday_1h"}
+
+# The field names are part of the key, InfluxDB merges points of the same series and time written with different fields ( e.g. Activity Minutes )
+def get_point_fingerprint(point):
+    point_key = encode_line_protocol_series(point.measurement, point.tags) + " " + ",".join(sorted(point.fields)) + " " + str(point.timestamp)
+    return hashlib.blake2b(point_key.encode(), digest_size=16).digest(), hashlib.blake2b(encode_line_protocol_fields(point.fields).encode(), digest_size=8).digest()
+
+class WriteDedupIndex:
+    def __init__(self, store, max_entries):
+        self.store = store
+        self.max_entries = max_entries
+        self.entries = None # point key hash -> fields hash, least recently written first. Loaded on first use
+        self.suppressed_points = 0
+        self.lock = threading.Lock()
+
+    def _load(self): # must be called with self.lock held
+        if self.entries is None:
+            self.store.execute("CREATE TABLE IF NOT EXISTS write_index (point_key BLOB PRIMARY KEY, fields_hash BLOB, last_written REAL)")
+            self.entries = collections.OrderedDict(self.store.execute("SELECT point_key, fields_hash FROM (SELECT * FROM write_index ORDER BY last_written DESC LIMIT ?) ORDER BY last_written", (self.max_entries,)))
+
+    # Returns the points that have to be written, and the fingerprints to record once they are
+    def filter(self, points):
+        points_to_write, fingerprints, suppressed_counts = [], {}, collections.Counter()
+        with self.lock:
+            self._load()
+            for point in points:
+                if point.measurement in write_dedup_excluded_measurements:
+                    points_to_write.append(point)
+                    continue
+                point_key, fields_hash = get_point_fingerprint(point)
+                if self.entries.get(point_key) == fields_hash:
+                    suppressed_counts[point.measurement] += 1
+                else:
+                    points_to_write.append(point)
+                fingerprints[point_key] = fields_hash
+            self.suppressed_points += sum(suppressed_counts.values())
+        for measurement, count in suppressed_counts.items():
+            metrics.inc("influxdb_write_suppressed_points_total", (("measurement", measurement),), count)
+        if suppressed_counts:
+            logging.info("Skipped writing " + str(sum(suppressed_counts.values())) + " unchanged points ( " + str(self.suppressed_points) + " since start )")
+        return points_to_write, fingerprints
+
+    # Unchanged points are recorded again too, so the points still being fetched are the last ones evicted
+    def record(self, fingerprints):
+        if not fingerprints:
+            return
+        with self.lock:
+            self._load()
+            for point_key, fields_hash in fingerprints.items():
+                self.entries[point_key] = fields_hash
+                self.entries.move_to_end(point_key)
+            evicted_keys = [self.entries.popitem(last=False)[0] for _ in range(len(self.entries) - self.max_entries)]
+            last_written = time.time()
+            self.store.executemany("INSERT OR REPLACE INTO write_index VALUES (?, ?, ?)", [(point_key, fields_hash, last_written) for point_key, fields_hash in fingerprints.items()])
+            if evicted_keys:
+                self.store.executemany("DELETE FROM write_index WHERE point_key = ?", [(point_key,) for point_key in evicted_keys])
+
+    def clear(self):
+        with self.lock:
+            self._load()
+            self.entries.clear()
+            self.store.execute("DELETE FROM write_index")
+
+write_dedup_index = WriteDedupIndex(StateStore(INFLUXDB_WRITE_DEDUP_DB_FILE_PATH), INFLUXDB_WRITE_DEDUP_MAX_ENTRIES)
+
+# %% [markdown]
+# ## Output sinks and Parquet archive
+
+# %%
+# The point writer hands every batch to all sinks of point_sinks. A sink has write(points), returning False if the batch could not be
+# stored ( the data is then not marked as complete and fetched again ), and flush() to write the points it buffers itself
+class InfluxDBSink:
+    def write(self, points):
+        return write_points_to_influxdb(points)
+
+    def flush(self):
+        return True
+
+point_sinks = [InfluxDBSink()] # main() adds the Parquet archive when ARCHIVE_DIR is set
+
+def write_points_to_sinks(points):
+    success = True
+    for sink in point_sinks:
+        success = sink.write(points) and success
+    return success
+
+def flush_point_sinks():
+    success = True
+    for sink in point_sinks:
+        success = sink.flush() and success
+    return success
+
+# Raw archive of the fetched points, one directory per measurement and UTC date in the hive layout ( measurement=HRV/date=2024-03-01 ) so
+# a partition can be read with pyarrow, pandas or DuckDB, and written back to any InfluxDB version with ARCHIVE_REINGEST. Every file has
+# a "time" column and a column per tag and field, the measurement and the tag columns are stored in the file metadata. A field with both
+# integer and float values is stored as a float column with an "int <field>" column marking the integer values, so every value is written
+# back with its original type ( InfluxDB rejects a field type that differs from the stored one ). Points are
+# buffered and written as large compressed files, so the points buffered when the process is killed are not archived. A partition with
+# more than ARCHIVE_COMPACT_FILES files is merged into one file, which also drops the points that were fetched more than once
+class ParquetArchiveSink:
+    def __init__(self, directory):
+        import pyarrow, pyarrow.parquet # installed with the influxdb 3.x client
+        self.pyarrow, self.parquet = pyarrow, pyarrow.parquet
+        self.directory = directory
+        self.buffer = {} # ( measurement, UTC day number ) -> partition, see add_archive_point
+        self.buffered_points = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, points):
+        with self.lock:
+            for point in map(as_fitbit_point, points):
+                add_archive_point(self.buffer.setdefault((point.measurement, point.timestamp // 86400), {}), point)
+                self.buffered_points += 1
+            if self.buffered_points < ARCHIVE_MAX_BUFFERED_POINTS and time.monotonic() - self.last_flush < ARCHIVE_FLUSH_INTERVAL:
+                return True
+        return self.flush()
+
+    # Partitions that could not be written stay in the buffer for the next flush
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer, self.buffered_points = self.buffer, {}, 0
+            self.last_flush = time.monotonic()
+            write_error = None
+            for (measurement, day), partition in buffer.items():
+                try:
+                    self._write_partition(measurement, datetime.fromtimestamp(day * 86400, pytz.utc).strftime("%Y-%m-%d"), partition)
+                except (OSError, self.pyarrow.ArrowException) as err:
+                    write_error = err
+                    merge_archive_partition(self.buffer.setdefault((measurement, day), {}), partition)
+                    self.buffered_points += sum(len(timestamps) for timestamps, values in partition.values())
+            if write_error is not None and self.buffered_points > 2 * ARCHIVE_MAX_BUFFERED_POINTS:
+                logging.error("Unable to write the Parquet archive in " + self.directory + ", " + str(self.buffered_points) + " points are dropped from it ! " + str(write_error))
+                self.buffer, self.buffered_points = {}, 0
+            elif write_error is not None:
+                logging.error("Unable to write " + str(self.buffered_points) + " points to the Parquet archive in " + self.directory + ", will retry with the next batch ! " + str(write_error))
+            return write_error is None
+
+    def _write_partition(self, measurement, date_str, partition):
+        partition_dir = os.path.join(self.directory, "measurement=" + urllib.parse.quote(measurement, safe=""), "date=" + date_str)
+        os.makedirs(partition_dir, exist_ok=True)
+        compacted_files = sorted(name for name in os.listdir(partition_dir) if name.endswith(".parquet"))
+        if len(compacted_files) < ARCHIVE_COMPACT_FILES:
+            compacted_files = []
+        merged_partition = {}
+        for file_name in compacted_files: # oldest first, so the points fetched last win
+            for point in read_archive_file(os.path.join(partition_dir, file_name)):
+                add_archive_point(merged_partition, point)
+        merge_archive_partition(merged_partition, partition)
+        file_path = os.path.join(partition_dir, "part-" + str(time.time_ns()) + ".parquet")
+        self.parquet.write_table(self._build_table(measurement, merged_partition), file_path + ".tmp", compression=ARCHIVE_COMPRESSION, row_group_size=1048576)
+        os.replace(file_path + ".tmp", file_path)
+        for file_name in compacted_files:
+            os.remove(os.path.join(partition_dir, file_name))
+        metrics.inc("archive_written_points_total", (), sum(len(timestamps) for timestamps, values in partition.values()))
+
+    def _build_table(self, measurement, partition):
+        pyarrow = self.pyarrow
+        field_keys = sorted(set(key for tags, group_field_keys in partition for key in group_field_keys))
+        tag_columns = {("tag " + key if key in field_keys else key): key for key in sorted(set(key for tags, group_field_keys in partition for key, value in tags))}
+        time_values, tag_values, field_values = [], {column: [] for column in tag_columns}, {key: [] for key in field_keys}
+        for (tags, group_field_keys), (timestamps, values) in partition.items():
+            last_indexes = {timestamp: index for index, timestamp in enumerate(timestamps)} # the same point fetched more than once
+            if len(last_indexes) < len(timestamps):
+                kept_indexes = sorted(last_indexes.values())
+                timestamps, values = [timestamps[index] for index in kept_indexes], [[column_values[index] for index in kept_indexes] for column_values in values]
+            time_values += timestamps
+            tags_as_dict, group_fields = dict(tags), dict(zip(group_field_keys, values))
+            for column, key in tag_columns.items():
+                tag_values[column] += [None if tags_as_dict.get(key) is None else str(tags_as_dict[key])] * len(timestamps)
+            for key in field_keys:
+                field_values[key] += group_fields.get(key) or [None] * len(timestamps)
+        columns = {"time": pyarrow.array(time_values, type=pyarrow.timestamp("s", tz="UTC"))}
+        columns.update((column, pyarrow.array(values, type=pyarrow.string())) for column, values in tag_values.items())
+        integer_columns = {}
+        for key, values in field_values.items():
+            if set(type(value) for value in values if value is not None) == {int, float}:
+                integer_columns["int " + key] = key
+                columns["int " + key] = pyarrow.array([None if value is None else type(value) is int for value in values], type=pyarrow.bool_())
+            columns[key] = pyarrow.array(values, type=pyarrow.float64() if "int " + key in integer_columns else None)
+        return pyarrow.table(columns).replace_schema_metadata({"fitbit_fetch_measurement": measurement, "fitbit_fetch_tag_columns": json.dumps(tag_columns), "fitbit_fetch_integer_columns": json.dumps(integer_columns)})
+
+# A buffered archive partition keeps the points column wise, grouped by series : ( tags, field names ) -> ( timestamps, a value list per field )
+def add_archive_point(partition, point):
+    group_field_keys = tuple(point.fields)
+    group = partition.get((point.tags, group_field_keys))
+    if group is None:
+        group = partition[(point.tags, group_field_keys)] = ([], [[] for key in group_field_keys])
+    group[0].append(point.timestamp)
+    for values, value in zip(group[1], point.fields.values()):
+        values.append(value)
+
+def merge_archive_partition(partition, other_partition):
+    for group_key, (timestamps, values) in other_partition.items():
+        group = partition.setdefault(group_key, ([], [[] for key in group_key[1]]))
+        group[0].extend(timestamps)
+        for group_values, other_values in zip(group[1], values):
+            group_values.extend(other_values)
+
+# Reads the points of an archive file back
+def read_archive_file(file_path):
+    import pyarrow, pyarrow.parquet
+    table = pyarrow.parquet.read_table(file_path)
+    measurement = table.schema.metadata[b"fitbit_fetch_measurement"].decode()
+    tag_columns = json.loads(table.schema.metadata[b"fitbit_fetch_tag_columns"])
+    timestamps = table.column("time").cast(pyarrow.timestamp("s", tz="UTC")).cast(pyarrow.int64()).to_pylist() # Parquet stores it in milliseconds
+    integer_columns = json.loads(table.schema.metadata.get(b"fitbit_fetch_integer_columns", b"{}")) # not set in files of older versions
+    tag_values = [(key, table.column(column).to_pylist()) for column, key in tag_columns.items()]
+    field_values = {column: table.column(column).to_pylist() for column in table.column_names if column != "time" and column not in tag_columns and column not in integer_columns}
+    for column, key in integer_columns.items():
+        field_values[key] = [int(value) if is_integer else value for value, is_integer in zip(field_values[key], table.column(column).to_pylist())]
+    field_values = list(field_values.items())
+    shared_tags = {}
+    for index, timestamp in enumerate(timestamps):
+        tags = tuple(sorted((key, values[index]) for key, values in tag_values if values[index] is not None))
+        yield FitbitPoint(measurement, shared_tags.setdefault(tags, tags), {key: values[index] for key, values in field_values if values[index] is not None}, timestamp)
+
+# Archive files of the partitions from start_date_str to end_date_str ( UTC dates ), all measurements
+def list_archive_files(directory, start_date_str, end_date_str):
+    file_paths = []
+    for measurement_dir in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        for date_dir in sorted(os.listdir(os.path.join(directory, measurement_dir))):
+            if date_dir.startswith("date=") and start_date_str <= date_dir[len("date="):] <= end_date_str:
+                partition_dir = os.path.join(directory, measurement_dir, date_dir)
+                file_paths += [os.path.join(partition_dir, file_name) for file_name in sorted(os.listdir(partition_dir)) if file_name.endswith(".parquet")]
+    return file_paths
+
+# Writes the archived points to InfluxDB ( any version ) without a Fitbit API call, e.g. to fill a new database or another version.
+# The write deduplication is bypassed, as the points are most likely missing in the target database
+def reingest_archive(start_date_str, end_date_str):
+    file_paths = list_archive_files(ARCHIVE_DIR, start_date_str, end_date_str)
+    logging.info("Reingesting " + str(len(file_paths)) + " archive files from " + ARCHIVE_DIR + " for " + start_date_str + " to " + end_date_str)
+    reingest_writer = PointWriter(functools.partial(write_points_to_influxdb, use_dedup=False), INFLUXDB_WRITE_BATCH_SIZE, INFLUXDB_FLUSH_INTERVAL, INFLUXDB_MAX_BUFFERED_POINTS, background=INFLUXDB_ASYNC_WRITE)
+    success = True
+    for file_path in file_paths:
+        success = reingest_writer.write(read_archive_file(file_path)) and success
+    success = reingest_writer.flush() and success
+    logging.info(("Success : " if success else "Failed : ") + "Reingested " + str(reingest_writer.points_written) + " archived points")
+    return success
+
+# %% [markdown]
+# ## Streaming point writer
+
+# %%
+# Points are streamed into a bounded buffer and written in batches of INFLUXDB_WRITE_BATCH_SIZE ( or after INFLUXDB_FLUSH_INTERVAL seconds ).
+# The thread adding the point that fills a batch writes it, and producers wait while INFLUXDB_MAX_BUFFERED_POINTS are pending ( backpressure ).
+# In background mode the batches are queued to a dedicated writer thread instead, and write failures are only reported by flush()
+class PointWriter:
+    def __init__(self, write_function, batch_size, flush_interval, max_buffered_points, background=False):
+        self.write_function = write_function
+        self.background = background
+        self.batch_queue = queue.Queue() # bounded by max_buffered_points through the in flight batches
+        self.writer_thread = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered_points = max(max_buffered_points, batch_size)
+        self.buffer = []
+        self.in_flight_batches = {} # batch id -> number of points, for batches being written
+        self.next_batch_id = 0
+        self.last_flush = time.monotonic()
+        self.points_written = 0
+        self.failed_batches = 0
+        self.condition = threading.Condition()
+
+    def _take_batch(self): # must be called with self.condition held
+        batch, self.buffer = self.buffer, []
+        batch_id = self.next_batch_id
+        self.next_batch_id += 1
+        self.in_flight_batches[batch_id] = len(batch)
+        self.last_flush = time.monotonic()
+        return batch_id, batch
+
+    def _submit_batch(self, batch_id, batch):
+        if not self.background:
+            return self._write_batch(batch_id, batch)
+        with self.condition:
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._writer_loop, name="influxdb-writer", daemon=True)
+                self.writer_thread.start()
+        self.batch_queue.put((batch_id, batch))
+        return True
+
+    def _writer_loop(self):
+        while True:
+            batch_id, batch = self.batch_queue.get()
+            try:
+                self._write_batch(batch_id, batch)
+            except Exception as err:
+                logging.error("Background InfluxDB writer failed to write a batch! " + str(err))
+
+    def _write_batch(self, batch_id, batch):
+        success = False
+        try:
+            success = self.write_function(batch)
+        finally:
+            with self.condition:
+                del self.in_flight_batches[batch_id]
+                if success:
+                    self.points_written += len(batch)
+                else:
+                    self.failed_batches += 1
+                self.condition.notify_all()
+        return success
+
+    def add(self, point):
+        with self.condition:
+            if len(self.buffer) + sum(self.in_flight_batches.values()) >= self.max_buffered_points:
+                wait_started = time.perf_counter()
+                while len(self.buffer) + sum(self.in_flight_batches.values()) >= self.max_buffered_points:
+                    self.condition.wait()
+                metrics.observe("point_writer_backpressure_seconds", (), time.perf_counter() - wait_started)
+            self.buffer.append(point)
+            if len(self.buffer) < self.batch_size and time.monotonic() - self.last_flush < self.flush_interval:
+                return True
+            batch_id, batch = self._take_batch()
+        return self._submit_batch(batch_id, batch)
+
+    # Consumes an iterable of points, returns False if any batch written meanwhile failed
+    def write(self, points):
+        success = True
+        for point in points:
+            success = self.add(point) and success
+        return success
+
+    # Writes the buffered points and waits for the batches other threads ( or the background writer ) are still writing.
+    # Returns False if any of these batches failed.
+    def flush(self):
+        with self.condition:
+            failed_batches_before = self.failed_batches
+            batch_id, batch = self._take_batch() if self.buffer else (None, [])
+            pending_batch_ids = set(self.in_flight_batches)
+        success = self._submit_batch(batch_id, batch) if batch else True
+        with self.condition:
+            while pending_batch_ids & set(self.in_flight_batches):
+                self.condition.wait()
+            return success and self.failed_batches == failed_batches_before
+
+point_writer = PointWriter(write_points_to_sinks, INFLUXDB_WRITE_BATCH_SIZE, INFLUXDB_FLUSH_INTERVAL, INFLUXDB_MAX_BUFFERED_POINTS, background=INFLUXDB_ASYNC_WRITE)
+
+# %% [markdown]
+# ## Set Timezone from profile data
+
+# %%
+# "Automatic" timezones are read from the user profile of the account
+def resolve_local_timezone():
+    account = current_account()
+    if account.local_timezone == "Automatic":
+        account.local_timezone = pytz.timezone(request_data_from_fitbit("https://api.fitbit.com/1/user/-/profile.json")["user"]["timezone"])
+    else:
+        account.local_timezone = pytz.timezone(account.local_timezone)
+
+# %% [markdown]
+# ## Selecting Dates for update
+
+# %%
+# Regular updates work on the last days in the local timezone of each account
+def update_working_dates():
+    account = current_account()
+    account.end_date = datetime.now(account.local_timezone)
+    account.start_date = account.end_date - timedelta(days=auto_update_date_range)
+    account.end_date_str = account.end_date.strftime("%Y-%m-%d")
+    account.start_date_str = account.start_date.strftime("%Y-%m-%d")
+
+# Bulk updates work on the given dates, asked for if not set
+def get_manual_date_range():
+    start_date_str = MANUAL_START_DATE or input("Enter start date in YYYY-MM-DD format : ")
+    end_date_str = MANUAL_END_DATE or input("Enter end date in YYYY-MM-DD format : ")
+    return start_date_str, end_date_str
+
+# %% [markdown]
+# ## Concurrent fetch engine
+
+# %%
+# Independent API requests are dispatched to a bounded worker pool of their account. Every worker still goes through the rate limit budget of the
+# account, so parallel requests only use the hourly budget faster and pause together when it runs out. The workers waiting for the budget of an
+# account are its own, so an account without budget left does not hold up the requests of the others
+account_executor = ThreadPoolExecutor(max_workers=ACCOUNT_MAX_WORKERS, thread_name_prefix="fitbit-account") # runs the updates of different accounts side by side
+live_job_executor = ThreadPoolExecutor(max_workers=ACCOUNT_MAX_WORKERS, thread_name_prefix="fitbit-live") # runs the live intraday jobs, never held up by the long account jobs
+service_job_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fitbit-service") # runs the scheduled jobs without an account ( metrics, connection stats )
+
+def is_fetch_worker_thread():
+    return threading.current_thread().name.startswith("fitbit-fetch")
+
+# Runs fetch tasks given as ( function, args ) tuples and yields their points as they arrive. Workers hand over points in chunks
+# through a bounded queue, so a slow consumer ( the writer ) pauses them instead of letting points pile up in memory.
+# Nested calls from a worker thread run inline to avoid waiting on the same pool they are running in.
+def run_fetch_tasks(tasks, chunk_size=1000):
+    if FETCH_MAX_WORKERS <= 1 or len(tasks) <= 1 or is_fetch_worker_thread():
+        for funcname, args in tasks:
+            yield from funcname(*args)
+        return
+    chunk_queue = queue.Queue(maxsize=FETCH_MAX_WORKERS * 2)
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunk_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise InterruptedError("Fetch task cancelled")
+
+    def produce(funcname, args):
+        try:
+            chunk = []
+            for point in funcname(*args):
+                chunk.append(point)
+                if len(chunk) >= chunk_size:
+                    put(("points", chunk))
+                    chunk = []
+            put(("points", chunk))
+            put(("done", None))
+        except InterruptedError:
+            pass
+        except Exception as err:
+            put(("error", err))
+
+    account, fetch_job = current_account(), current_fetch_job()
+    for funcname, args in tasks:
+        account.fetch_executor.submit(run_as_account, account, run_in_fetch_job, fetch_job, produce, funcname, args)
+    try:
+        remaining_tasks = len(tasks)
+        while remaining_tasks > 0:
+            kind, item = chunk_queue.get()
+            if kind == "points":
+                yield from item
+            elif kind == "done":
+                remaining_tasks -= 1
+            else:
+                raise item
+    finally:
+        cancelled.set()
+
+# Runs a function for each args tuple on the worker pool ( in the current account ) and waits for all of them.
+# The main thread runs the scheduled jobs ( metrics ) meanwhile
+def run_on_worker_pool(funcname, args_list, executor):
+    is_main_thread = threading.current_thread() is threading.main_thread()
+    account = getattr(account_context, "account", None)
+    pending = {executor.submit(funcname, *args) if account is None else executor.submit(run_as_account, account, funcname, *args) for args in args_list}
+    while pending:
+        done, pending = wait(pending, timeout=job_scheduler.get_next_run_delay(30))
+        for future in done:
+            future.result()
+        if is_main_thread:
+            run_pending_jobs()
+
+# Adds the account tags to the points when several accounts share the database
+def tag_account_points(points):
+    account_tags = current_account().tags
+    if not account_tags:
+        return points
+    return (add_point_tags(as_fitbit_point(point), account_tags) for point in points)
+
+def add_point_tags(point, extra_tags):
+    return FitbitPoint(point.measurement, merge_point_tags(point.tags, extra_tags), point.fields, point.timestamp)
+
+@functools.lru_cache(maxsize=4096)
+def merge_point_tags(tags, extra_tags):
+    return tuple(sorted(tags + extra_tags))
+
+# Streams the points of a fetch function into the writer as one fetch job, returns False if any write failed
+def fetch_and_write(funcname, *args):
+    return run_fetch_job(lambda : point_writer.write(tag_account_points(funcname(*args))))
+
+# Runs write_points ( returns False if a write failed ) as a new fetch job and flushes the writer. The response cache and TCX archive entries
+# staged by the job are committed if all its points are written, and dropped if a write failed or it raised, so the data is fetched again
+def run_fetch_job(write_points):
+    account = current_account()
+    fetch_job = FetchJob()
+    success = run_in_fetch_job(fetch_job, write_points)
+    success = point_writer.flush() and success
+    if success:
+        account.response_cache.commit(fetch_job.response_hashes)
+        account.tcx_archive.commit(fetch_job.tcx_activities)
+    return success
+
+# %% [markdown]
+# ## Job scheduler
+
+# %%
+# Jobs are kept in a heap ordered by their next run time ( then priority ), and the scheduler thread sleeps exactly until the first one is due.
+# Jobs of an account are queued on one of its job lanes, the others ( metrics, connection stats ) on the service worker, so a write to a database
+# that is down never holds up the dispatch of the account jobs. A job still queued or
+# running when it is due again is not queued a second time, and runs missed while the scheduler was busy ( e.g. a bulk update or a long startup
+# update ) are coalesced into one : the due times stay on the interval grid of the job, only the random jitter is added to every run
+JOB_PRIORITY_HIGH, JOB_PRIORITY_NORMAL, JOB_PRIORITY_LOW = 0, 1, 2
+
+class ScheduledJob:
+    def __init__(self, name, interval, funcname, args, priority, lane):
+        self.name = name
+        self.interval = interval
+        self.funcname = funcname
+        self.args = args
+        self.priority = priority
+        self.lane = lane
+        self.due = time.monotonic() + interval # without the jitter
+        self.next_run = self.due
+        self.active = False # queued or running on its lane ( or the service worker )
+
+class JobScheduler:
+    def __init__(self, max_jitter):
+        self.max_jitter = max_jitter
+        self.heap = [] # ( next_run, priority, sequence, job )
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    # Runs funcname(*args) every interval seconds, the first time one interval from now
+    def every(self, interval, funcname, *args, name=None, priority=JOB_PRIORITY_NORMAL, lane=None):
+        job = ScheduledJob(name or funcname.__name__, interval, funcname, args, priority, lane)
+        self.push(job)
+        return job
+
+    def push(self, job):
+        job.next_run = job.due + random.uniform(0, min(self.max_jitter, job.interval / 10))
+        with self.condition:
+            heapq.heappush(self.heap, (job.next_run, job.priority, next(self.sequence), job))
+            self.condition.notify()
+
+    # Seconds until the next job is due, at most default ( or default if there is no job )
+    def get_next_run_delay(self, default):
+        with self.condition:
+            return max(min(self.heap[0][0] - time.monotonic(), default), 0) if self.heap else default
+
+    # Dispatches the jobs due now, highest priority first
+    def run_pending(self):
+        now = time.monotonic()
+        due_jobs = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                due_jobs.append(heapq.heappop(self.heap)[3])
+        for job in sorted(due_jobs, key=lambda job: job.priority):
+            self.dispatch(job, now)
+
+    def run_forever(self):
+        while True:
+            with self.condition:
+                delay = self.heap[0][0] - time.monotonic() if self.heap else None
+                if delay is None or delay > 0:
+                    self.condition.wait(delay)
+            self.run_pending()
+
+    def dispatch(self, job, now):
+        metrics.observe("scheduler_lag_seconds", (("job", job.name),), now - job.next_run)
+        missed_runs = int((now - job.due) // job.interval)
+        if missed_runs > 0:
+            metrics.inc("scheduler_skipped_runs_total", (("job", job.name), ("reason", "missed")), missed_runs)
+            logging.info("Scheduled job " + job.name + " missed " + str(missed_runs) + " run(s), running it once")
+        job.due += (missed_runs + 1) * job.interval
+        self.push(job)
+        if job.lane is None:
+            if not job.active:
+                job.active = True
+                service_job_executor.submit(run_service_job, job)
+            else:
+                metrics.inc("scheduler_skipped_runs_total", (("job", job.name), ("reason", "overlap")))
+                logging.info("Scheduled job " + job.name + " is still running, skipping this run")
+        elif not job.lane.submit(job):
+            metrics.inc("scheduler_skipped_runs_total", (("job", job.name), ("reason", "overlap")))
+            logging.info("Scheduled job " + job.name + " is still queued or running, skipping this run")
+
+# Errors are logged and do not stop the schedule
+def run_scheduled_job(job):
+    started = time.monotonic()
+    try:
+        job.funcname(*job.args)
+    except Exception as err:
+        logging.error("Scheduled job " + job.name + " failed : " + str(err))
+    metrics.observe("scheduler_job_duration_seconds", (("job", job.name),), time.monotonic() - started)
+
+def run_service_job(job):
+    try:
+        run_scheduled_job(job)
+    finally:
+        job.active = False
+
+# Runs the scheduled jobs of an account one after another on a worker pool, highest priority first, so a slow account ( e.g. waiting for its hourly
+# rate limit ) does not hold up the others. Every account has a "background" lane and a "live" lane for the incremental intraday update, which
+# keeps its own high-water marks instead of the staged response cache and can therefore run next to a long background job of the same account
+class JobLane:
+    def __init__(self, account, executor):
+        self.account = account
+        self.executor = executor
+        self.queued_jobs = [] # ( priority, sequence, queued_at, job )
+        self.sequence = itertools.count()
+        self.running = False
+        self.lock = threading.Lock()
+
+    # Returns False if the job is already queued or running
+    def submit(self, job):
+        with self.lock:
+            if job.active:
+                return False
+            job.active = True
+            heapq.heappush(self.queued_jobs, (job.priority, next(self.sequence), time.monotonic(), job))
+            if self.running:
+                return True
+            self.running = True
+        self.executor.submit(self.run_jobs)
+        return True
+
+    def run_jobs(self):
+        while True:
+            with self.lock:
+                if not self.queued_jobs:
+                    self.running = False
+                    return
+                _, _, queued_at, job = heapq.heappop(self.queued_jobs)
+            metrics.observe("account_job_queue_seconds", (("account", self.account.name),), time.monotonic() - queued_at)
+            try:
+                run_as_account(self.account, update_working_dates)
+                run_as_account(self.account, run_scheduled_job, job)
+            finally:
+                with self.lock:
+                    job.active = False
+
+job_scheduler = JobScheduler(SCHEDULER_MAX_JITTER)
+
+# Runs the due jobs ( metrics ) while the main thread waits for a startup or bulk update
+def run_pending_jobs():
+    job_scheduler.run_pending()
+
+# %% [markdown]
+# ## Intraday rollups
+
+# %%
+# Dashboards covering weeks of 1 second heart rate scan millions of points, so the intraday data is also summarised per minute and per local
+# hour while it is fetched. Measurement -> list of ( bucket seconds, rollup measurement, fields ). A bucket is computed from all the fetched
+# points it contains, the incremental update requests whole hours for this, and a partially complete bucket is simply written again with
+# the same timestamp ( overwriting the previous values ) once more data is fetched
+intraday_rollups = {
+    "HeartRate_Intraday": [(60, "HeartRate_Intraday_1m", ("min", "max", "mean", "count")), (3600, "HeartRate_Intraday_1h", ("min", "max", "mean", "count"))],
+    "Steps_Intraday": [(3600, "Steps_Intraday_1h", ("sum",))],
+    "SPO2_Intraday": [(3600, "SPO2_Intraday_1h", ("min", "max", "mean", "count"))],
+}
+
+# Local times are "HH:MM:SS" ( or "YYYY-MM-DDTHH:MM:SS" when spanning several days ) strings with their UTC epoch timestamps. The points are first reduced to per minute statistics
+# ( min, max, sum, count ) with the C builtins on slices of the sorted times, then the minutes are combined into the configured buckets
+def rollup_intraday_points(measurement_name, tags, local_times, timestamps, values):
+    rollups = intraday_rollups.get(measurement_name)
+    if not INTRADAY_ROLLUPS or not rollups or not values:
+        return
+    if local_times != sorted(local_times):
+        local_times, timestamps, values = map(list, zip(*sorted(zip(local_times, timestamps, values))))
+    minute_stats = []
+    start = 0
+    while start < len(local_times):
+        minute = local_times[start][:-3]
+        end = bisect.bisect_left(local_times, minute + ":60", start)
+        chunk = values[start:end]
+        minute_stats.append((minute, timestamps[start] - int(local_times[start][-2:]), min(chunk), max(chunk), sum(chunk), len(chunk)))
+        start = end
+    for bucket_seconds, rollup_measurement, field_names in rollups:
+        if bucket_seconds == 60:
+            buckets = minute_stats
+        else:
+            buckets = []
+            for hour, group in itertools.groupby(minute_stats, key=lambda stats: stats[0][:-3]):
+                group = list(group)
+                buckets.append((hour, group[0][1] - int(group[0][0][-2:]) * 60, min(stats[2] for stats in group), max(stats[3] for stats in group), sum(stats[4] for stats in group), sum(stats[5] for stats in group)))
+        for _, bucket_start, minimum, maximum, total, count in buckets:
+            fields = {"min": minimum, "max": maximum, "mean": float(total) / count, "count": count, "sum": total}
+            yield FitbitPoint(rollup_measurement, tags, {name: fields[name] for name in field_names}, bucket_start)
+
+# %% [markdown]
+# ## Setting up functions for Requesting data from server
+
+# %%
+# Get last synced battery level of the device
+@instrument_fetcher
+def get_battery_level():
+    account = current_account()
+    devices = request_data_from_fitbit("https://api.fitbit.com/1/user/-/devices.json")
+    device = devices[0] if devices else None
+    if device != None:
+        yield {
+            "measurement": "DeviceBatteryLevel",
+            "time": account.local_timezone.localize(datetime.fromisoformat(device['lastSyncTime'])).astimezone(pytz.utc).isoformat(),
+            "fields": {
+                "value": float(device['batteryLevel'])
+            }
+        }
+        logging.info("Recorded battery level for " + account.device_name)
+    else:
+        logging.error("Recording battery level failed : " + account.device_name)
+
+# For intraday detailed data, max possible range in one day. 
+def get_intraday_data_limit_1d(date_str, measurement_list):
+    yield from run_fetch_tasks([(get_intraday_measurement, (date_str, measurement)) for measurement in measurement_list])
+
+# With a start time ( HH:MM ) only the rest of the day is requested. The time of the last data point is stored in high_water_marks if given.
+# Raw points before raw_start_time are only used for the rollups, they were already written by a previous update. The incremental update does not
+# use the response cache, the high-water marks already tell which data is stored ( and the cache entries are committed by the other jobs )
+@instrument_fetcher
+def get_intraday_measurement(date_str, measurement, start_time=None, high_water_marks=None, raw_start_time=None):
+    account = current_account()
+    time_window = '/time/' + start_time + '/23:59' if start_time else ''
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/' + measurement[0] + '/date/' + date_str + '/1d/' + measurement[2] + time_window + '.json', use_cache=high_water_marks is None)
+    if response is UNCHANGED_RESPONSE:
+        return
+    data = response["activities-" + measurement[0] + "-intraday"]['dataset'] if response != None else None
+    if data != None:
+        device_tags = (("Device", account.device_name),)
+        local_times = [value['time'] for value in data]
+        timestamps = local_times_to_epoch(date_str, local_times, account.local_timezone)
+        values = [int(value['value']) for value in data]
+        for local_time, value, timestamp in zip(local_times, values, timestamps):
+            if raw_start_time is None or local_time >= raw_start_time:
+                yield FitbitPoint(measurement[1], device_tags, {"value": value}, timestamp)
+        yield from rollup_intraday_points(measurement[1], device_tags, local_times, timestamps, values)
+        if high_water_marks is not None and len(data) > 0:
+            high_water_marks[measurement[1]] = data[-1]['time']
+        logging.info("Recorded " +  measurement[1] + " intraday for date " + date_str + (" from " + start_time if start_time else "") + " ( " + str(len(data)) + " points )")
+    else:
+        logging.error("Recording failed : " +  measurement[1] + " intraday for date " + date_str)
+
+# High-water mark : time ( HH:MM:SS ) of the last intraday point stored for a measurement and date, kept in the local state database
+def get_intraday_high_water_mark(date_str, measurement_name):
+    account = current_account()
+    rows = account.state_store.execute("SELECT last_time FROM intraday_high_water_marks WHERE measurement = ? AND date = ?", (measurement_name, date_str))
+    return rows[0][0] if rows else None
+
+# Live update of intraday data : requests only the time window after the high-water mark, minus INTRADAY_OVERLAP_MINUTES as the last minutes may still be incomplete.
+# The marks are moved forward only after all points are written, so a failed update is simply fetched again next time. With the rollups
+# the request starts at the beginning of the hour, so the current hour and minute buckets are computed again from all their points
+def update_intraday_incremental(date_str, measurement_list):
+    account = current_account()
+    high_water_marks = {}
+    tasks = []
+    for measurement in measurement_list:
+        high_water_mark = get_intraday_high_water_mark(date_str, measurement[1])
+        start_time = raw_start_time = None
+        if high_water_mark:
+            start_minute = max(int(high_water_mark[:2]) * 60 + int(high_water_mark[3:5]) - INTRADAY_OVERLAP_MINUTES, 0)
+            raw_start_time = "%02d:%02d" % divmod(start_minute, 60)
+            start_time = "%02d:00" % (start_minute // 60) if INTRADAY_ROLLUPS and measurement[1] in intraday_rollups else raw_start_time
+        tasks.append((get_intraday_measurement, (date_str, measurement, start_time, high_water_marks, raw_start_time)))
+    if run_fetch_job(lambda : point_writer.write(tag_account_points(run_fetch_tasks(tasks)))) and high_water_marks:
+        account.state_store.executemany("INSERT OR REPLACE INTO intraday_high_water_marks VALUES (?, ?, ?)", [(measurement_name, date_str, last_time) for measurement_name, last_time in high_water_marks.items()])
+        account.state_store.execute("DELETE FROM intraday_high_water_marks WHERE date < ?", ((datetime.strptime(date_str, "%Y-%m-%d") - timedelta(days=7)).strftime("%Y-%m-%d"),))
+
+# Max range is 30 days, records BR, SPO2 Intraday, skin temp, HRV and weight - 5 queries
+def get_daily_data_limit_30d(start_date_str, end_date_str):
+    yield from run_fetch_tasks([(funcname, (start_date_str, end_date_str)) for funcname in [get_hrv_data, get_breathing_rate_data, get_skin_temperature_data, get_spo2_intraday_data, get_weight_data]])
+
+@instrument_fetcher
+def get_hrv_data(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/hrv/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    hrv_data_list = response.get('hrv') if response != None else None
+    if hrv_data_list != None:
+        for data in hrv_data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement":  "HRV",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        "dailyRmssd": data["value"]["dailyRmssd"],
+                        "deepRmssd": data["value"]["deepRmssd"]
+                    }
+                }
+        logging.info("Recorded HRV for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed HRV for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_breathing_rate_data(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/br/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    br_data_list = response.get("br") if response != None else None
+    if br_data_list != None:
+        for data in br_data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement":  "BreathingRate",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        "value": data["value"]["breathingRate"]
+                    }
+                }
+        logging.info("Recorded BR for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.warning("Records not found : BR for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_skin_temperature_data(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/temp/skin/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    skin_temp_data_list = response.get("tempSkin") if response != None else None
+    if skin_temp_data_list != None:
+        for temp_record in skin_temp_data_list:
+            log_time = datetime.fromisoformat(temp_record["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement":  "Skin Temperature Variation",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        "RelativeValue": temp_record["value"]["nightlyRelative"]
+                    }
+                }
+        logging.info("Recorded Skin Temperature Variation for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : Skin Temperature Variation for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_spo2_intraday_data(start_date_str, end_date_str):
+    account = current_account()
+    spo2_data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/spo2/date/' + start_date_str + '/' + end_date_str + '/all.json', use_cache=True)
+    if spo2_data_list is UNCHANGED_RESPONSE:
+        return
+    if spo2_data_list != None:
+        device_tags = (("Device", account.device_name),)
+        for days in spo2_data_list:
+            data = days["minutes"]
+            timestamps = local_datetimes_to_epoch([record["minute"] for record in data], account.local_timezone)
+            values = [float(record["value"]) for record in data]
+            for value, timestamp in zip(values, timestamps):
+                yield FitbitPoint("SPO2_Intraday", device_tags, {"value": value}, timestamp)
+            yield from rollup_intraday_points("SPO2_Intraday", device_tags, [record["minute"] for record in data], timestamps, values)
+        logging.info("Recorded SPO2 intraday for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : SPO2 intraday for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_weight_data(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/body/log/weight/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    weight_data_list = response.get("weight") if response != None else None
+    if weight_data_list != None:
+        for entry in weight_data_list:
+            log_time = datetime.fromisoformat(entry["date"] + "T" + entry["time"])
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                "measurement":  "weight",
+                "time": utc_time,
+                "tags": {
+                    "Device": account.device_name
+                },
+                "fields": {
+                    "value": float(entry["weight"]),
+                }
+            }
+            yield {
+                "measurement":  "bmi",
+                "time": utc_time,
+                "tags": {
+                    "Device": account.device_name
+                },
+                "fields": {
+                    "value": float(entry["bmi"]),
+                }
+            }
+        logging.info("Recorded weight and BMI for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : weight and BMI for date " + start_date_str + " to " + end_date_str)
+
+# Only for sleep data - limit 100 days - 1 query
+@instrument_fetcher
+def get_daily_data_limit_100d(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1.2/user/-/sleep/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    sleep_data = response.get("sleep") if response != None else None
+    if sleep_data != None:
+        for record in sleep_data:
+            log_time = datetime.fromisoformat(record["startTime"])
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            try:
+                minutesLight= record['levels']['summary']['light']['minutes']
+                minutesREM = record['levels']['summary']['rem']['minutes']
+                minutesDeep = record['levels']['summary']['deep']['minutes']
+            except:
+                minutesLight= record['levels']['summary']['asleep']['minutes']
+                minutesREM = record['levels']['summary']['restless']['minutes']
+                minutesDeep = 0
+
+            yield {
+                    "measurement":  "Sleep Summary",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name,
+                        "isMainSleep": record["isMainSleep"],
+                    },
+                    "fields": {
+                        'efficiency': record["efficiency"],
+                        'minutesAfterWakeup': record['minutesAfterWakeup'],
+                        'minutesAsleep': record['minutesAsleep'],
+                        'minutesToFallAsleep': record['minutesToFallAsleep'],
+                        'minutesInBed': record['timeInBed'],
+                        'minutesAwake': record['minutesAwake'],
+                        'minutesLight': minutesLight,
+                        'minutesREM': minutesREM,
+                        'minutesDeep': minutesDeep
+                    }
+                }
+            
+            sleep_level_mapping = {'wake': 3, 'rem': 2, 'light': 1, 'deep': 0, 'asleep': 1, 'restless': 2, 'awake': 3, 'unknown': 4}
+            for sleep_stage in record['levels']['data']:
+                log_time = datetime.fromisoformat(sleep_stage["dateTime"])
+                utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+                yield {
+                        "measurement":  "Sleep Levels",
+                        "time": utc_time,
+                        "tags": {
+                            "Device": account.device_name,
+                            "isMainSleep": record["isMainSleep"],
+                        },
+                        "fields": {
+                            'level': sleep_level_mapping[sleep_stage["level"]],
+                            'duration_seconds': sleep_stage["seconds"]
+                        }
+                    }
+            wake_time = datetime.fromisoformat(record["endTime"])
+            utc_wake_time = account.local_timezone.localize(wake_time).astimezone(pytz.utc).isoformat()
+            yield {
+                        "measurement":  "Sleep Levels",
+                        "time": utc_wake_time,
+                        "tags": {
+                            "Device": account.device_name,
+                            "isMainSleep": record["isMainSleep"],
+                        },
+                        "fields": {
+                            'level': sleep_level_mapping['wake'],
+                            'duration_seconds': None
+                        }
+                    }
+        logging.info("Recorded Sleep data for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : Sleep data for date " + start_date_str + " to " + end_date_str)
+
+# Max date range 1 year, records HR zones, Activity minutes and Resting HR - 4 + 3 + 1 + 1 = 9 queries
+def get_daily_data_limit_365d(start_date_str, end_date_str):
+    activity_minutes_list = ["minutesSedentary", "minutesLightlyActive", "minutesFairlyActive", "minutesVeryActive"]
+    activity_others_list = ["distance", "calories", "steps"]
+    tasks = [(get_activity_minutes_data, (activity_type, start_date_str, end_date_str)) for activity_type in activity_minutes_list]
+    tasks += [(get_activity_others_data, (activity_type, start_date_str, end_date_str)) for activity_type in activity_others_list]
+    tasks.append((get_hr_zones_data, (start_date_str, end_date_str)))
+    yield from run_fetch_tasks(tasks)
+
+@instrument_fetcher
+def get_activity_minutes_data(activity_type, start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    activity_minutes_data_list = response.get("activities-tracker-"+activity_type) if response != None else None
+    if activity_minutes_data_list != None:
+        for data in activity_minutes_data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement": "Activity Minutes",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        activity_type : int(data["value"])
+                    }
+                }
+        logging.info("Recorded " + activity_type + "for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : " + activity_type + " for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_activity_others_data(activity_type, start_date_str, end_date_str):
+    account = current_account()
+    activity_name = "Total Steps" if activity_type == "steps" else activity_type
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/' + activity_type + '/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    activity_others_data_list = response.get("activities-tracker-"+activity_type) if response != None else None
+    if activity_others_data_list != None:
+        for data in activity_others_data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement": activity_name,
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        "value" : float(data["value"])
+                    }
+                }
+        logging.info("Recorded " + activity_name + " for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : " + activity_name + " for date " + start_date_str + " to " + end_date_str)
+
+@instrument_fetcher
+def get_hr_zones_data(start_date_str, end_date_str):
+    account = current_account()
+    response = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/heart/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if response is UNCHANGED_RESPONSE:
+        return
+    HR_zones_data_list = response.get("activities-heart") if response != None else None
+    if HR_zones_data_list != None:
+        for data in HR_zones_data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement": "HR zones",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    # Using get() method with a default value 0 to prevent keyerror ( see issue #31)
+                    "fields": {
+                        "Normal" : data["value"]["heartRateZones"][0].get("minutes", 0),
+                        "Fat Burn" :  data["value"]["heartRateZones"][1].get("minutes", 0),
+                        "Cardio" :  data["value"]["heartRateZones"][2].get("minutes", 0),
+                        "Peak" :  data["value"]["heartRateZones"][3].get("minutes", 0)
+                    }
+                }
+            if "restingHeartRate" in data["value"]:
+                yield {
+                            "measurement":  "RestingHR",
+                            "time": utc_time,
+                            "tags": {
+                                "Device": account.device_name
+                            },
+                            "fields": {
+                                "value": data["value"]["restingHeartRate"]
+                            }
+                        }
+        logging.info("Recorded RHR and HR zones for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : RHR and HR zones for date " + start_date_str + " to " + end_date_str)
+
+# records SPO2 single days for the whole given period - 1 query
+@instrument_fetcher
+def get_daily_data_limit_none(start_date_str, end_date_str):
+    account = current_account()
+    data_list = request_data_from_fitbit('https://api.fitbit.com/1/user/-/spo2/date/' + start_date_str + '/' + end_date_str + '.json', use_cache=True)
+    if data_list is UNCHANGED_RESPONSE:
+        return
+    if data_list != None:
+        for data in data_list:
+            log_time = datetime.fromisoformat(data["dateTime"] + "T" + "00:00:00")
+            utc_time = account.local_timezone.localize(log_time).astimezone(pytz.utc).isoformat()
+            yield {
+                    "measurement":  "SPO2",
+                    "time": utc_time,
+                    "tags": {
+                        "Device": account.device_name
+                    },
+                    "fields": {
+                        "avg": data["value"]["avg"],
+                        "max": data["value"]["max"],
+                        "min": data["value"]["min"]
+                    }
+                }
+        logging.info("Recorded Avg SPO2 for date " + start_date_str + " to " + end_date_str)
+    else:
+        logging.error("Recording failed : Avg SPO2 for date " + start_date_str + " to " + end_date_str)
+
+# fetches TCX GPS data. The response body is streamed into the TCX archive and parsed from there, so it is never loaded at once
+@instrument_fetcher
+def get_tcx_data(tcx_url, ActivityID, log_id=None):
+    account = current_account()
+    tcx_headers = {
+        "Authorization": "Bearer " + account.token_manager.get_access_token(),
+        "Accept": "application/x-www-form-urlencoded"
+    }
+    tcx_params = {
+            'includePartialTCX': 'false'
+        }
+    response = request_data_from_fitbit(tcx_url, headers=tcx_headers, params=tcx_params, stream=True)
+    if response == None:
+        logging.error("Error fetching TCX file : request skipped for " + tcx_url)
+    elif response.status_code != 200:
+        logging.error(f"Error fetching TCX file: {response.status_code}, {response.text}")
+    else:
+        with response:
+            file_path, content_hash = account.tcx_archive.archive_response(response)
+        with gzip.open(file_path, "rb") as file:
+            yield from parse_tcx_trackpoints(file, ActivityID)
+        account.tcx_archive.stage(ActivityID, log_id, content_hash)
+
+# Errors of a single GPS activity are logged and do not stop the other downloads
+def ingest_tcx_activity(tcx_link, ActivityID, log_id):
+    try:
+        yield from get_tcx_data(tcx_link, ActivityID, log_id)
+        logging.info("Recorded TCX GPS data for " + tcx_link)
+    except Exception as tcx_exception:
+        logging.error("Failed to get GPS Data for " + tcx_link + " : " + str(tcx_exception))
+
+# Yields the Activity Records points, then downloads the GPS data of the activities not ingested yet ( at most tcx_download_limit, None for all ) in parallel
+def process_activities(activities, tcx_download_limit=None):
+    account = current_account()
+    tcx_tasks = []
+    for activity in activities:
+        fields = {}
+        if 'activeDuration' in activity:
+            fields['ActiveDuration'] = int(activity['activeDuration'])
+        if 'averageHeartRate' in activity:
+            fields['AverageHeartRate'] = int(activity['averageHeartRate'])
+        if 'calories' in activity:
+            fields['calories'] = int(activity['calories'])
+        if 'duration' in activity:
+            fields['duration'] = int(activity['duration'])
+        if 'distance' in activity:
+            fields['distance'] = float(activity['distance'])
+        if 'steps' in activity:
+            fields['steps'] = int(activity['steps'])
+        starttime = datetime.fromisoformat(activity['startTime'].strip("Z"))
+        utc_time = starttime.astimezone(pytz.utc).isoformat()
+        try:
+            extracted_activity_name = activity['activityName']
+        except KeyError as MissingKeyError:
+            extracted_activity_name = "Unknown-Activity"
+        ActivityID = utc_time + "-" + extracted_activity_name
+        yield {
+            "measurement": "Activity Records",
+            "time": utc_time,
+            "tags": {
+                "ActivityName": extracted_activity_name
+            },
+            "fields": fields
+        }
+        tcx_link = activity.get("tcxLink", False) if activity.get("hasGps", False) else False
+        if tcx_link and (tcx_download_limit is None or len(tcx_tasks) < tcx_download_limit):
+            if account.tcx_archive.is_ingested(ActivityID):
+                logging.debug("Skipping TCX GPS data for " + ActivityID + " : already ingested")
+            else:
+                tcx_tasks.append((ingest_tcx_activity, (tcx_link, ActivityID, str(activity.get("logId", "")))))
+    yield from run_fetch_tasks(tcx_tasks)
+
+# Fetches latest activities from record ( upto last 50 )
+def fetch_latest_activities(end_date_str):
+    next_end_date_str = (datetime.strptime(end_date_str, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    recent_activities_data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/list.json', params={'beforeDate': next_end_date_str, 'sort':'desc', 'limit':50, 'offset':0})
+    if recent_activities_data != None:
+        yield from process_activities(recent_activities_data['activities'], TCX_DOWNLOAD_LIMIT)
+        logging.info("Fetched 50 recent activities before date " + end_date_str)
+    else:
+        logging.error("Fetching 50 recent activities failed : before date " + end_date_str)
+
+# Fetches all activities in the date range ( bulk update ), paging through the activity list 100 at a time
+def fetch_all_activities(start_date_str, end_date_str):
+    after_date_str = (datetime.strptime(start_date_str, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+    offset, activity_count = 0, 0
+    while True:
+        activities_data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/list.json', params={'afterDate': after_date_str, 'sort':'asc', 'limit':100, 'offset':offset})
+        if activities_data == None:
+            logging.error("Fetching activities failed : for date " + start_date_str + " to " + end_date_str + " at offset " + str(offset))
+            return
+        page = activities_data['activities']
+        activities = [activity for activity in page if start_date_str <= activity['startTime'][:10] <= end_date_str]
+        activity_count += len(activities)
+        yield from process_activities(activities)
+        if len(page) == 0 or activities_data.get('pagination', {}).get('next', '') == '' or page[-1]['startTime'][:10] > end_date_str:
+            break
+        offset += len(page)
+    logging.info("Fetched " + str(activity_count) + " activities for date " + start_date_str + " to " + end_date_str)
+
+# %% [markdown]
+# ## Call the functions one time as a startup update OR do switch to bulk update mode
+
+# %%
+def run_startup_update():
+    account = current_account()
+    date_list = [(account.start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((account.end_date - account.start_date).days + 1)]
+    if len(date_list) > 3:
+        logging.warn("Auto schedule update is not meant for more than 3 days at a time, please consider lowering the auto_update_date_range variable to aviod rate limit hit!")
+    startup_tasks = [(get_intraday_data_limit_1d, (date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')])) for date_str in date_list] # 2 queries x number of dates ( default 2)
+    startup_tasks += [
+        (get_daily_data_limit_30d, (account.start_date_str, account.end_date_str)), # 5 queries
+        (get_daily_data_limit_100d, (account.start_date_str, account.end_date_str)), # 1 query
+        (get_daily_data_limit_365d, (account.start_date_str, account.end_date_str)), # 8 queries
+        (get_daily_data_limit_none, (account.start_date_str, account.end_date_str)), # 1 query
+        (get_battery_level, ()), # 1 query
+        (fetch_latest_activities, (account.end_date_str,)) # 1 query
+    ]
+    run_fetch_job(lambda : point_writer.write(tag_account_points(run_fetch_tasks(startup_tasks))))
+
+# Do Bulk update----------------------------------------------------------------------------------------------------------------------------
+
+def yield_dates_with_gap(date_list, gap):
+    start_index = -1*gap
+    while start_index < len(date_list)-1:
+        start_index  = start_index + gap
+        end_index = start_index+gap
+        if end_index > len(date_list) - 1:
+            end_index = len(date_list) - 1
+        if start_index > len(date_list) - 1:
+            break
+        yield (date_list[start_index],date_list[end_index])
+
+# Journal key of a bulk update unit : function name ( with intraday measurement names ) and the date window
+def bulk_unit_key(funcname, args):
+    dates = [arg for arg in args if isinstance(arg, str)]
+    measurements = [measurement[0] for arg in args if isinstance(arg, list) for measurement in arg]
+    endpoint = funcname.__name__ + (":" + ",".join(measurements) if measurements else "")
+    return endpoint, dates[0], dates[-1]
+
+# Returns False if requests of the unit were skipped
+def do_bulk_update(funcname, *args):
+    account = current_account()
+    unit_key = bulk_unit_key(funcname, args)
+    if account.state_store.execute("SELECT 1 FROM bulk_journal WHERE endpoint = ? AND start_date = ? AND end_date = ?", unit_key):
+        logging.info("Skipping " + unit_key[0] + " for " + unit_key[1] + " to " + unit_key[2] + " : already completed in a previous run")
+        return True
+    skipped_requests_before, failed_batches_before = get_skipped_request_count(), point_writer.failed_batches
+    write_success = fetch_and_write(funcname, *args)
+    logging.debug("Rate limit budget status : " + str(account.rate_limit_budget.status()))
+    # Data for today may still change, so only past windows fetched and written without errors are marked as complete
+    if write_success and get_skipped_request_count() == skipped_requests_before and point_writer.failed_batches == failed_batches_before and unit_key[2] < datetime.now(account.local_timezone).strftime("%Y-%m-%d"):
+        account.state_store.execute("INSERT OR REPLACE INTO bulk_journal VALUES (?, ?, ?, ?)", unit_key + (datetime.now(pytz.utc).isoformat(),))
+    return get_skipped_request_count() == skipped_requests_before
+
+# Days with a tracker step count above zero, one call per 360 days. Days without steps had no device worn, so they have no intraday data either
+def probe_active_days(date_list):
+    active_days = set()
+    for date_range in yield_dates_with_gap(date_list, 360):
+        steps_data = request_data_from_fitbit('https://api.fitbit.com/1/user/-/activities/tracker/steps/date/' + date_range[0] + '/' + date_range[1] + '.json')
+        if steps_data == None:
+            active_days.update(single_day for single_day in date_list if date_range[0] <= single_day <= date_range[1]) # probe failed, fetch everything
+        else:
+            active_days.update(data["dateTime"] for data in steps_data["activities-tracker-steps"] if float(data["value"]) > 0)
+    return active_days
+
+bulk_call_costs = {fetch_all_activities: 1, get_daily_data_limit_none: 1, get_daily_data_limit_365d: 8, get_daily_data_limit_100d: 1, get_daily_data_limit_30d: 5, get_intraday_data_limit_1d: 2} # API calls per unit ( activities : per list page, without the GPS files )
+
+# Full list of ( funcname, args ) units, ordered by days covered per API call : the cheap summaries make the dashboards usable first,
+# then the intraday days from the most recent one. Units completed in a previous run are left out
+def build_bulk_plan(date_list, active_days):
+    plan = [(fetch_all_activities, (date_list[0], date_list[-1])), (get_daily_data_limit_none, (date_list[0], date_list[-1]))]
+    plan += [(get_daily_data_limit_365d, date_range) for date_range in yield_dates_with_gap(date_list, 360)]
+    plan += [(get_daily_data_limit_100d, date_range) for date_range in yield_dates_with_gap(date_list, 98)]
+    plan += [(get_daily_data_limit_30d, date_range) for date_range in yield_dates_with_gap(date_list, 28)] # always whole windows : weight, HRV, breathing rate and SpO2 do not need tracker steps
+    plan += [(get_intraday_data_limit_1d, (single_day, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')])) for single_day in reversed(date_list) if single_day in active_days]
+    return [(funcname, args) for funcname, args in plan if not current_account().state_store.execute("SELECT 1 FROM bulk_journal WHERE endpoint = ? AND start_date = ? AND end_date = ?", bulk_unit_key(funcname, args))]
+
+# The probe calls are part of the total, they are already taken from the budget when the estimate is made ( unless in a dry run, which does not probe )
+def describe_bulk_plan(date_list, plan, skipped_days, probe_calls):
+    account = current_account()
+    lines = ["Bulk update plan for " + date_list[0] + " to " + date_list[-1] + " :"]
+    if probe_calls:
+        lines.append("  %-28s %5d requests %6d API calls   %s to %s" % (probe_active_days.__name__, probe_calls, probe_calls, date_list[0], date_list[-1]))
+    for funcname in bulk_call_costs:
+        units = [args for unit_funcname, args in plan if unit_funcname == funcname]
+        if units:
+            unit_dates = [arg for args in units for arg in args if isinstance(arg, str)]
+            lines.append("  %-28s %5d requests %6d API calls   %s to %s" % (funcname.__name__, len(units), len(units) * bulk_call_costs[funcname], min(unit_dates), max(unit_dates)))
+    plan_calls = sum(bulk_call_costs[funcname] for funcname, args in plan)
+    total_calls = probe_calls + plan_calls
+    if BULK_DRY_RUN and probe_calls:
+        lines.append("  Days without tracker data are not probed in a dry run, the intraday requests of those days are left out of the real run")
+    else:
+        lines.append("  " + str(skipped_days) + " days without tracker data skipped for the intraday requests")
+    estimated_completion = datetime.now(account.local_timezone) + timedelta(seconds=account.rate_limit_budget.estimate_seconds_for(total_calls if BULK_DRY_RUN else plan_calls))
+    lines.append("Total " + str(total_calls) + " API calls ( plus the GPS files ), estimated completion at the earliest " + estimated_completion.strftime("%Y-%m-%d %H:%M") + " with " + str(RATE_LIMIT_CALLS_PER_HOUR - RATE_LIMIT_RESERVED_CALLS) + " calls per hour")
+    return "\n".join(lines)
+
+# Done units per phase of a running bulk update, logged every BULK_PROGRESS_INTERVAL seconds and whenever a phase completes. The calls of the
+# active day probe count as done from the start ( started is the time.monotonic() value before the probe )
+class BulkProgress:
+    def __init__(self, plan, probe_calls, started):
+        self.phases = {} # fetch function -> [done units, total units], in plan order
+        for funcname, args in plan:
+            self.phases.setdefault(funcname, [0, 0])[1] += 1
+        self.total_calls = probe_calls + sum(bulk_call_costs[funcname] for funcname, args in plan)
+        self.done_calls = probe_calls
+        self.started = started
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def complete(self, funcname):
+        account = current_account()
+        with self.lock:
+            phase = self.phases[funcname]
+            phase[0] += 1
+            self.done_calls += bulk_call_costs[funcname]
+            metrics.set("bulk_remaining_units", (("account", account.name), ("phase", funcname.__name__)), phase[1] - phase[0])
+            if phase[0] < phase[1] and time.monotonic() - self.last_report < BULK_PROGRESS_INTERVAL:
+                return
+            self.last_report = time.monotonic()
+            remaining_seconds = self.estimate_remaining_seconds()
+            metrics.set("bulk_estimated_remaining_seconds", (("account", account.name),), remaining_seconds)
+            estimated_completion = datetime.now(account.local_timezone) + timedelta(seconds=remaining_seconds)
+            phase_progress = ", ".join(phase_funcname.__name__ + " " + str(done) + "/" + str(total) for phase_funcname, (done, total) in self.phases.items())
+            logging.info("Bulk update progress : " + str(self.done_calls * 100 // max(self.total_calls, 1)) + " % of " + str(self.total_calls) + " API calls, estimated completion at " + estimated_completion.strftime("%Y-%m-%d %H:%M") + " ( " + phase_progress + " )")
+
+    # The slower of the remaining hourly budget and the pace so far, which includes the time spent waiting for the rate limit. Called with self.lock held
+    def estimate_remaining_seconds(self):
+        remaining_calls = self.total_calls - self.done_calls
+        elapsed_pace_seconds = (time.monotonic() - self.started) / self.done_calls * remaining_calls if self.done_calls else 0
+        return max(current_account().rate_limit_budget.estimate_seconds_for(remaining_calls), elapsed_pace_seconds)
+
+# Runs the plan of the current account as one work queue in plan order ( its priority order ), with up to FETCH_MAX_WORKERS units in flight on
+# the fetch workers of the account ( the bulk updates of the other accounts have their own ). A phase does not wait for the slowest unit of the
+# previous one, and all units take their requests from the hourly budget of the account.
+# Units with skipped requests ( server errors, open circuit breaker ) are put in a retry queue, which runs again once the plan is done, up to
+# BULK_RETRY_ROUNDS times, when the open circuits let a trial request through and at least after the next step of the request backoff.
+# Returns False if units are still incomplete
+def run_bulk_plan(bulk_plan, progress):
+    account = current_account()
+    retry_queue = run_bulk_units(bulk_plan, progress)
+    for retry_round in range(BULK_RETRY_ROUNDS):
+        if not retry_queue:
+            return True
+        metrics.inc("bulk_retry_units_total", (("account", account.name), ("result", "queued")), len(retry_queue))
+        retry_delay = get_retry_delay(SERVER_ERROR_MAX_RETRY + retry_round, endpoint_circuit_breaker.seconds_until_trial())
+        logging.info("Retrying " + str(len(retry_queue)) + " bulk update units with skipped requests in " + str(int(retry_delay)) + " seconds ( round " + str(retry_round + 1) + " of " + str(BULK_RETRY_ROUNDS) + " )")
+        time.sleep(retry_delay)
+        queued_units = len(retry_queue)
+        retry_queue = run_bulk_units(retry_queue)
+        metrics.inc("bulk_retry_units_total", (("account", account.name), ("result", "completed")), queued_units - len(retry_queue))
+    if retry_queue:
+        metrics.inc("bulk_retry_units_total", (("account", account.name), ("result", "given_up")), len(retry_queue))
+        logging.warning("Bulk update incomplete, requests were skipped for " + ", ".join(bulk_unit_key(funcname, args)[0] + " " + bulk_unit_key(funcname, args)[1] for funcname, args in retry_queue) + ". Run the same bulk update again to fetch them")
+    return not retry_queue
+
+# Runs the units and returns the ones with skipped requests
+def run_bulk_units(units, progress=None):
+    account = current_account()
+    failed_units = []
+
+    def complete(funcname, args, fetched):
+        if not fetched:
+            failed_units.append((funcname, args))
+        if progress is not None:
+            progress.complete(funcname)
+
+    if FETCH_MAX_WORKERS <= 1:
+        for funcname, args in units:
+            complete(funcname, args, do_bulk_update(funcname, *args))
+        return failed_units
+    pending_units = iter(units)
+    in_flight = {}
+    while True:
+        for funcname, args in itertools.islice(pending_units, FETCH_MAX_WORKERS - len(in_flight)):
+            in_flight[account.fetch_executor.submit(run_as_account, account, do_bulk_update, funcname, *args)] = (funcname, args)
+        if not in_flight:
+            return failed_units
+        done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            funcname, args = in_flight.pop(future)
+            complete(funcname, args, future.result())
+
+# Plans and runs the bulk update of the current account, the accounts run side by side as each one has its own rate limit
+def run_bulk_update(start_date_str, end_date_str):
+    account = current_account()
+    start_date, end_date = datetime.strptime(start_date_str, "%Y-%m-%d"), datetime.strptime(end_date_str, "%Y-%m-%d")
+    date_list = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((end_date - start_date).days + 1)]
+    account.state_store.execute("CREATE TABLE IF NOT EXISTS bulk_journal (endpoint TEXT, start_date TEXT, end_date TEXT, completed_at TEXT, PRIMARY KEY (endpoint, start_date, end_date))")
+    if not BULK_RESUME:
+        account.state_store.execute("DELETE FROM bulk_journal")
+        account.response_cache.clear()
+    started = time.monotonic()
+    active_days = probe_active_days(date_list) if BULK_SKIP_EMPTY_DAYS and not BULK_DRY_RUN else set(date_list) # the dry run does not probe, every day counts as active
+    probe_calls = len(list(yield_dates_with_gap(date_list, 360))) if BULK_SKIP_EMPTY_DAYS else 0 # one per window, see probe_active_days
+    bulk_plan = build_bulk_plan(date_list, active_days)
+    logging.info(describe_bulk_plan(date_list, bulk_plan, len(set(date_list) - active_days), probe_calls))
+    if BULK_DRY_RUN:
+        return
+    if run_bulk_plan(bulk_plan, BulkProgress(bulk_plan, probe_calls, started)):
+        logging.info("Success : Bulk update complete for " + start_date_str + " to " + end_date_str)
+
+# %% [markdown]
+# ## Subscription notifications
+
+# %%
+# Fitbit notifies the subscriber endpoint when a device sync or a manual log changes the data of a collection, with the date that changed. The
+# receiver answers at once ( Fitbit expects a response within 5 seconds ) and queues fetches of only that collection and date on the job lanes of
+# the account, the polling of the same data is kept as a less frequent fallback ( SUBSCRIBER_POLL_INTERVAL_FACTOR ). Subscriptions are created at
+# startup with the ID "<account name>-<collection>", which is how notifications are matched to the accounts
+subscription_fetches = {
+    "activities": [
+        ("live", lambda date_str : update_intraday_incremental(date_str, [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')])),
+        ("background", lambda date_str : fetch_and_write(get_daily_data_limit_365d, date_str, date_str)),
+        ("background", lambda date_str : fetch_and_write(fetch_latest_activities, date_str)),
+    ],
+    "body": [("background", lambda date_str : fetch_and_write(get_weight_data, date_str, date_str))],
+    "sleep": [("background", lambda date_str : fetch_and_write(get_daily_data_limit_100d, date_str, date_str))],
+}
+notification_lock = threading.Lock()
+
+# Existing subscriptions with the same ID are kept ( 200 ), a conflict ( 409 ) means the collection is subscribed with another ID or subscriber
+def create_fitbit_subscriptions():
+    account = current_account()
+    headers = {"Authorization": "Bearer " + account.token_manager.get_access_token(), "Accept": "application/json"}
+    if SUBSCRIBER_ID:
+        headers["X-Fitbit-Subscriber-Id"] = SUBSCRIBER_ID
+    for collection in subscription_fetches:
+        subscription_id = account.name + "-" + collection
+        try:
+            if request_data_from_fitbit("https://api.fitbit.com/1/user/-/" + collection + "/apiSubscriptions/" + subscription_id + ".json", headers=headers, request_type="post") is not None:
+                logging.info("Subscribed to Fitbit " + collection + " notifications with ID " + subscription_id)
+        except requests.exceptions.HTTPError as err:
+            logging.warning("Creating the Fitbit " + collection + " subscription " + subscription_id + " failed, this data is only polled : " + str(err))
+
+# The collection is cut off the end, as account names may contain "-" themselves
+def get_subscription_account(subscription_id):
+    account_name, _, collection = subscription_id.rpartition("-")
+    for account in fitbit_accounts:
+        if account.name == account_name and collection in subscription_fetches:
+            return account
+    return fitbit_accounts[0] if len(fitbit_accounts) == 1 else None # subscription created by another tool
+
+# Fitbit signs the body with HMAC-SHA1, the key is the client secret of the application followed by "&"
+def is_valid_notification_signature(body, signature):
+    for secret in set(account.client_secret for account in fitbit_accounts):
+        expected = base64.b64encode(hmac.new((secret + "&").encode(), body, hashlib.sha1).digest()).decode()
+        if hmac.compare_digest(expected, signature or ""):
+            return True
+    return False
+
+# Returns the metric result of the notification. A fetch already waiting for the same date is not queued again
+def queue_notification_fetches(notification):
+    account = get_subscription_account(str(notification.get("subscriptionId", "")))
+    collection, date_str = notification.get("collectionType"), str(notification.get("date"))
+    if account is None:
+        return "unknown_subscription"
+    if collection not in subscription_fetches or not re.fullmatch(r"\d{4}-\d{2}-\d{2}", date_str):
+        logging.warning("Ignoring Fitbit notification : " + json.dumps(notification))
+        return "invalid"
+    result = "duplicate"
+    for fetch_index, (lane_name, funcname) in enumerate(subscription_fetches[collection]):
+        with notification_lock:
+            if (collection, fetch_index, date_str) in account.pending_notifications:
+                continue
+            account.pending_notifications.add((collection, fetch_index, date_str))
+        job = ScheduledJob("notification_" + collection, 0, run_notification_fetch, (collection, fetch_index, date_str, funcname), JOB_PRIORITY_HIGH, account.job_lanes[lane_name])
+        job.lane.submit(job)
+        result = "queued"
+    return result
+
+# Notified data is requested again even if the response cache has a recent entry for it
+def run_notification_fetch(collection, fetch_index, date_str, funcname):
+    account = current_account()
+    with notification_lock:
+        account.pending_notifications.discard((collection, fetch_index, date_str))
+    logging.info("Fetching " + collection + " data for date " + date_str + " ( subscription notification )")
+    account.response_cache.forget("/date/" + date_str + "/" + date_str + ".json")
+    funcname(date_str)
+
+class SubscriptionRequestHandler(BaseHTTPRequestHandler):
+    # Endpoint verification : 204 for the right code, 404 otherwise
+    def do_GET(self):
+        verify_code = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get("verify", [None])[0]
+        self.send_empty_response(204 if SUBSCRIBER_VERIFICATION_CODE and verify_code == SUBSCRIBER_VERIFICATION_CODE else 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not is_valid_notification_signature(body, self.headers.get("X-Fitbit-Signature")):
+            logging.warning("Fitbit notification with an invalid signature from " + self.client_address[0])
+            metrics.inc("fitbit_notifications_total", (("collection", ""), ("result", "invalid")))
+            return self.send_empty_response(404)
+        self.send_empty_response(204)
+        try:
+            notifications = json.loads(body)
+        except ValueError:
+            notifications = None
+        if not isinstance(notifications, list) or not all(isinstance(notification, dict) for notification in notifications):
+            logging.warning("Ignoring Fitbit notification body : " + body.decode(errors="replace"))
+            return
+        for notification in notifications:
+            metrics.inc("fitbit_notifications_total", (("collection", str(notification.get("collectionType", ""))), ("result", queue_notification_fetches(notification))))
+
+    def send_empty_response(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Subscriber endpoint : " + format % args)
+
+def start_subscription_receiver():
+    subscription_server = ThreadingHTTPServer(("", SUBSCRIBER_PORT), SubscriptionRequestHandler)
+    subscription_server.daemon_threads = True
+    threading.Thread(target=subscription_server.serve_forever, name="subscription-receiver", daemon=True).start()
+    logging.info("Receiving Fitbit subscription notifications on port " + str(SUBSCRIBER_PORT))
+
+# %% [markdown]
+# ## Schedule functions at specific intervals (Ongoing continuous update)
+
+# %%
+# Jobs of one account, they are queued on its job lanes so the scheduler thread only keeps time. The working dates are updated before every job
+def schedule_account_updates(account):
+    account.state_store.execute("CREATE TABLE IF NOT EXISTS intraday_high_water_marks (measurement TEXT, date TEXT, last_time TEXT, PRIMARY KEY (measurement, date))")
+    intraday_measurements = [('heart','HeartRate_Intraday','1sec'),('steps','Steps_Intraday','1min')]
+    live_lane, background_lane = account.job_lanes["live"], account.job_lanes["background"]
+    fallback = SUBSCRIBER_POLL_INTERVAL_FACTOR if SUBSCRIBER_PORT > 0 else 1 # the data of the subscribed collections is fetched when notified
+    if INTRADAY_INCREMENTAL:
+        job_scheduler.every(3 * 60 * fallback, lambda : update_intraday_incremental(account.end_date_str, intraday_measurements), name="intraday_incremental", priority=JOB_PRIORITY_HIGH, lane=live_lane) # Auto-refresh detailed HR and steps, new data only
+    else:
+        job_scheduler.every(3 * 60 * fallback, lambda : fetch_and_write(get_intraday_data_limit_1d, account.end_date_str, intraday_measurements), name="intraday", priority=JOB_PRIORITY_HIGH, lane=background_lane) # Auto-refresh detailed HR and steps
+    job_scheduler.every(3600 * fallback, lambda : fetch_and_write(get_intraday_data_limit_1d, (datetime.strptime(account.end_date_str, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d"), intraday_measurements), name="intraday_previous_day", lane=background_lane) # Refilling any missing data on previous day end of night due to fitbit sync delay ( see issue #10 )
+    job_scheduler.every(20 * 60, fetch_and_write, get_battery_level, name="battery_level", lane=background_lane) # Auto-refresh battery level
+    job_scheduler.every(3 * 3600, lambda : fetch_and_write(get_daily_data_limit_30d, account.start_date_str, account.end_date_str), name="daily_data_30d", lane=background_lane)
+    job_scheduler.every(4 * 3600 * fallback, lambda : fetch_and_write(get_daily_data_limit_100d, account.start_date_str, account.end_date_str), name="daily_data_100d", priority=JOB_PRIORITY_LOW, lane=background_lane)
+    job_scheduler.every(6 * 3600 * fallback, lambda : fetch_and_write(get_daily_data_limit_365d, account.start_date_str, account.end_date_str), name="daily_data_365d", priority=JOB_PRIORITY_LOW, lane=background_lane)
+    job_scheduler.every(6 * 3600, lambda : fetch_and_write(get_daily_data_limit_none, account.start_date_str, account.end_date_str), name="daily_data_none", priority=JOB_PRIORITY_LOW, lane=background_lane)
+    job_scheduler.every(3600 * fallback, lambda : fetch_and_write(fetch_latest_activities, account.end_date_str), name="latest_activities", lane=background_lane)
+
+# Ongoing continuous update of data
+def run_scheduled_updates():
+    for account in fitbit_accounts:
+        schedule_account_updates(account)
+    if SUBSCRIBER_PORT > 0:
+        for account in fitbit_accounts:
+            run_as_account(account, create_fitbit_subscriptions)
+        start_subscription_receiver()
+    job_scheduler.every(3600, log_http_connection_stats)
+    job_scheduler.run_forever()
+
+# %% [markdown]
+# ## Main
+
+# %%
+# Importing this file has no side effects ( no log file, network or database access ), everything starts here
+def main():
+    setup_logging()
+    if ARCHIVE_REINGEST:
+        connect_influxdb()
+        reingest_archive(*get_manual_date_range())
+        return
+    if FITBIT_API_BASE_URL:
+        logging.warning("Fitbit API requests are sent to " + FITBIT_API_BASE_URL)
+    start_metrics_export()
+    fitbit_accounts[:] = load_fitbit_accounts()
+    if len(fitbit_accounts) > 1:
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(AccountLogFilter())
+    for account in fitbit_accounts:
+        run_as_account(account, account.token_manager.get_access_token)
+    connect_influxdb()
+    for account in fitbit_accounts:
+        run_as_account(account, resolve_local_timezone)
+    if ARCHIVE_DIR:
+        point_sinks.append(ParquetArchiveSink(ARCHIVE_DIR))
+
+    try:
+        if AUTO_DATE_RANGE:
+            for account in fitbit_accounts:
+                run_as_account(account, update_working_dates)
+            run_on_worker_pool(run_as_account, [(account, run_startup_update) for account in fitbit_accounts], executor=account_executor)
+            flush_point_sinks()
+            log_http_connection_stats()
+        else:
+            start_date_str, end_date_str = get_manual_date_range()
+            if not BULK_RESUME and INFLUXDB_WRITE_DEDUP:
+                write_dedup_index.clear() # the bulk update writes everything again
+            run_on_worker_pool(run_as_account, [(account, run_bulk_update, start_date_str, end_date_str) for account in fitbit_accounts], executor=account_executor)
+            if BULK_DRY_RUN:
+                return
+            flush_point_sinks()
+            log_http_connection_stats()
+            print("Bulk update complete!")
+
+        if SCHEDULE_AUTO_UPDATE:
+            run_scheduled_updates()
+    finally:
+        flush_point_sinks() # the points still buffered by the archive
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# %% [markdown]
+# # Offline benchmark of Fitbit_Fetch.py
+# Runs the script against a local stand-in of the Fitbit API that serves synthetic responses for every endpoint the script uses,
+# and an in-memory InfluxDB 1.x sink that only counts the written lines. No Fitbit account or database is needed.
+# Reports wall time, CPU time, peak RSS and points per second for the auto update pass ( startup update without the schedule )
+# and a multi-year bulk update. The timezone and tcx scenarios time the intraday timezone conversion and the GPS file parser in this process.
+#
+#   python extra/benchmark.py                                   # both scenarios, 2 years of bulk data
+#   python extra/benchmark.py --scenarios bulk --bulk-years 5 --env FETCH_MAX_WORKERS=1
+#   python extra/benchmark.py --scenarios timezone,tcx
+#
+# The stand-in does not enforce the hourly rate limit of 150 calls, the reported API calls divided by 150 give the hours a real run would take.
+
+# %%
+import argparse, importlib.util, io, json, os, random, re, subprocess, sys, tempfile, threading, time, timeit, tracemalloc, pytz
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# %% [markdown]
+# ## Synthetic Fitbit responses
+
+# %%
+# Days without tracker data ( device not worn ), so the bulk planner has some days to skip
+def is_worn(date_str):
+    return datetime.strptime(date_str, "%Y-%m-%d").toordinal() % 30 != 0
+
+def date_range(start_date_str, end_date_str):
+    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+    return [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((datetime.strptime(end_date_str, "%Y-%m-%d") - start_date).days + 1)]
+
+def day_seed(date_str, name):
+    return random.Random(date_str + name)
+
+# Intraday heart rate every heart_interval seconds ( Fitbit reports "1sec" data only every few seconds ) and steps every minute
+def intraday_dataset(kind, start_second, end_second, heart_interval):
+    interval = heart_interval if kind == "heart" else 60
+    rng = random.Random(kind)
+    dataset = []
+    for second in range(start_second - start_second % interval, end_second, interval):
+        value = 55 + int(30 * abs(((second / 3600.0) % 24 - 14) / 14)) + rng.randint(0, 15) if kind == "heart" else (rng.randint(0, 120) if 7 * 3600 <= second < 22 * 3600 else 0)
+        dataset.append({"time": "%02d:%02d:%02d" % (second // 3600, second // 60 % 60, second % 60), "value": value})
+    return dataset
+
+def sleep_record(date_str):
+    rng = day_seed(date_str, "sleep")
+    start_time = datetime.strptime(date_str, "%Y-%m-%d") - timedelta(minutes=rng.randint(60, 150))
+    levels, stage_time = [], start_time
+    while stage_time < start_time + timedelta(hours=7, minutes=30):
+        seconds = rng.randint(3, 40) * 60
+        levels.append({"dateTime": stage_time.isoformat() + ".000", "level": rng.choice(["light", "light", "deep", "rem", "wake"]), "seconds": seconds})
+        stage_time += timedelta(seconds=seconds)
+    minutes = {level: sum(stage["seconds"] for stage in levels if stage["level"] == level) // 60 for level in ["light", "deep", "rem", "wake"]}
+    return {"dateOfSleep": date_str, "startTime": start_time.isoformat() + ".000", "endTime": stage_time.isoformat() + ".000", "isMainSleep": True, "efficiency": rng.randint(80, 98),
+            "minutesAfterWakeup": 0, "minutesAsleep": minutes["light"] + minutes["deep"] + minutes["rem"], "minutesToFallAsleep": 0, "timeInBed": int((stage_time - start_time).total_seconds() // 60), "minutesAwake": minutes["wake"],
+            "levels": {"summary": {level: {"minutes": minutes[level]} for level in minutes}, "data": levels}}
+
+def activity_list(after_date_str, before_date_str, sort, limit, offset, base_url):
+    # one GPS run every other worn day at 07:00 local time
+    first_date, last_date = after_date_str or "2015-01-01", before_date_str or datetime.now().strftime("%Y-%m-%d")
+    activity_dates = [date_str for date_str in date_range(first_date, last_date)[1 if after_date_str else 0:-1 if before_date_str else None] # afterDate and beforeDate are exclusive
+                      if is_worn(date_str) and datetime.strptime(date_str, "%Y-%m-%d").toordinal() % 2 == 0]
+    if sort == "desc":
+        activity_dates.reverse()
+    page = activity_dates[offset:offset + limit]
+    activities = []
+    for date_str in page:
+        log_id = datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+        activities.append({"logId": log_id, "activityName": "Run", "startTime": date_str + "T07:00:00.000-05:00", "activeDuration": 1800000, "duration": 1800000, "calories": 350, "distance": 5.2,
+                           "steps": 5500, "averageHeartRate": 148, "hasGps": True, "tcxLink": base_url + "/1/user/-/activities/" + str(log_id) + ".tcx"})
+    return {"activities": activities, "pagination": {"next": "more" if offset + limit < len(activity_dates) else "", "offset": offset, "limit": limit}}
+
+# 30 minute run with one trackpoint per second
+def tcx_file(log_id):
+    start_time = datetime.fromordinal(log_id).replace(hour=12)
+    trackpoints = []
+    for second in range(1800):
+        trackpoints.append("<Trackpoint><Time>" + (start_time + timedelta(seconds=second)).isoformat() + ".000Z</Time><Position><LatitudeDegrees>" + repr(40 + second * 1e-5) + "</LatitudeDegrees><LongitudeDegrees>" + repr(-70 + second * 1e-5)
+                           + "</LongitudeDegrees></Position><AltitudeMeters>" + repr(10 + second % 50 * 0.5) + "</AltitudeMeters><DistanceMeters>" + repr(second * 2.9) + "</DistanceMeters><HeartRateBpm><Value>" + str(130 + second % 40) + "</Value></HeartRateBpm></Trackpoint>")
+    return ('<?xml version="1.0" encoding="UTF-8"?><TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"><Activities><Activity Sport="Running"><Lap><Track>' + "".join(trackpoints) + '</Track></Lap></Activity></Activities></TrainingCenterDatabase>').encode()
+
+def daily_series(start_date_str, end_date_str, name, value_function):
+    return [{"dateTime": date_str, "value": value_function(date_str, day_seed(date_str, name))} for date_str in date_range(start_date_str, end_date_str)]
+
+# Path pattern -> function( match groups, query parameters, server ) returning the JSON body ( or bytes )
+fitbit_routes = [
+    (r"/1/user/-/activities/(heart|steps)/date/([\d-]+)/1d/(?:1sec|1min)(?:/time/(\d\d):(\d\d)/(\d\d):(\d\d))?\.json", lambda groups, query, server: server.intraday_body(*groups)),
+    (r"/1/user/-/hrv/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"hrv": [{"dateTime": date_str, "value": {"dailyRmssd": round(day_seed(date_str, "hrv").uniform(25, 60), 3), "deepRmssd": round(day_seed(date_str, "deep").uniform(25, 70), 3)}} for date_str in date_range(*groups) if is_worn(date_str)]}),
+    (r"/1/user/-/br/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"br": [{"dateTime": date_str, "value": {"breathingRate": round(day_seed(date_str, "br").uniform(12, 18), 1)}} for date_str in date_range(*groups) if is_worn(date_str)]}),
+    (r"/1/user/-/temp/skin/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"tempSkin": [{"dateTime": date_str, "value": {"nightlyRelative": round(day_seed(date_str, "skin").uniform(-1, 1), 1)}, "logType": "dedicated_temp_sensor"} for date_str in date_range(*groups) if is_worn(date_str)]}),
+    (r"/1/user/-/spo2/date/([\d-]+)/([\d-]+)/all\.json", lambda groups, query, server: [{"dateTime": date_str, "minutes": [{"minute": (datetime.strptime(date_str, "%Y-%m-%d") - timedelta(hours=1) + timedelta(minutes=minute)).isoformat(), "value": round(94 + (minute * 7919 % 50) / 10, 1)} for minute in range(420)]} for date_str in date_range(*groups) if is_worn(date_str)]),
+    (r"/1/user/-/spo2/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: [{"dateTime": date_str, "value": {"avg": 96.1, "min": 92.0, "max": 99.5}} for date_str in date_range(*groups) if is_worn(date_str)]),
+    (r"/1/user/-/body/log/weight/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"weight": [{"date": date_str, "time": "07:15:00", "weight": round(70 + day_seed(date_str, "weight").uniform(-1, 1), 1), "bmi": 22.4, "logId": int(date_str.replace("-", ""))} for date_str in date_range(*groups) if datetime.strptime(date_str, "%Y-%m-%d").weekday() == 0]}),
+    (r"/1\.2/user/-/sleep/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"sleep": [sleep_record(date_str) for date_str in reversed(date_range(*groups)) if is_worn(date_str)]}),
+    (r"/1/user/-/activities/tracker/(minutesSedentary|minutesLightlyActive|minutesFairlyActive|minutesVeryActive|distance|calories|steps)/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"activities-tracker-" + groups[0]: daily_series(groups[1], groups[2], groups[0], lambda date_str, rng: str(rng.randint(1, 900) if is_worn(date_str) else 0))}),
+    (r"/1/user/-/activities/heart/date/([\d-]+)/([\d-]+)\.json", lambda groups, query, server: {"activities-heart": daily_series(groups[0], groups[1], "zones", lambda date_str, rng: {"heartRateZones": [{"name": name, "minutes": rng.randint(0, 600)} for name in ["Out of Range", "Fat Burn", "Cardio", "Peak"]], "restingHeartRate": rng.randint(55, 65)})}),
+    (r"/1/user/-/activities/list\.json", lambda groups, query, server: activity_list(query.get("afterDate", [None])[0], query.get("beforeDate", [None])[0], query.get("sort", ["asc"])[0], int(query.get("limit", ["20"])[0]), int(query.get("offset", ["0"])[0]), server.base_url)),
+    (r"/1/user/-/activities/(\d+)\.tcx", lambda groups, query, server: tcx_file(int(groups[0]))),
+    (r"/1/user/-/profile\.json", lambda groups, query, server: {"user": {"timezone": "America/New_York"}}),
+    (r"/1/user/-/devices\.json", lambda groups, query, server: [{"batteryLevel": 80, "deviceVersion": "Charge 5", "lastSyncTime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000"), "type": "TRACKER"}]),
+]
+fitbit_routes = [(re.compile(pattern + "$"), handler) for pattern, handler in fitbit_routes]
+
+# %% [markdown]
+# ## Stand-in server ( Fitbit API and InfluxDB sink )
+
+# %%
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Fitbit-Rate-Limit-Limit", "150")
+        self.send_header("Fitbit-Rate-Limit-Remaining", "1000000")
+        self.send_header("Fitbit-Rate-Limit-Reset", str(3600 - int(time.time()) % 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path in ["/ping", "/health"]: # InfluxDB
+            return self.send_body(204, b"")
+        if url.path == "/query":
+            return self.send_body(200, {"results": [{"statement_id": 0}]})
+        for pattern, handler in fitbit_routes:
+            match = pattern.match(url.path)
+            if match:
+                self.server.count("api_calls")
+                body = handler(match.groups(), parse_qs(url.query), self.server)
+                return self.send_body(200, body, "application/vnd.garmin.tcx+xml" if url.path.endswith(".tcx") else "application/json")
+        self.send_body(404, {"errors": [{"errorType": "not_found", "message": url.path}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urlparse(self.path)
+        if url.path == "/oauth2/token":
+            return self.send_body(200, {"access_token": "benchmark-access-token", "refresh_token": "benchmark-refresh-token", "expires_in": 28800, "token_type": "Bearer", "user_id": "-"})
+        if url.path in ["/write", "/api/v2/write", "/api/v3/write_lp"]: # InfluxDB 1.x, 2.x and 3.x line protocol writes
+            self.server.count_lines(body)
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_body(404, {})
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, heart_interval):
+        super().__init__(("127.0.0.1", 0), StandInRequestHandler)
+        self.base_url = "http://127.0.0.1:" + str(self.server_address[1])
+        self.heart_interval = heart_interval
+        self.intraday_bodies = {} # the intraday data is the same every day, so the large bodies are built once
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"api_calls": 0, "writes": 0, "points": 0, "measurements": {}}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def count_lines(self, body):
+        lines = [line for line in body.split(b"\n") if line]
+        measurements = {}
+        for line in lines:
+            measurement = re.match(rb"(?:[^\\, ]|\\.)*", line).group(0).replace(b"\\", b"").decode()
+            measurements[measurement] = measurements.get(measurement, 0) + 1
+        with self.lock:
+            self.stats["writes"] += 1
+            self.stats["points"] += len(lines)
+            for measurement, count in measurements.items():
+                self.stats["measurements"][measurement] = self.stats["measurements"].get(measurement, 0) + count
+
+    def intraday_body(self, kind, date_str, start_hour=None, start_minute=None, end_hour=None, end_minute=None):
+        if not is_worn(date_str):
+            return {"activities-" + kind: [{"dateTime": date_str, "value": "0"}], "activities-" + kind + "-intraday": {"dataset": [], "datasetInterval": 1, "datasetType": "second"}}
+        window = (int(start_hour) * 3600 + int(start_minute) * 60, int(end_hour) * 3600 + int(end_minute) * 60 + 60) if start_hour else (0, 86400)
+        with self.lock:
+            body = self.intraday_bodies.get((kind, window))
+        if body is None:
+            body = json.dumps({"activities-" + kind: [{"dateTime": "", "value": "0"}], "activities-" + kind + "-intraday": {"dataset": intraday_dataset(kind, window[0], window[1], self.heart_interval), "datasetInterval": 1, "datasetType": "second"}}).encode()
+            with self.lock:
+                self.intraday_bodies[(kind, window)] = body
+        return body
+
+# %% [markdown]
+# ## Parser benchmarks
+# Run in this process against the functions of the imported script, without the stand-in server
+
+# %%
+# Importing the script has no side effects, everything starts in its main()
+def load_script(script_path):
+    spec = importlib.util.spec_from_file_location("Fitbit_Fetch", script_path)
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+def benchmark_timezone_conversion(script, timezone_name="America/New_York", repeat=5):
+    timezone = pytz.timezone(timezone_name)
+    time_strings = ["%02d:%02d:%02d" % (second // 3600, second // 60 % 60, second % 60) for second in range(86400)]
+    for date_str in ["2024-06-01", "2024-03-10", "2024-11-03"]: # regular day and both DST transition days
+        script.get_local_day_offsets.cache_clear()
+        per_row_iso = lambda: [timezone.localize(datetime.fromisoformat(date_str + "T" + time_str)).astimezone(pytz.utc).isoformat() for time_str in time_strings]
+        per_row_epoch = lambda: [int(timezone.localize(datetime.fromisoformat(date_str + "T" + time_str)).timestamp()) for time_str in time_strings]
+        batched = lambda: script.local_times_to_epoch(date_str, time_strings, timezone)
+        assert batched() == per_row_epoch(), "Batched timezone conversion does not match the per sample conversion for " + date_str
+        print("Timezone conversion of 86400 samples ( 1 sec heart rate ) on " + date_str + " in " + timezone_name + " :")
+        for name, func in [("per sample localize + isoformat", per_row_iso), ("per sample localize + epoch", per_row_epoch), ("batched", batched)]:
+            print("  %-32s %8.1f ms" % (name, min(timeit.repeat(func, number=1, repeat=repeat)) * 1000))
+
+# Synthetic TCX file with one trackpoint per second, similar to what Fitbit returns for GPS activities
+def generate_tcx_file(hours):
+    start_time = datetime(2024, 6, 1, 6, 0, 0)
+    trackpoints = []
+    for second in range(int(hours * 3600)):
+        trackpoints.append("<Trackpoint><Time>" + (start_time + timedelta(seconds=second)).isoformat() + ".000Z</Time><Position><LatitudeDegrees>" + repr(40 + second * 1e-5) + "</LatitudeDegrees><LongitudeDegrees>" + repr(-70 + second * 1e-5) + "</LongitudeDegrees></Position><AltitudeMeters>" + repr(10 + second % 50 * 0.5) + "</AltitudeMeters><DistanceMeters>" + repr(second * 2.5) + "</DistanceMeters><HeartRateBpm><Value>" + str(100 + second % 60) + "</Value></HeartRateBpm></Trackpoint>")
+    return ('<?xml version="1.0" encoding="UTF-8"?><TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"><Activities><Activity Sport="Running"><Lap><Track>' + "".join(trackpoints) + '</Track></Lap></Activity></Activities></TrainingCenterDatabase>').encode()
+
+# Previous TCX parser of the script : whole tree built from the response text, XPath lookups per Trackpoint
+def parse_tcx_tree(tcx_text, ActivityID):
+    namespace = {"ns": "http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"}
+    prev_time = None
+    prev_distance = None
+    for trkpt in ET.fromstring(tcx_text).findall(".//ns:Trackpoint", namespace):
+        time_elem = trkpt.find("ns:Time", namespace)
+        lat = trkpt.find(".//ns:LatitudeDegrees", namespace)
+        lon = trkpt.find(".//ns:LongitudeDegrees", namespace)
+        altitude = trkpt.find("ns:AltitudeMeters", namespace)
+        distance = trkpt.find("ns:DistanceMeters", namespace)
+        heart_rate = trkpt.find(".//ns:HeartRateBpm/ns:Value", namespace)
+        if time_elem is not None and lat is not None:
+            current_time = datetime.fromisoformat(time_elem.text.strip("Z"))
+            fields = {"lat": float(lat.text), "lon": float(lon.text)}
+            if altitude is not None:
+                fields["altitude"] = float(altitude.text)
+            current_distance = float(distance.text) if distance is not None else None
+            if current_distance is not None:
+                fields["distance"] = current_distance
+            if heart_rate is not None:
+                fields["heart_rate"] = int(heart_rate.text)
+            if prev_time is not None and prev_distance is not None and current_distance is not None:
+                time_diff = (current_time - prev_time).total_seconds()
+                if time_diff > 0:
+                    fields["speed_kph"] = (current_distance - prev_distance) / time_diff * 3.6
+            prev_time = current_time
+            prev_distance = current_distance
+            yield {"measurement": "GPS", "tags": {"ActivityID": ActivityID}, "time": current_time.astimezone(pytz.utc).isoformat(), "fields": fields}
+
+def benchmark_tcx_parsing(script, hours_list=(1, 4, 8), repeat=3):
+    for hours in hours_list:
+        tcx_bytes = generate_tcx_file(hours)
+        tree = lambda: sum(1 for _ in parse_tcx_tree(tcx_bytes.decode(), "benchmark"))
+        streaming = lambda: sum(1 for _ in script.parse_tcx_trackpoints(io.BytesIO(tcx_bytes), "benchmark"))
+        assert list(map(script.encode_line_protocol, script.parse_tcx_trackpoints(io.BytesIO(tcx_bytes), "benchmark"))) == list(map(script.encode_line_protocol, parse_tcx_tree(tcx_bytes.decode(), "benchmark"))), "Streaming TCX parser output differs from the tree parser"
+        print("TCX parsing of a " + str(hours) + " hour activity ( " + str(hours * 3600) + " trackpoints, " + str(round(len(tcx_bytes) / 1e6, 1)) + " MB ) :")
+        for name, func in [("tree + XPath lookups", tree), ("streaming", streaming)]:
+            elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+            tracemalloc.start()
+            func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("  %-32s %8.1f ms %8.1f MB peak" % (name, elapsed * 1000, peak_memory / 1e6))
+
+# %% [markdown]
+# ## Benchmark runner
+
+# %%
+# Runs the script in a fresh working directory ( token, state database, archives ) and returns its measurements. Peak RSS and CPU time come
+# from wait4(), so they only cover the script process ( Linux and macOS )
+def run_scenario(script_path, server, scenario_env, extra_env, timeout):
+    work_dir = tempfile.mkdtemp(prefix="fitbit_benchmark_")
+    token_file_path = os.path.join(work_dir, "fitbit.token")
+    with open(token_file_path, "w") as file:
+        json.dump({"access_token": "benchmark-access-token", "refresh_token": "benchmark-refresh-token"}, file)
+    port = str(server.server_address[1])
+    env = dict(os.environ, FITBIT_API_BASE_URL=server.base_url, TOKEN_FILE_PATH=token_file_path, FITBIT_LOG_FILE_PATH=os.path.join(work_dir, "fitbit.log"), CLIENT_ID="benchmark", CLIENT_SECRET="benchmark",
+               DEVICENAME="Charge5", LOCAL_TIMEZONE="Automatic", INFLUXDB_VERSION="1", INFLUXDB_HOST="127.0.0.1", INFLUXDB_PORT=port, INFLUXDB_URL=server.base_url, INFLUXDB_DATABASE="benchmark")
+    env.update(scenario_env)
+    env.update(extra_env)
+    server.reset()
+    started = time.monotonic()
+    with open(os.path.join(work_dir, "stdout.txt"), "w") as stdout:
+        process = subprocess.Popen([sys.executable, script_path], env=env, cwd=work_dir, stdout=stdout, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        _, status, rusage = os.wait4(process.pid, 0)
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall_seconds = time.monotonic() - started
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024) # bytes on macOS, kilobytes on Linux
+    return {"exit_code": process.returncode, "wall_seconds": wall_seconds, "cpu_seconds": rusage.ru_utime + rusage.ru_stime, "peak_rss_mb": peak_rss / 1e6, "work_dir": work_dir, **server.stats}
+
+def print_result(name, result):
+    print(name + ( "" if result["exit_code"] == 0 else "  *** exited with code " + str(result["exit_code"]) + ", see " + os.path.join(result["work_dir"], "stdout.txt") + " ***"))
+    print("  wall time    %10.1f s" % result["wall_seconds"])
+    print("  CPU time     %10.1f s" % result["cpu_seconds"])
+    print("  peak RSS     %10.1f MB" % result["peak_rss_mb"])
+    print("  points       %10d ( %d writes )" % (result["points"], result["writes"]))
+    print("  points/sec   %10.0f" % (result["points"] / result["wall_seconds"]))
+    print("  API calls    %10d ( %.1f hours at 150 calls per hour )" % (result["api_calls"], result["api_calls"] / 150.0))
+    for measurement, count in sorted(result["measurements"].items(), key=lambda item: -item[1]):
+        print("    %-28s %10d" % (measurement, count))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of Fitbit_Fetch.py against a local stand-in Fitbit API and InfluxDB sink")
+    parser.add_argument("--scenarios", default="auto,bulk", help="comma separated : auto ( startup update of the last days ), bulk ( historical update ), timezone ( intraday timezone conversion ) and / or tcx ( GPS file parser )")
+    parser.add_argument("--bulk-years", type=float, default=2, help="years of history fetched by the bulk scenario")
+    parser.add_argument("--heart-interval", type=int, default=5, help="seconds between the synthetic intraday heart rate samples")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Fitbit_Fetch.py"), help="path of the script to benchmark")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra environment variable for the script, can be repeated ( e.g. FETCH_MAX_WORKERS=1 )")
+    parser.add_argument("--timeout", type=int, default=3600, help="seconds after which a scenario is stopped")
+    args = parser.parse_args()
+
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    server = StandInServer(args.heart_interval)
+    threading.Thread(target=server.serve_forever, name="stand-in-server", daemon=True).start()
+    end_date = datetime.now() - timedelta(days=1)
+    scenarios = {
+        "auto": {"SCHEDULE_AUTO_UPDATE": "False"},
+        "bulk": {"AUTO_DATE_RANGE": "False", "MANUAL_START_DATE": (end_date - timedelta(days=int(args.bulk_years * 365))).strftime("%Y-%m-%d"), "MANUAL_END_DATE": end_date.strftime("%Y-%m-%d")},
+    }
+    print("Stand-in Fitbit API and InfluxDB at " + server.base_url + ", heart rate every " + str(args.heart_interval) + " seconds" + (", script environment " + str(extra_env) if extra_env else ""))
+    parser_benchmarks = {"timezone": benchmark_timezone_conversion, "tcx": benchmark_tcx_parsing}
+    for name in args.scenarios.split(","):
+        if name in parser_benchmarks:
+            parser_benchmarks[name](load_script(args.script))
+            continue
+        if name not in scenarios:
+            parser.error("unknown scenario " + name + ", supported values are : " + ", ".join(list(scenarios) + list(parser_benchmarks)))
+        result = run_scenario(args.script, server, scenarios[name], extra_env, args.timeout)
+        print_result(name + ( " ( " + scenarios[name]["MANUAL_START_DATE"] + " to " + scenarios[name]["MANUAL_END_DATE"] + " )" if name == "bulk" else "" ), result)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# %% [markdown]
+# # Stand-in Fitbit subscription notification sender
+# Sends the requests Fitbit sends to a subscriber endpoint, to test the SUBSCRIBER_PORT receiver of Fitbit_Fetch.py without a public URL :
+# the endpoint verification ( GET with the right and a wrong verification code ) and signed notification POSTs. The receiver must answer the
+# verification with 204 and 404, and every notification with 204 ( 404 for an invalid signature ).
+#
+#   python extra/notification_sender.py --url http://127.0.0.1:8090/ --client-secret <CLIENT_SECRET> --verification-code <code>
+#   python extra/notification_sender.py --collection activities --collection sleep --date 2024-03-01 --count 3 --interval 60
+#
+# The subscription IDs follow the "<account name>-<collection>" convention of Fitbit_Fetch.py, the account of a single account setup is "default".
+
+# %%
+import argparse, base64, hashlib, hmac, json, os, time
+from datetime import datetime
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+
+# %% [markdown]
+# ## Requests
+
+# %%
+# Returns the HTTP status code of the response
+def send_request(url, body=None, headers={}):
+    request = Request(url, data=body, headers=headers, method="GET" if body is None else "POST")
+    try:
+        with urlopen(request, timeout=10) as response:
+            return response.status
+    except HTTPError as err:
+        return err.code
+
+# Same signature as Fitbit : base64 of the HMAC-SHA1 of the body, keyed with the client secret followed by "&"
+def sign_body(body, client_secret):
+    return base64.b64encode(hmac.new((client_secret + "&").encode(), body, hashlib.sha1).digest()).decode()
+
+def verify_endpoint(url, verification_code):
+    separator = "&" if "?" in url else "?"
+    correct_status = send_request(url + separator + urlencode({"verify": verification_code}))
+    wrong_status = send_request(url + separator + urlencode({"verify": verification_code + "-wrong"}))
+    print("verification      correct code -> %d ( expected 204 ), wrong code -> %d ( expected 404 )" % (correct_status, wrong_status))
+    return correct_status == 204 and wrong_status == 404
+
+def send_notifications(url, client_secret, notifications, bad_signature=False):
+    body = json.dumps(notifications).encode()
+    signature = sign_body(body, client_secret + ("-wrong" if bad_signature else ""))
+    status = send_request(url, body, {"Content-Type": "application/json", "X-Fitbit-Signature": signature})
+    expected_status = 404 if bad_signature else 204
+    print("notification      %s -> %d ( expected %d )" % (", ".join(notification["collectionType"] + " " + notification["date"] for notification in notifications), status, expected_status))
+    return status == expected_status
+
+# %% [markdown]
+# ## Main
+
+# %%
+def main():
+    parser = argparse.ArgumentParser(description="Sends stand-in Fitbit subscription notifications to the subscriber endpoint of Fitbit_Fetch.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8090/", help="subscriber endpoint URL ( SUBSCRIBER_PORT of the script )")
+    parser.add_argument("--client-secret", default=os.environ.get("CLIENT_SECRET", ""), help="client secret used to sign the notifications ( default : CLIENT_SECRET )")
+    parser.add_argument("--verification-code", help="also test the endpoint verification with this code ( SUBSCRIBER_VERIFICATION_CODE )")
+    parser.add_argument("--account", default="default", help="account name used in the subscription IDs")
+    parser.add_argument("--collection", action="append", choices=["activities", "body", "sleep"], help="collection of the notification, can be repeated ( default : activities )")
+    parser.add_argument("--date", default=datetime.now().strftime("%Y-%m-%d"), help="date of the changed data ( default : today )")
+    parser.add_argument("--count", type=int, default=1, help="number of notification requests, like several device syncs")
+    parser.add_argument("--interval", type=float, default=0, help="seconds between the notification requests")
+    parser.add_argument("--bad-signature", action="store_true", help="sign with a wrong secret, the receiver must reject the notifications")
+    args = parser.parse_args()
+
+    success = verify_endpoint(args.url, args.verification_code) if args.verification_code else True
+    notifications = [{"collectionType": collection, "date": args.date, "ownerId": "STANDIN", "ownerType": "user", "subscriptionId": args.account + "-" + collection} for collection in args.collection or ["activities"]]
+    for request_index in range(args.count):
+        if request_index > 0:
+            time.sleep(args.interval)
+        success = send_notifications(args.url, args.client_secret, notifications, args.bad_signature) and success
+    raise SystemExit(0 if success else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Fitbit_Fetch # importing has no side effects, see main()
+
+pytest.importorskip("pyarrow")
+
+# Reingest writes the line protocol of the archived points, so the integer values must come back as integers ( "72i", not "72.0" )
+def test_mixed_int_float_field_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(Fitbit_Fetch, "ARCHIVE_COMPACT_FILES", 1) # the second flush merges the first file into its own
+    day_start = 1709251200 # 2024-03-01 UTC
+    points = [
+        Fitbit_Fetch.FitbitPoint("Weight", (("Device", "Aria"),), {"value": 72}, day_start),
+        Fitbit_Fetch.FitbitPoint("Weight", (("Device", "Aria"),), {"value": 72.5}, day_start + 60),
+        Fitbit_Fetch.FitbitPoint("Weight", (("Device", "Scale"),), {"value": 73, "bmi": 22.1}, day_start + 120),
+    ]
+    sink = Fitbit_Fetch.ParquetArchiveSink(str(tmp_path))
+    assert sink.write(points[:2]) and sink.flush()
+    assert sink.write(points[2:]) and sink.flush()
+
+    file_paths = Fitbit_Fetch.list_archive_files(str(tmp_path), "2024-03-01", "2024-03-01")
+    assert len(file_paths) == 1
+    archived_points = sorted(Fitbit_Fetch.read_archive_file(file_paths[0]), key=lambda point: point.timestamp)
+    assert [Fitbit_Fetch.encode_line_protocol(point) for point in archived_points] == [Fitbit_Fetch.encode_line_protocol(point) for point in points]
+    assert [type(point.fields["value"]) for point in archived_points] == [int, float, int]